@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'books.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,18 +78,54 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'backend.wsgi.application'
 
+# Serve the book list, detail and comments with the async views of books.async_views;
+# enabled by backend/asgi.py
+ASYNC_READ_VIEWS = config("ASYNC_READ_VIEWS", default=False, cast=bool)
+
+# Requests slower than this are logged to books.slow_requests with their slowest statements
+SLOW_REQUEST_SECONDS = config("SLOW_REQUEST_SECONDS", default=1.0, cast=float)
+SLOW_REQUEST_STATEMENTS = config("SLOW_REQUEST_STATEMENTS", default=10, cast=int)
+
+# Directory of the memory-mapped index build_similar_books writes for /books/<pk>/similar/;
+# every worker must see the same one
+SIMILAR_BOOKS_INDEX = config("SIMILAR_BOOKS_INDEX", default=str(BASE_DIR / "similar-books"))
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
+# DB_ENGINE=sqlite runs the project, tests and benchmarks without PostgreSQL.
+# Search then uses an FTS5 table instead of the tsvector column.
+if config("DB_ENGINE", default="postgresql") == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": config("DB_NAME", default=str(BASE_DIR / "db.sqlite3")),
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": config("DB_NAME"),
+            "USER": config("DB_USER"),
+            "PASSWORD": config("DB_PASSWORD"),
+            "HOST": config("DB_HOST"),
+            "PORT": config("DB_PORT"),
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# locmem is only shared inside one process; use a shared backend such as
+# django.core.cache.backends.filebased.FileBasedCache (CACHE_LOCATION=/var/tmp/books-cache)
+# when running more than one worker.
+
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
-        "NAME": config("DB_NAME"),
-        "USER": config("DB_USER"),
-        "PASSWORD": config("DB_PASSWORD"),
-        "HOST": config("DB_HOST"),
-        "PORT": config("DB_PORT"),
+        "BACKEND": config("CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": config("CACHE_LOCATION", default="books"),
     }
 }
 
@@ -113,11 +150,17 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    # JSON unless the client asks for MessagePack in Accept
+    'DEFAULT_RENDERER_CLASSES': (
+        'books.renderers.ORJSONRenderer',
+        'books.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
 SIMPLE_JWT = {
@@ -0,0 +1,82 @@
+"""
+Cache entries invalidated through version keys, shared by the apps.
+
+An entry is stored together with the value of its version key when it was loaded
+and is only used while that version is current; invalidating bumps the version
+instead of deleting entries.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from prometheus_client import Counter
+
+CACHE_REQUESTS = Counter('books_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+
+
+class CacheStats:
+    """
+    Per-process hit/miss counters of one cache, also counted in /metrics as
+    books_cache_requests_total{cache=name}.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._hit_counter = CACHE_REQUESTS.labels(name, 'hit')
+        self._miss_counter = CACHE_REQUESTS.labels(name, 'miss')
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+        self._hit_counter.inc()
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+        self._miss_counter.inc()
+
+    @property
+    def ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def as_dict(self):
+        return {'hits': self.hits, 'misses': self.misses, 'ratio': self.ratio}
+
+
+def _new_version():
+    # Versions start from the clock so a version key evicted from the cache is never
+    # recreated with a value something stale was stored or handed out under
+    return time.time_ns()
+
+
+def get_version(key):
+    """Current value of the version key `key`, created if it isn't cached."""
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), timeout=None)
+
+
+def invalidate(key):
+    """Bump the version key `key`, and again on commit when in a transaction."""
+    # Anything loaded between the write and the commit is discarded too
+    bump_version(key)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: bump_version(key))
@@ -0,0 +1,192 @@
+"""
+Throughput and latency of the book reads served by uWSGI with the sync views and by
+uvicorn with the async views, at the same number of worker processes.
+
+Both servers run against a throwaway test database created from the configured one
+and seeded with books, comments and bookmarks. Requests are a mix of list, detail
+and comments pages sent by `--concurrency` clients for `--duration` seconds:
+
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.asgi_vs_wsgi --workers 2
+    DB_ENGINE=sqlite SECRET_KEY=x python -m benchmarks.asgi_vs_wsgi --books 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+import httpx  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from books.models import Book, BookStats, Bookmark, Comment  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_commands(port, workers):
+    return {
+        'wsgi': (
+            [shutil.which('uwsgi') or 'uwsgi', '--http', f'127.0.0.1:{port}', '--module', 'backend.wsgi:application',
+             '--master', '--processes', str(workers), '--disable-logging', '--die-on-term', '--need-app'],
+            {'ASYNC_READ_VIEWS': 'false'},
+        ),
+        'asgi': (
+            [sys.executable, '-m', 'uvicorn', 'backend.asgi:application', '--host', '127.0.0.1', '--port', str(port),
+             '--workers', str(workers), '--no-access-log', '--log-level', 'warning'],
+            {'ASYNC_READ_VIEWS': 'true'},
+        ),
+    }
+
+
+def seed(books, comments_per_book):
+    user = User.objects.create_user(username='benchmark', password='benchmark')
+    readers = User.objects.bulk_create([User(username=f'reader{i}') for i in range(comments_per_book)])
+    created = Book.objects.bulk_create([
+        Book(title=f'Book {i:06}', author=f'Author {i % 50}', description='Benchmark book ' * 20,
+             published_date='2024-01-01')
+        for i in range(books)
+    ])
+    now = timezone.now()
+    Comment.objects.bulk_create([
+        Comment(user=reader, book=book, text=f'Comment {i}', rating=i % 5 + 1, submitted_on=now - timedelta(minutes=i))
+        for book in created for i, reader in enumerate(readers)
+    ])
+    ratings = {f'rating_{rating}': 0 for rating in BookStats.RATINGS}
+    for i in range(comments_per_book):
+        ratings[f'rating_{i % 5 + 1}'] += 1
+    rating_sum = sum(i % 5 + 1 for i in range(comments_per_book))
+    BookStats.objects.bulk_create([
+        BookStats(book=book, rating_sum=rating_sum, text_count=comments_per_book, **ratings) for book in created
+    ])
+    Bookmark.objects.bulk_create([Bookmark(user=user, book=book) for book in created[::10]])
+    token = AccessToken.for_user(user)
+    token.set_exp(lifetime=timedelta(hours=2))
+    return str(token), [book.id for book in created]
+
+
+def wait_for(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with {process.returncode}')
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server did not start within {timeout}s')
+
+
+async def load(base_url, token, book_ids, concurrency, duration):
+    def random_path():
+        return random.choice(['/books/list/', '/books/{}/', '/books/{}/comments/']).format(random.choice(book_ids))
+
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client(http):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            path = random_path()
+            started = time.perf_counter()
+            try:
+                response = await http.get(path)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    # A connection per request, as nginx talks to the backend
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    headers = {'Authorization': f'Bearer {token}'}
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=30) as http:
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(command, env, base_url, args, token, book_ids):
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env={**os.environ, **env},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(f'{base_url}/books/list/', process)
+        # Warm up the workers: imports, connections and caches
+        asyncio.run(load(base_url, token, book_ids, args.concurrency, 2))
+        latencies, errors = asyncio.run(load(base_url, token, book_ids, args.concurrency, args.duration))
+    finally:
+        process.terminate()
+        process.wait(30)
+    return {
+        'requests/s': len(latencies) / args.duration,
+        'p50 ms': statistics.median(latencies) * 1000,
+        'p99 ms': percentile(latencies, 0.99) * 1000,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes of each server")
+    parser.add_argument('--concurrency', type=int, default=32, help="Clients sending requests at the same time")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of load per server")
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--comments', type=int, default=10, help="Comments per book")
+    parser.add_argument('--servers', nargs='+', choices=['wsgi', 'asgi'], default=['wsgi', 'asgi'])
+    args = parser.parse_args()
+
+    database = settings.DATABASES['default']
+    if connection.vendor == 'sqlite':
+        # The servers run in other processes, so the test database can't be in memory
+        directory = tempfile.mkdtemp()
+        database.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        token, book_ids = seed(args.books, args.comments)
+        env = {'DB_NAME': connection.settings_dict['NAME']}
+        if connection.vendor == 'sqlite':
+            env['DB_ENGINE'] = 'sqlite'
+        port = free_port()
+        commands = server_commands(port, args.workers)
+        print(f'{args.books} books, {args.workers} worker(s), {args.concurrency} clients, {args.duration:g}s per server')
+        for kind in args.servers:
+            command, server_env = commands[kind]
+            results = run(command, {**env, **server_env}, f'http://localhost:{port}', args, token, book_ids)
+            print(f'{kind}: ' + ', '.join(
+                f'{name} {value:.1f}' if isinstance(value, float) else f'{name} {value}' for name, value in results.items()
+            ))
+    finally:
+        connection.close()
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
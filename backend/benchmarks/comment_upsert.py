@@ -0,0 +1,132 @@
+"""
+Round trips and latency of POST /books/comment/<pk>/, before and after the
+single-statement upsert, for a new comment and for an edit.
+
+Runs against a throwaway test database created from the configured one:
+
+    DB_ENGINE=sqlite SECRET_KEY=x python -m benchmarks.comment_upsert
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.comment_upsert --iterations 500
+"""
+import argparse
+import os
+import statistics
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import IntegrityError, connection, transaction  # noqa: E402
+from django.db.models import F  # noqa: E402
+from django.shortcuts import get_object_or_404  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases  # noqa: E402
+from rest_framework import status  # noqa: E402
+from rest_framework.response import Response  # noqa: E402
+from rest_framework.test import APIRequestFactory, force_authenticate  # noqa: E402
+from rest_framework.views import APIView  # noqa: E402
+
+from books.cache import invalidate_bookmarks, invalidate_catalog  # noqa: E402
+from books.models import Book, BookStats, Bookmark, Comment  # noqa: E402
+from books.serializers import CommentSerializer  # noqa: E402
+from books.views import SubmitCommentView  # noqa: E402
+
+
+def legacy_record(book_id, old=None, new=None):
+    """BookStats.record as it was before the upsert: get_or_create, then an UPDATE."""
+    deltas = {}
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        text, rating = values
+        if text is not None:
+            deltas['text_count'] = deltas.get('text_count', 0) + sign
+        if rating:
+            deltas[f'rating_{rating}'] = deltas.get(f'rating_{rating}', 0) + sign
+            deltas['rating_sum'] = deltas.get('rating_sum', 0) + sign * int(rating)
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if deltas:
+        BookStats.objects.get_or_create(book_id=book_id)
+        BookStats.objects.filter(book_id=book_id).update(**{field: F(field) + delta for field, delta in deltas.items()})
+
+
+class LegacySubmitCommentView(APIView):
+    """SubmitCommentView.post as it was before the upsert, for comparison."""
+
+    def post(self, request, pk):
+        book = get_object_or_404(Book, id=pk)
+        text = request.data.get('text') or None
+        rating = int(request.data['rating']) if request.data.get('rating') else None
+        try:
+            with transaction.atomic():
+                bookmark = Bookmark.objects.filter(user=request.user, book=book).first()
+                if bookmark:
+                    bookmark.delete()
+                    invalidate_bookmarks(request.user.id)
+                    invalidate_catalog()
+                comment = Comment.objects.create(user=request.user, book=book, text=text, rating=rating)
+                legacy_record(book.id, new=(text, rating))
+                Book.objects.filter(pk=book.pk).bump_version()
+            created = True
+        except IntegrityError:
+            with transaction.atomic():
+                comment = Comment.objects.select_for_update().get(user=request.user, book=book)
+                old = (comment.text, comment.rating)
+                comment.text = text
+                comment.rating = rating if rating else 0
+                comment.save()
+                legacy_record(book.id, old=old, new=(comment.text, comment.rating))
+                Book.objects.filter(pk=book.pk).bump_version()
+            created = False
+        return Response(CommentSerializer(comment).data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+def submit(view, user, book, rating):
+    request = APIRequestFactory().post(f'/books/comment/{book.id}/', {'text': 'Benchmark', 'rating': rating})
+    force_authenticate(request, user)
+    start = time.perf_counter()
+    with CaptureQueriesContext(connection) as queries:
+        response = view(request, pk=book.id)
+    elapsed = time.perf_counter() - start
+    assert response.status_code in (200, 201), response.data
+    return len(queries), elapsed
+
+
+def measure(view, user, book, iterations):
+    results = {'create': [], 'edit': []}
+    for i in range(iterations):
+        Comment.objects.filter(user=user, book=book).delete()
+        Bookmark.objects.create(user=user, book=book)
+        results['create'].append(submit(view, user, book, i % 5 + 1))
+        results['edit'].append(submit(view, user, book, (i + 2) % 5 + 1))
+    return {
+        path: (max(count for count, _ in runs), statistics.mean(elapsed for _, elapsed in runs) * 1000)
+        for path, runs in results.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        user = User.objects.create(username='benchmark')
+        book = Book.objects.create(title='Benchmark', author='Benchmark', published_date='2024-01-01')
+        views = {
+            'before': LegacySubmitCommentView.as_view(),
+            'after': SubmitCommentView.as_view(),
+        }
+        print(f'{connection.vendor}, {args.iterations} iterations')
+        print(f'{"":8}{"path":8}{"statements":>12}{"mean ms":>10}')
+        for name, view in views.items():
+            for path, (count, mean) in measure(view, user, book, args.iterations).items():
+                print(f'{name:8}{path:8}{count:>12}{mean:>10.3f}')
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
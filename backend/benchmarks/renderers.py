@@ -0,0 +1,103 @@
+"""
+Serialize and render time of the book list and detail payloads with DRF's
+JSONRenderer, ORJSONRenderer and MessagePackRenderer.
+
+The books are read once; only BookSerializer.data and the renderer are timed. Runs
+against a throwaway test database created from the configured one:
+
+    DB_ENGINE=sqlite SECRET_KEY=x python -m benchmarks.renderers
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.renderers --iterations 2000
+"""
+import argparse
+import os
+import statistics
+import time
+from datetime import timedelta
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+
+from books.models import Book, BookStats, Comment  # noqa: E402
+from books.pagination import BookCursorPagination  # noqa: E402
+from books.renderers import MessagePackRenderer, ORJSONRenderer  # noqa: E402
+from books.serializers import BookSerializer  # noqa: E402
+
+RENDERERS = {'json': JSONRenderer, 'orjson': ORJSONRenderer, 'msgpack': MessagePackRenderer}
+
+
+def seed(books, comments):
+    readers = User.objects.bulk_create([User(username=f'reader{i}') for i in range(comments)])
+    created = Book.objects.bulk_create([
+        Book(title=f'کتاب شماره {i:04}', author='نویسنده', description='توضیحات کتاب ' * 40, published_date='2024-01-01')
+        for i in range(books)
+    ])
+    now = timezone.now()
+    Comment.objects.bulk_create([
+        Comment(user=reader, book=created[0], text=f'نظر {i}', rating=i % 5 + 1, submitted_on=now - timedelta(minutes=i))
+        for i, reader in enumerate(readers)
+    ])
+    BookStats.objects.bulk_create([BookStats(book=book, rating_4=3, rating_sum=12, text_count=3) for book in created])
+    return created[0].id
+
+
+def measure(payloads, renderers, iterations):
+    results = {}
+    for payload, (instance, context, many) in payloads.items():
+        for name, renderer in renderers.items():
+            serialize, render = [], []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                data = BookSerializer(instance, many=many, context=context).data
+                serialized = time.perf_counter()
+                content = renderer.render(data)
+                serialize.append(serialized - started)
+                render.append(time.perf_counter() - serialized)
+            results[payload, name] = (statistics.mean(serialize) * 1000, statistics.mean(render) * 1000, len(content))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--page-size', type=int, default=BookCursorPagination.max_page_size)
+    args = parser.parse_args()
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        book_id = seed(args.page_size, BookSerializer.COMMENTS_PREVIEW_SIZE)
+        request = APIRequestFactory().get('/books/list/')
+        list_fields = set(BookSerializer.LIST_FIELDS)
+        page = list(BookSerializer.get_queryset(list_fields, BookCursorPagination.ordering)[:args.page_size])
+        detail_fields = set(BookSerializer.DETAIL_FIELDS)
+        book = BookSerializer.get_queryset(detail_fields).get(pk=book_id)
+        # Loaded up front as AsyncBookDetailView does, so the renderers don't run the query
+        users_actions = list(BookSerializer.users_actions(Comment.objects.filter(book_id=book_id)))
+        payloads = {
+            f'list ({args.page_size} books)': (page, {'request': request, 'fields': list_fields, 'bookmarked_ids': set()}, True),
+            'detail': (book, {
+                'request': request, 'detailed': True, 'fields': detail_fields, 'bookmarked_ids': set(),
+                'users_actions': users_actions,
+            }, False),
+        }
+        renderers = {name: renderer() for name, renderer in RENDERERS.items()}
+        results = measure(payloads, renderers, args.iterations)
+
+        print(f'{connection.vendor}, {args.iterations} iterations')
+        print(f'{"payload":20}{"renderer":>10}{"serialize ms":>14}{"render ms":>11}{"total ms":>10}{"bytes":>8}')
+        for (payload, name), (serialize, render, size) in results.items():
+            print(f'{payload:20}{name:>10}{serialize:>14.3f}{render:>11.3f}{serialize + render:>10.3f}{size:>8}')
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
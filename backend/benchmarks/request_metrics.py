@@ -0,0 +1,81 @@
+"""
+Overhead of RequestMetricsMiddleware: mean time of the book list, detail and comments
+requests through the full middleware stack with and without it.
+
+Runs against a throwaway test database created from the configured one:
+
+    DB_ENGINE=sqlite SECRET_KEY=x python -m benchmarks.request_metrics
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.request_metrics --iterations 2000
+"""
+import argparse
+import os
+import statistics
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.test.utils import setup_databases, teardown_databases  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from books.models import Book, Comment  # noqa: E402
+
+MIDDLEWARE = 'books.middleware.RequestMetricsMiddleware'
+
+
+def measure(clients, paths, iterations):
+    timings = {(name, path): [] for name in clients for path in paths}
+    for _ in range(iterations):
+        # Alternated so both stacks see the same caches and load
+        for name, client in clients.items():
+            for path in paths:
+                start = time.perf_counter()
+                response = client.get(path)
+                timings[name, path].append(time.perf_counter() - start)
+                assert response.status_code == 200, response.content
+    return {key: statistics.mean(values) * 1000 for key, values in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        user = User.objects.create(username='benchmark')
+        books = Book.objects.bulk_create([
+            Book(title=f'Book {i:04}', author='Benchmark', published_date='2024-01-01') for i in range(100)
+        ])
+        readers = User.objects.bulk_create([User(username=f'reader{i}') for i in range(10)])
+        Comment.objects.bulk_create([Comment(user=reader, book=books[0], text='Benchmark', rating=4) for reader in readers])
+        authorization = f'Bearer {AccessToken.for_user(user)}'
+        paths = ['/books/list/', f'/books/{books[0].id}/', f'/books/{books[0].id}/comments/']
+
+        # A client builds its middleware chain on its first request
+        clients = {}
+        without = [name for name in settings.MIDDLEWARE if name != MIDDLEWARE]
+        for name, middleware in (('without', without), ('with', settings.MIDDLEWARE)):
+            with override_settings(MIDDLEWARE=middleware):
+                clients[name] = Client(HTTP_AUTHORIZATION=authorization, HTTP_HOST='localhost')
+                response = clients[name].get(paths[0])
+            assert response.has_header('Server-Timing') == (name == 'with')
+        results = measure(clients, paths, args.iterations)
+
+        print(f'{connection.vendor}, {args.iterations} iterations')
+        print(f'{"path":28}{"without ms":>12}{"with ms":>10}{"overhead":>10}')
+        for path in paths:
+            before, after = results['without', path], results['with', path]
+            print(f'{path:28}{before:>12.3f}{after:>10.3f}{(after - before) / before:>10.1%}')
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Latency, throughput and query counts of every API endpoint against the configured
+database, usually one filled by `manage.py generate_dataset`.
+
+Requests go through the full middleware stack in this process (Django test client),
+or over HTTP to a running server with `--url`. Query counts are read from the
+Server-Timing header set by RequestMetricsMiddleware, so both modes report them.
+Writes are made by a `benchmark` user on books picked once per run and are undone
+at the end, so runs can be repeated on the same data:
+
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.runner --save-baseline main
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.runner --baseline main
+    SECRET_KEY=x DB_HOST=... python -m benchmarks.runner --url http://localhost:8000 --concurrency 16
+
+With `--baseline` the run exits with status 1 when a scenario fails a request, its
+p95 grew by more than `--tolerance` (and `--slack-ms`), or it makes more queries.
+Baselines are only comparable on the machine and dataset they were measured on, so
+benchmarks/baselines/ isn't committed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from collections import namedtuple
+from datetime import timedelta
+from urllib.parse import urlencode
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+import httpx  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.db.models import F  # noqa: E402
+from django.test import Client  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken  # noqa: E402
+
+from books.cache import invalidate_bookmarks, invalidate_catalog, invalidate_stats  # noqa: E402
+from books.dataset import WORDS  # noqa: E402
+from books.models import Book, BookRanking, BookStats, Bookmark, Comment  # noqa: E402
+from books.pagination import BookCursorPagination  # noqa: E402
+
+BASELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+BULK_SIZE = 10
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+# `count` is the share of --requests a scenario sends: password hashing makes the auth
+# endpoints slow by design, and an export reads the whole catalog
+Scenario = namedtuple('Scenario', 'name method path body status count', defaults=(None, 200, 1.0))
+
+
+def reset(user):
+    """Undo the writes of earlier runs: comments (and their stats and rankings), bookmarks, registrations."""
+    with transaction.atomic():
+        comments = list(Comment.objects.filter(user=user).values_list('book_id', 'text', 'rating', 'submitted_on'))
+        for book_id, text, rating, _ in comments:
+            BookStats.record(book_id, old=(text, rating))
+        Comment.objects.filter(user=user).delete()
+        bookmarked = list(Bookmark.objects.filter(user=user).values_list('book_id', 'added_on'))
+        Bookmark.objects.filter(user=user).delete()
+        BookRanking.record(
+            [(book_id, -BookRanking.COMMENT_WEIGHT, submitted_on) for book_id, _, _, submitted_on in comments]
+            + [(book_id, -BookRanking.BOOKMARK_WEIGHT, added_on) for book_id, added_on in bookmarked]
+        )
+        Book.objects.filter(pk__in=[row[0] for row in comments + bookmarked]).update(version=F('version') + 1)
+        User.objects.filter(username__startswith=f'{USERNAME}-').delete()
+    invalidate_bookmarks(user.id)
+    invalidate_catalog()
+    invalidate_stats()
+
+
+def scenarios(requests, rng):
+    book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+    if len(book_ids) < 3 * requests + BULK_SIZE:
+        raise SystemExit(f'Need at least {3 * requests + BULK_SIZE} books, run manage.py generate_dataset first')
+    popular = (
+        BookStats.objects.annotate(comments=sum((F(f'rating_{i}') for i in BookStats.RATINGS), F('text_count')))
+        .order_by('-comments').values_list('book_id', flat=True).first()
+    ) or book_ids[0]
+    author = Book.objects.filter(pk=popular).values_list('author', flat=True).get()
+
+    paginator = BookCursorPagination()
+    paginator.base_url = '/books/list/'
+    middle = Book.objects.order_by(*paginator.ordering).values_list(*paginator.ordering)[len(book_ids) // 2]
+    deep_page = paginator.encode_cursor(list(middle), reverse=False)
+
+    # Every write scenario works on its own books, so a bookmark never meets a comment
+    pool = rng.sample(book_ids, 3 * requests + BULK_SIZE)
+    bookmarks, comments, bulk = pool[:requests], pool[requests:3 * requests], pool[3 * requests:]
+    refresh = str(RefreshToken.for_user(User.objects.get(username=USERNAME)))
+    run = int(time.time())
+    return [
+        Scenario('list', 'GET', lambda i: '/books/list/'),
+        Scenario('list-deep', 'GET', lambda i: deep_page),
+        Scenario('list-sparse', 'GET', lambda i: '/books/list/?fields=id,title&limit=100'),
+        Scenario('list-author', 'GET', lambda i: f'/books/list/?{urlencode({"author": author})}'),
+        Scenario('detail-popular', 'GET', lambda i: f'/books/{popular}/'),
+        Scenario('detail-random', 'GET', lambda i: f'/books/{rng.choice(book_ids)}/'),
+        Scenario('detail-sparse', 'GET', lambda i: f'/books/{rng.choice(book_ids)}/?fields=title,rating_avg'),
+        Scenario('comments-popular', 'GET', lambda i: f'/books/{popular}/comments/'),
+        Scenario('comments-random', 'GET', lambda i: f'/books/{rng.choice(book_ids)}/comments/'),
+        Scenario('search', 'GET', lambda i: f'/books/search/?{urlencode({"q": f"{rng.choice(WORDS)} {rng.choice(WORDS)}"})}'),
+        Scenario('top', 'GET', lambda i: '/books/top/'),
+        Scenario('trending', 'GET', lambda i: '/books/trending/'),
+        Scenario('similar', 'GET', lambda i: f'/books/{rng.choice(book_ids)}/similar/'),
+        Scenario('related', 'GET', lambda i: f'/books/{rng.choice(book_ids)}/related/'),
+        Scenario('bookmark-add', 'POST', lambda i: f'/books/bookmark/{bookmarks[i]}/', status=201),
+        Scenario('bookmark-remove', 'DELETE', lambda i: f'/books/bookmark/{bookmarks[i]}/', status=204),
+        Scenario('bookmark-bulk', 'POST', lambda i: '/books/bookmark/bulk/',
+                 lambda i: {'add': bulk} if i % 2 == 0 else {'remove': bulk}),
+        Scenario('comment-new', 'POST', lambda i: f'/books/comment/{comments[i]}/',
+                 lambda i: {'text': 'Benchmark', 'rating': i % 5 + 1}, status=201),
+        Scenario('comment-edit', 'POST', lambda i: f'/books/comment/{comments[i]}/',
+                 lambda i: {'text': 'Benchmark, edited', 'rating': (i + 1) % 5 + 1}),
+        Scenario('comment-rating-only', 'POST', lambda i: f'/books/comment/{comments[requests + i]}/',
+                 lambda i: {'text': '', 'rating': i % 5 + 1}, status=201),
+        Scenario('export', 'GET', lambda i: '/books/export/', count=0.01),
+        Scenario('token', 'POST', lambda i: '/auth/token/', lambda i: {'username': USERNAME, 'password': PASSWORD},
+                 count=0.05),
+        Scenario('token-refresh', 'POST', lambda i: '/auth/token/refresh/', lambda i: {'refresh': refresh}),
+        Scenario('register', 'POST', lambda i: '/auth/register/', lambda i: {
+            'username': f'{USERNAME}-{run}-{i}', 'email': f'{USERNAME}-{run}-{i}@example.com',
+            'password': 'Benchmark-1234', 'password_confirm': 'Benchmark-1234',
+        }, status=201, count=0.05),
+    ]
+
+
+def queries(response):
+    # The header of a streamed response is sent before the queries that produce the body;
+    # CommonMiddleware sets Content-Length on all the others
+    if 'Content-Length' not in response.headers:
+        return None
+    match = QUERIES.search(response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def run_in_process(scenario, requests, authorization):
+    client = Client(HTTP_AUTHORIZATION=authorization, HTTP_HOST='localhost')
+    send = getattr(client, scenario.method.lower())
+    latencies, counts, errors = [], [], 0
+    started = time.perf_counter()
+    for i in range(requests):
+        body = scenario.body(i) if scenario.body else None
+        path = scenario.path(i)
+        request_started = time.perf_counter()
+        if body is None:
+            response = send(path)
+        else:
+            response = send(path, body, content_type='application/json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        latencies.append(time.perf_counter() - request_started)
+        counts.append(queries(response))
+        errors += response.status_code != scenario.status
+    return latencies, counts, errors, time.perf_counter() - started
+
+
+async def run_http(scenario, requests, authorization, url, concurrency):
+    latencies, counts, errors = [], [], 0
+    indexes = iter(range(requests))
+
+    async def worker(http):
+        nonlocal errors
+        for i in indexes:
+            body = scenario.body(i) if scenario.body else None
+            request_started = time.perf_counter()
+            try:
+                response = await http.request(scenario.method, scenario.path(i), json=body)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - request_started)
+            counts.append(queries(response))
+            errors += response.status_code != scenario.status
+
+    # A connection per request, as nginx talks to the backend
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    async with httpx.AsyncClient(base_url=url, headers={'Authorization': authorization}, limits=limits,
+                                 timeout=60) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(http) for _ in range(concurrency)))
+    return latencies, counts, errors, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, counts, errors, elapsed):
+    known = [count for count in counts if count is not None]
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'requests_per_s': len(latencies) / elapsed if elapsed else None,
+        'queries': max(known) if known else None,
+    }
+
+
+def regressions(results, baseline, tolerance, slack_ms):
+    failures = []
+    for name, result in results.items():
+        if result['errors']:
+            failures.append(f'{name}: {result["errors"]} failed request(s)')
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        limit = before['p95_ms'] * (1 + tolerance) + slack_ms
+        if result['p95_ms'] > limit:
+            failures.append(f'{name}: p95 {result["p95_ms"]:.1f} ms, baseline {before["p95_ms"]:.1f} ms (limit {limit:.1f} ms)')
+        if result['queries'] is not None and before['queries'] is not None and result['queries'] > before['queries']:
+            failures.append(f'{name}: {result["queries"]} queries, baseline {before["queries"]}')
+    return failures
+
+
+def print_results(results):
+    print(f'{"scenario":22}{"requests":>9}{"errors":>7}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"req/s":>9}{"queries":>8}')
+    for name, result in results.items():
+        print(f'{name:22}{result["requests"]:>9}{result["errors"]:>7}' + ''.join(
+            f'{result[key]:>9.1f}' if result[key] is not None else f'{"-":>9}'
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'requests_per_s')
+        ) + (f'{result["queries"]:>8}' if result['queries'] is not None else f'{"-":>8}'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Base URL of a running server; requests are made in-process without it")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="Clients sending requests at the same time over HTTP")
+    parser.add_argument('--warmup', type=int, default=10, help="Unmeasured requests before each read scenario")
+    parser.add_argument('--scenarios', nargs='+', help="Only run these scenarios")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', metavar='NAME', help="Store the results in baselines/NAME.json")
+    parser.add_argument('--baseline', metavar='NAME', help="Compare with baselines/NAME.json and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative growth of p95")
+    parser.add_argument('--slack-ms', type=float, default=1.0, help="Allowed absolute growth of p95 on top of it")
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Staff, for the catalog export
+    user, created = User.objects.get_or_create(username=USERNAME, defaults={'is_staff': True})
+    if created or not user.is_staff or not user.check_password(PASSWORD):
+        user.is_staff = True
+        user.set_password(PASSWORD)
+        user.save()
+    token = AccessToken.for_user(user)
+    token.set_exp(lifetime=timedelta(hours=12))
+    authorization = f'Bearer {token}'
+    reset(user)
+
+    rng = random.Random(args.seed)
+    selected = [
+        scenario for scenario in scenarios(args.requests, rng)
+        if not args.scenarios or scenario.name in args.scenarios
+    ]
+    mode = 'http' if args.url else 'in-process'
+    print(f'{connection.vendor}, {Book.objects.count()} books, {Comment.objects.count()} comments, {mode}'
+          + (f', {args.concurrency} clients' if args.url else ''))
+
+    results = {}
+    try:
+        for scenario in selected:
+            requests = max(1, int(args.requests * scenario.count))
+            if scenario.method == 'GET' and args.warmup:
+                warmup = min(args.warmup, requests)
+                if args.url:
+                    asyncio.run(run_http(scenario, warmup, authorization, args.url, args.concurrency))
+                else:
+                    run_in_process(scenario, warmup, authorization)
+            if args.url:
+                measured = asyncio.run(run_http(scenario, requests, authorization, args.url, args.concurrency))
+            else:
+                measured = run_in_process(scenario, requests, authorization)
+            results[scenario.name] = summarize(*measured)
+    finally:
+        reset(user)
+    print_results(results)
+
+    report = {'vendor': connection.vendor, 'mode': mode, 'scenarios': results}
+    for path in filter(None, [
+        args.output, args.save_baseline and os.path.join(BASELINES_DIR, f'{args.save_baseline}.json'),
+    ]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as output:
+            json.dump(report, output, indent=2)
+            output.write('\n')
+
+    if args.baseline:
+        with open(os.path.join(BASELINES_DIR, f'{args.baseline}.json')) as baseline_file:
+            baseline = json.load(baseline_file)
+        if (baseline['vendor'], baseline['mode']) != (report['vendor'], report['mode']):
+            print(f'Baseline {args.baseline} was measured on {baseline["vendor"]}, {baseline["mode"]}', file=sys.stderr)
+        failures = regressions(results, baseline, args.tolerance, args.slack_ms)
+        for failure in failures:
+            print(f'REGRESSION {failure}', file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        print(f'No regression against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
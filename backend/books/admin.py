@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Book, Bookmark, Comment
+from .models import Book, BookStats, Bookmark, Comment
 
 class BookAdmin(admin.ModelAdmin):
     list_display = ('title', 'author', 'published_date')
@@ -19,6 +19,11 @@ class CommentAdmin(admin.ModelAdmin):
     list_filter = ('rating', 'submitted_on')
     ordering = ('-submitted_on',)
 
+class BookStatsAdmin(admin.ModelAdmin):
+    list_display = ('book', 'text_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5')
+    search_fields = ('book__title',)
+
 admin.site.register(Book, BookAdmin)
 admin.site.register(Bookmark, BookmarkAdmin)
 admin.site.register(Comment, CommentAdmin)
+admin.site.register(BookStats, BookStatsAdmin)
@@ -1,6 +1,26 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_index(using, **kwargs):
+    from django.db import connections
+    from .search import ensure_sqlite_search_index
+
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        ensure_sqlite_search_index(connection)
 
 
 class BooksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'books'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .metrics import record_queries
+        from .search import register_sqlite_functions
+
+        connection_created.connect(register_sqlite_functions)
+        connection_created.connect(record_queries)
+        post_migrate.connect(ensure_search_index, sender=self)
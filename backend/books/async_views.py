@@ -0,0 +1,221 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.utils.cache import patch_vary_headers
+from django.views import View
+from rest_framework import exceptions, status
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .cache import get_bookmarked_ids, get_list_page, set_list_page
+from .etags import book_detail_etag, book_list_etag, condition
+from .metrics import timed
+from .models import Book, Comment
+from .pagination import BookCursorPagination, CommentCursorPagination
+from .serializers import BookSerializer
+from .views import list_filters, list_page, select_fields, with_bookmarks
+
+
+async def load_bookmarked_ids(request, fields):
+    # Only looked up when the response has is_bookmarked
+    if 'is_bookmarked' in fields:
+        return await sync_to_async(get_bookmarked_ids)(request.user.id)
+    return None
+
+
+class AsyncAPIView(View):
+    """
+    Minimal async counterpart of APIView for read endpoints served over ASGI: the
+    same authentication, permission and throttle classes, exception handling and
+    content negotiation, without blocking the event loop while the queries run.
+    """
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    permission_classes = api_settings.DEFAULT_PERMISSION_CLASSES
+    throttle_classes = api_settings.DEFAULT_THROTTLE_CLASSES
+
+    async def dispatch(self, request, *args, **kwargs):
+        request = Request(request, authenticators=self.get_authenticators())
+        self.request = request
+        self.args = args
+        self.kwargs = kwargs
+        try:
+            handler = getattr(self, request.method.lower(), None)
+            request.accepted_renderer, request.accepted_media_type = self.perform_content_negotiation(request)
+            # The authenticators, permissions and throttles may query the database or cache
+            await sync_to_async(self.initial)(request)
+            if request.method.lower() not in self.http_method_names or handler is None:
+                raise exceptions.MethodNotAllowed(request.method)
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        return self.finalize_response(request, response)
+
+    def initial(self, request):
+        """Authenticate, then check the permissions and throttles, as APIView.initial() does."""
+        # Runs the authenticators
+        request.user
+        self.check_permissions(request)
+        self.check_throttles(request)
+
+    def get_renderers(self):
+        # The browsable API needs an APIView
+        return [
+            renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+            if not issubclass(renderer, BrowsableAPIRenderer)
+        ]
+
+    def perform_content_negotiation(self, request):
+        renderers = self.get_renderers()
+        try:
+            return api_settings.DEFAULT_CONTENT_NEGOTIATION_CLASS().select_renderer(request, renderers)
+        except exceptions.NotAcceptable:
+            # Such as browsers asking for HTML
+            return renderers[0], renderers[0].media_type
+
+    def get_authenticators(self):
+        return [auth() for auth in self.authentication_classes]
+
+    def get_permissions(self):
+        return [permission() for permission in self.permission_classes]
+
+    def get_throttles(self):
+        return [throttle() for throttle in self.throttle_classes]
+
+    def check_permissions(self, request):
+        for permission in self.get_permissions():
+            if not permission.has_permission(request, self):
+                if request.authenticators and not request.successful_authenticator:
+                    raise exceptions.NotAuthenticated()
+                raise exceptions.PermissionDenied(getattr(permission, 'message', None), getattr(permission, 'code', None))
+
+    def check_throttles(self, request):
+        waits = [throttle.wait() for throttle in self.get_throttles() if not throttle.allow_request(request, self)]
+        if waits:
+            # Throttles that can't tell how long to wait don't count
+            waits = [wait for wait in waits if wait is not None]
+            raise exceptions.Throttled(max(waits, default=None))
+
+    def handle_exception(self, exc):
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            authenticators = self.get_authenticators()
+            auth_header = authenticators[0].authenticate_header(self.request) if authenticators else None
+            if auth_header:
+                exc.auth_header = auth_header
+            else:
+                exc.status_code = status.HTTP_403_FORBIDDEN
+        response = api_settings.EXCEPTION_HANDLER(exc, {'view': self, 'args': self.args, 'kwargs': self.kwargs, 'request': self.request})
+        if response is None:
+            raise exc
+        response.exception = True
+        return response
+
+    def finalize_response(self, request, response):
+        if isinstance(response, Response):
+            if not getattr(request, 'accepted_renderer', None):
+                request.accepted_renderer, request.accepted_media_type = self.perform_content_negotiation(request)
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = {'view': self, 'args': self.args, 'kwargs': self.kwargs, 'request': request}
+        # Same headers as the APIView serving the endpoint over WSGI
+        response['Allow'] = ', '.join(method.upper() for method in self.http_method_names if hasattr(self, method))
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class AsyncBookListView(AsyncAPIView):
+    pagination_class = BookCursorPagination
+
+    @condition(book_list_etag)
+    async def get(self, request):
+        fields, error = select_fields(request)
+        if error:
+            return error
+        filters, error = list_filters(request)
+        if error:
+            return error
+
+        page, version = await sync_to_async(get_list_page)(request, BookSerializer.has_stats(fields))
+        if page is None:
+            page, bookmarked_ids = await asyncio.gather(
+                self.page(request, fields, filters, version),
+                load_bookmarked_ids(request, fields),
+            )
+        else:
+            bookmarked_ids = await load_bookmarked_ids(request, fields)
+        return Response(with_bookmarks(page, bookmarked_ids), status=status.HTTP_200_OK)
+
+    async def page(self, request, fields, filters, version):
+        paginator = self.pagination_class()
+        books = BookSerializer.get_queryset(fields, paginator.ordering).filter(**filters)
+        page = list_page(paginator, await paginator.apaginate_queryset(books, request, view=self), request, fields)
+        await sync_to_async(set_list_page)(request, version, page)
+        return page
+
+
+class AsyncBookDetailView(AsyncAPIView):
+    @condition(book_detail_etag)
+    async def get(self, request, pk):
+        fields, error = select_fields(request, detailed=True)
+        if error:
+            return error
+        book, users_actions, bookmarked_ids = await asyncio.gather(
+            self.book(pk, fields),
+            self.users_actions(pk) if 'users_actions' in fields else asyncio.sleep(0),
+            load_bookmarked_ids(request, fields),
+        )
+        if book is None:
+            return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
+        context = {'request': request, 'detailed': True, 'fields': fields}
+        if bookmarked_ids is not None:
+            context['bookmarked_ids'] = bookmarked_ids
+        if users_actions is not None:
+            context['users_actions'] = users_actions
+        serializer = BookSerializer(book, context=context)
+        with timed('serializer'):
+            data = serializer.data
+        return Response(data, status=status.HTTP_200_OK)
+
+    async def book(self, pk, fields):
+        try:
+            return await BookSerializer.get_queryset(fields).aget(pk=pk)
+        except Book.DoesNotExist:
+            return None
+
+    async def users_actions(self, pk):
+        comments = BookSerializer.users_actions(Comment.objects.filter(book_id=pk))
+        return [comment async for comment in comments.aiterator()]
+
+
+class AsyncBookCommentsView(AsyncAPIView):
+    pagination_class = CommentCursorPagination
+
+    async def get(self, request, pk):
+        comments = Comment.objects.filter(book_id=pk)
+        rating = request.query_params.get('rating')
+        valid_rating = not rating or (rating.isdigit() and int(rating) in range(1, 6))
+        if rating and valid_rating:
+            comments = comments.filter(rating=int(rating))
+
+        # Errors are reported in the same order as BookCommentsView: missing book first
+        paginator = self.pagination_class()
+        exists, page = await asyncio.gather(
+            Book.objects.filter(pk=pk).aexists(),
+            self.page(paginator, comments, request) if valid_rating else asyncio.sleep(0),
+            return_exceptions=True,
+        )
+        if isinstance(exists, Exception):
+            raise exists
+        if not exists:
+            return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
+        if not valid_rating:
+            return Response({"error": "Rating must be a number between 1 and 5"}, status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(page, Exception):
+            raise page
+        return paginator.get_paginated_response(page)
+
+    async def page(self, paginator, comments, request):
+        return await paginator.apaginate_queryset(
+            comments.values('id', 'user__username', 'text', 'rating', 'submitted_on'), request, view=self
+        )
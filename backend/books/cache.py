@@ -0,0 +1,123 @@
+import hashlib
+
+from django.core.cache import cache
+
+from backend.versioned_cache import CacheStats, get_version, invalidate
+from .models import Bookmark
+
+# How long a user's bookmark set stays cached without being read or invalidated
+BOOKMARKS_TIMEOUT = 60 * 60
+# How long a rendered list page stays cached without being read or invalidated
+LIST_PAGE_TIMEOUT = 10 * 60
+
+
+bookmark_cache_stats = CacheStats('bookmarks')
+list_page_cache_stats = CacheStats('list_pages')
+
+
+def _bookmarks_version_key(user_id):
+    return f'books:bookmarks:{user_id}:version'
+
+
+def _bookmarks_key(user_id):
+    return f'books:bookmarks:{user_id}'
+
+
+CATALOG_VERSION_KEY = 'books:catalog:version'
+STATS_VERSION_KEY = 'books:stats:version'
+
+
+def bookmark_version(user_id):
+    """Current version of `user_id`'s bookmarks, bumped by every bookmark write."""
+    return get_version(_bookmarks_version_key(user_id))
+
+
+def get_bookmarked_ids(user_id):
+    """
+    Set of book ids `user_id` has bookmarked, served from the cache.
+
+    The set is stored together with the version it was loaded at and is only used
+    while that version is current, so a reader that loaded the set just before a
+    concurrent write can't keep a stale copy alive.
+    """
+    cached = cache.get_many([_bookmarks_version_key(user_id), _bookmarks_key(user_id)])
+    version = cached.get(_bookmarks_version_key(user_id))
+    entry = cached.get(_bookmarks_key(user_id))
+    if version is not None and entry is not None and entry[0] == version:
+        bookmark_cache_stats.hit()
+        return entry[1]
+
+    bookmark_cache_stats.miss()
+    if version is None:
+        version = bookmark_version(user_id)
+    ids = frozenset(Bookmark.objects.filter(user_id=user_id).values_list('book_id', flat=True))
+    cache.set(_bookmarks_key(user_id), (version, ids), BOOKMARKS_TIMEOUT)
+    return ids
+
+
+def invalidate_bookmarks(user_id):
+    """Call after changing `user_id`'s bookmarks."""
+    invalidate(_bookmarks_version_key(user_id))
+
+
+def catalog_version():
+    """Version of the user-independent part of the book list."""
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def invalidate_catalog():
+    """Call after a write that changes what the book list shows for everyone."""
+    invalidate(CATALOG_VERSION_KEY)
+
+
+def stats_version():
+    """Version of the rating stats shown in the book list when they are expanded."""
+    return get_version(STATS_VERSION_KEY)
+
+
+def invalidate_stats():
+    """Call after a write that changes the rating stats of books."""
+    invalidate(STATS_VERSION_KEY)
+
+
+def list_version_keys(stats):
+    # Pages with rating stats also change with every comment
+    return [CATALOG_VERSION_KEY, STATS_VERSION_KEY] if stats else [CATALOG_VERSION_KEY]
+
+
+def list_version(stats=False):
+    """Version of the user-independent part of a book list page."""
+    return tuple(get_version(key) for key in list_version_keys(stats))
+
+
+def _list_page_key(request):
+    # The next/previous links and cover URLs are absolute, so the host is part of the key
+    query = sorted(request.query_params.lists())
+    parts = repr((request.scheme, request.get_host(), request.path, query))
+    return f'books:list:{hashlib.md5(parts.encode()).hexdigest()}'
+
+
+def get_list_page(request, stats):
+    """
+    The cached user-independent data of the book list page `request` asks for,
+    shared by all users, or None. Also returns the list version to pass to
+    set_list_page() with a rebuilt page: it is read before the page is built, so
+    a page built during a concurrent write is never served after it.
+    """
+    key = _list_page_key(request)
+    version_keys = list_version_keys(stats)
+    cached = cache.get_many([*version_keys, key])
+    version = tuple(cached.get(version_key) for version_key in version_keys)
+    entry = cached.get(key)
+    if None not in version and entry is not None and entry[0] == version:
+        list_page_cache_stats.hit()
+        return entry[1], version
+
+    list_page_cache_stats.miss()
+    if None in version:
+        version = list_version(stats)
+    return None, version
+
+
+def set_list_page(request, version, page):
+    cache.set(_list_page_key(request), (version, page), LIST_PAGE_TIMEOUT)
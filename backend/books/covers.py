@@ -0,0 +1,46 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db.models import F
+
+from .cache import invalidate_catalog
+from .imaging import init_worker, render
+from .models import Book
+
+logger = logging.getLogger(__name__)
+
+
+def generate_covers(covers, workers=1, chunksize=4):
+    """
+    Generate the variants of `covers`, an iterable of (book id, cover name), and store
+    the dimensions and placeholder on the books. With more than one worker the images
+    are processed in a process pool. Returns the number of covers processed and failed.
+    """
+    covers = [(book_id, name) for book_id, name in covers if name]
+    if not covers:
+        return 0, 0
+    if workers > 1 and len(covers) > 1:
+        # Spawned rather than forked, so the workers don't inherit the open database
+        # connections; they only touch the storage
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=context, initializer=init_worker, initargs=(settings.MEDIA_ROOT,),
+        ) as executor:
+            results = list(executor.map(render, covers, chunksize=chunksize))
+    else:
+        results = map(render, covers)
+
+    processed = failed = 0
+    for book_id, name, fields, error in results:
+        if error:
+            failed += 1
+            logger.warning('Could not generate the variants of cover %s of book %s: %s', name, book_id, error)
+            fields = {'cover_width': None, 'cover_height': None, 'cover_placeholder': ''}
+        else:
+            processed += 1
+        # Skip books whose cover changed again in the meantime
+        Book.objects.filter(pk=book_id, cover_image=name).update(version=F('version') + 1, **fields)
+    invalidate_catalog()
+    return processed, failed
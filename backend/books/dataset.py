@@ -0,0 +1,171 @@
+import bisect
+import csv
+import io
+import itertools
+import random
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from .models import Book, BookStats, Bookmark, Comment
+from .utils import chunks
+
+# Share of ratings 1-5 in a typical J-shaped review distribution
+RATING_WEIGHTS = (0.07, 0.06, 0.14, 0.30, 0.43)
+# A comment may be a rating only or a text only
+RATING_ONLY = 0.45
+TEXT_ONLY = 0.08
+
+WORDS = (
+    'کتاب', 'شب', 'دریا', 'خانه', 'سفر', 'عشق', 'باران', 'کوه', 'آینه', 'راه', 'شهر', 'باغ', 'نامه',
+    'سایه', 'ستاره', 'دل', 'زمستان', 'تاریخ', 'روز', 'مرد', 'زن', 'پنجره', 'قصه', 'خاک', 'آتش',
+)
+COMMENTS = (
+    'خیلی خوب بود', 'پیشنهاد می‌کنم', 'ترجمه ضعیفی داشت', 'پایانش را دوست نداشتم', 'یکی از بهترین‌ها',
+    'A must read', 'Slow start, great ending', 'Not for me', 'Beautifully written',
+)
+
+
+def zipf_counts(total, size, exponent, cap=None):
+    """Split `total` over `size` ranks proportionally to 1 / rank ** exponent, at most `cap` each."""
+    weights = [1 / rank ** exponent for rank in range(1, size + 1)]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    # Hand the rounding remainder to the top ranks
+    for rank in range(total - sum(counts)):
+        counts[rank % size] += 1
+    if cap is not None:
+        counts = [min(count, cap) for count in counts]
+    return counts
+
+
+class ZipfSampler:
+    def __init__(self, items, exponent, rng):
+        self.items = items
+        self.rng = rng
+        self.cumulative = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, len(items) + 1)))
+
+    def __call__(self):
+        return self.items[bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+
+def insert_rows(model, fields, rows, batch_size):
+    """
+    Insert tuples of `fields` values into `model`'s table: with COPY on PostgreSQL,
+    otherwise with batched executemany() INSERTs. Returns the number of rows.
+    """
+    columns = [model._meta.get_field(field).column for field in fields]
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    column_list = ', '.join(qn(column) for column in columns)
+    inserted = 0
+    with connection.cursor() as cursor:
+        for batch in chunks(rows, batch_size):
+            if connection.vendor == 'postgresql':
+                buffer = io.StringIO()
+                # NULL is spelled \N so it stays distinct from an empty string
+                csv.writer(buffer).writerows([r'\N' if value is None else value for value in row] for row in batch)
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+            else:
+                model_fields = [model._meta.get_field(field) for field in fields]
+                placeholders = ', '.join(['%s'] * len(fields))
+                cursor.executemany(
+                    f'INSERT INTO {table} ({column_list}) VALUES ({placeholders})',
+                    [[field.get_db_prep_save(value, connection) for field, value in zip(model_fields, row)] for row in batch],
+                )
+            inserted += len(batch)
+    return inserted
+
+
+def _new_ids(model, after):
+    return list(model.objects.filter(pk__gt=after).order_by('pk').values_list('pk', flat=True))
+
+
+def _max_id(model):
+    return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def generate(books, users, comments, bookmarks, exponent=1.1, seed=0, password_hash='!', prefix='reader',
+             batch_size=10000, progress=None):
+    """
+    Add a synthetic catalog: `users` users, `books` books whose authors, comments and
+    bookmarks follow a Zipf distribution of popularity, rating stats for every book.
+    Returns the number of rows added per table.
+    """
+    rng = random.Random(seed)
+    progress = progress or (lambda message: None)
+    now = timezone.now()
+    counts = {}
+
+    before = _max_id(User)
+    counts['users'] = insert_rows(User, ['username', 'password', 'first_name', 'last_name', 'email', 'is_superuser',
+                                         'is_staff', 'is_active', 'date_joined'], (
+        (f'{prefix}{i:07}', password_hash, '', '', '', False, False, True, now - timedelta(days=rng.randrange(1000)))
+        for i in range(users)
+    ), batch_size)
+    user_ids = _new_ids(User, before)
+    progress(f"{counts['users']} users")
+
+    authors = [f'{rng.choice(WORDS)} {rng.choice(WORDS)}ی {i}' for i in range(max(1, books // 5))]
+    author = ZipfSampler(authors, exponent, rng)
+    before = _max_id(Book)
+    counts['books'] = insert_rows(Book, ['title', 'author', 'description', 'published_date', 'cover_image',
+                                         'cover_placeholder', 'version'], (
+        (
+            ' '.join(rng.choices(WORDS, k=rng.randint(1, 4))) + f' {i}', author(),
+            ' '.join(rng.choices(WORDS, k=rng.randint(10, 60))),
+            date(1950, 1, 1) + timedelta(days=rng.randrange(27000)), '', '', 0,
+        )
+        for i in range(books)
+    ), batch_size)
+    book_ids = _new_ids(Book, before)
+    progress(f"{counts['books']} books")
+
+    # Popularity is independent of the id and title order
+    ranked = book_ids[:]
+    rng.shuffle(ranked)
+    comment_counts = zipf_counts(comments, len(ranked), exponent, cap=len(user_ids))
+    bookmark_counts = zipf_counts(bookmarks, len(ranked), exponent, cap=len(user_ids))
+    bookmarkers = {}
+    stats = []
+
+    def comment_rows():
+        for book_id, comment_count, bookmark_count in zip(ranked, comment_counts, bookmark_counts):
+            # Bookmarkers are drawn together with the commenters: a user who commented
+            # on a book can't bookmark it
+            bookmark_count = min(bookmark_count, len(user_ids) - comment_count)
+            chosen = rng.sample(user_ids, comment_count + bookmark_count)
+            if bookmark_count:
+                bookmarkers[book_id] = chosen[comment_count:]
+            if not comment_count:
+                continue
+            ratings = [0] * 5
+            rating_sum = text_count = 0
+            for user_id in chosen[:comment_count]:
+                kind = rng.random()
+                rating = None if kind < TEXT_ONLY else rng.choices((1, 2, 3, 4, 5), RATING_WEIGHTS)[0]
+                text = None if TEXT_ONLY <= kind < TEXT_ONLY + RATING_ONLY else rng.choice(COMMENTS)
+                if rating:
+                    ratings[rating - 1] += 1
+                    rating_sum += rating
+                if text is not None:
+                    text_count += 1
+                yield user_id, book_id, text, rating, now - timedelta(seconds=rng.randrange(2 * 365 * 86400))
+            stats.append((book_id, *ratings, rating_sum, text_count))
+
+    counts['comments'] = insert_rows(Comment, ['user', 'book', 'text', 'rating', 'submitted_on'], comment_rows(), batch_size)
+    progress(f"{counts['comments']} comments")
+    counts['stats'] = insert_rows(
+        BookStats, ['book', *(f'rating_{i}' for i in BookStats.RATINGS), 'rating_sum', 'text_count'], stats, batch_size,
+    )
+
+    bookmark_rows = (
+        (user_id, book_id, now - timedelta(seconds=rng.randrange(2 * 365 * 86400)))
+        for book_id, users_of_book in bookmarkers.items() for user_id in users_of_book
+    )
+    counts['bookmarks'] = insert_rows(Bookmark, ['user', 'book', 'added_on'], bookmark_rows, batch_size)
+    progress(f"{counts['bookmarks']} bookmarks")
+    return counts
@@ -0,0 +1,73 @@
+import hashlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .cache import bookmark_version, list_version
+from .models import Book
+from .serializers import BookSerializer
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest())
+
+
+def _request_parts(request):
+    # The same URL renders differently per user and per negotiated format
+    return (request.user.id, bookmark_version(request.user.id), request.get_full_path(), request.META.get('HTTP_ACCEPT', ''))
+
+
+def book_list_etag(request, **kwargs):
+    try:
+        fields = BookSerializer.select_fields(request.query_params)
+    except ValueError:
+        return None
+    return make_etag('list', *list_version(BookSerializer.has_stats(fields)), *_request_parts(request))
+
+
+def book_detail_etag(request, pk, **kwargs):
+    version = Book.objects.filter(pk=pk).values_list('version', flat=True).first()
+    if version is None:
+        return None
+    return make_etag('detail', pk, version, *_request_parts(request))
+
+
+def condition(etag_func):
+    """
+    Answer GETs whose If-None-Match holds the current ETag with 304 Not Modified,
+    before the view runs any serializer or aggregate query. Works on sync and async
+    view methods.
+    """
+    def not_modified(request, etag):
+        if etag is not None:
+            if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+            return etag in if_none_match or '*' in if_none_match
+        return False
+
+    def tag(response, etag):
+        if etag is not None and response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def decorator(method):
+        if iscoroutinefunction(method):
+            @wraps(method)
+            async def async_wrapper(self, request, *args, **kwargs):
+                etag = await sync_to_async(etag_func)(request, **kwargs)
+                if not_modified(request, etag):
+                    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+                return tag(await method(self, request, *args, **kwargs), etag)
+            return async_wrapper
+
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            etag = etag_func(request, **kwargs)
+            if not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            return tag(method(self, request, *args, **kwargs), etag)
+        return wrapper
+    return decorator
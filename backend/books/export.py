@@ -0,0 +1,66 @@
+from asgiref.sync import sync_to_async
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count
+
+from .models import Book, BookStats, Bookmark
+from .utils import chunks
+
+EXPORT_FIELDS = ('id', 'title', 'author', 'description', 'published_date', 'cover_image')
+STATS_FIELDS = tuple(f'rating_{i}' for i in BookStats.RATINGS) + ('rating_sum', 'text_count')
+
+
+def iter_catalog(chunk_size=1000):
+    """
+    Yield every book with its bookmark count and rating stats, in id order.
+
+    Books are read through a server-side cursor and the aggregates are fetched with
+    one query each per chunk, so memory stays bounded by `chunk_size` however large
+    the catalog is.
+    """
+    books = Book.objects.order_by('id').values(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    for chunk in chunks(books, chunk_size):
+        ids = [book['id'] for book in chunk]
+        bookmarks = dict(
+            Bookmark.objects.filter(book_id__in=ids).order_by().values('book_id')
+            .annotate(total=Count('id')).values_list('book_id', 'total')
+        )
+        stats = {
+            row['book_id']: BookStats(**row)
+            for row in BookStats.objects.filter(book_id__in=ids).values('book_id', *STATS_FIELDS)
+        }
+        for book in chunk:
+            book_stats = stats.get(book['id']) or BookStats(book_id=book['id'])
+            if book['cover_image']:
+                book['cover_image'] = default_storage.url(book['cover_image'])
+            book.update(
+                total_bookmarks=bookmarks.get(book['id'], 0),
+                total_comments=book_stats.text_count,
+                total_rating=book_stats.total_rating,
+                rating_avg=book_stats.rating_avg,
+                rating_dict=book_stats.rating_dict,
+            )
+            yield book
+
+
+def iter_ndjson(chunk_size=1000):
+    """Encode iter_catalog() as NDJSON, one bytes block per chunk of books."""
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    for chunk in chunks(iter_catalog(chunk_size), chunk_size):
+        yield ''.join(encoder.encode(record) + '\n' for record in chunk).encode()
+
+
+async def aiter_ndjson(chunk_size=1000):
+    """
+    iter_ndjson() as an async iterator, for ASGI servers that would otherwise read a
+    sync iterator to the end before sending anything. Every block is read in the
+    request's thread for sync code, which keeps the database cursor.
+    """
+    blocks = iter_ndjson(chunk_size)
+    read = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (block := await read(blocks, None)) is not None:
+            yield block
+    finally:
+        # Closes the server-side cursor when the client goes away early
+        await sync_to_async(blocks.close, thread_sensitive=True)()
@@ -0,0 +1,97 @@
+"""
+Cover image processing. Imports no models, so process pool workers can load it
+before Django is set up.
+"""
+import base64
+import posixpath
+from io import BytesIO
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .storage import cover_storage, is_hashed_name
+
+# Widths of the generated variants, each in every format of VARIANT_FORMATS
+COVER_WIDTHS = (160, 320, 640)
+VARIANT_FORMATS = (
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+)
+PLACEHOLDER_WIDTH = 16
+
+
+def variant_widths(width):
+    """Widths of the variants of a cover `width` pixels wide, covers are never upscaled."""
+    return sorted({min(size, width) for size in COVER_WIDTHS})
+
+
+def variant_name(name, width, extension):
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'variants', f'{stem}-{width}.{extension}')
+
+
+def _replace(name, content):
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(content))
+
+
+def _encode(image, image_format, options):
+    buffer = BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def render_variants(name):
+    """
+    Write the sized JPEG and WebP variants of the cover stored as `name` and return
+    its dimensions and a tiny WebP placeholder as a data URI.
+    """
+    with cover_storage.open(name, 'rb') as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image = image.convert('RGB')
+    width, height = image.size
+    # Variants of a content-addressed cover are served as immutable, never rewrite them
+    immutable = is_hashed_name(name)
+
+    for variant_width in variant_widths(width):
+        targets = [
+            (variant_name(name, variant_width, extension), image_format, options)
+            for extension, image_format, options in VARIANT_FORMATS
+        ]
+        if immutable:
+            targets = [target for target in targets if not default_storage.exists(target[0])]
+        if not targets:
+            continue
+        variant_height = max(1, round(height * variant_width / width))
+        variant = image if variant_width == width else image.resize((variant_width, variant_height), Image.LANCZOS)
+        for target, image_format, options in targets:
+            _replace(target, _encode(variant, image_format, options))
+
+    placeholder = image.copy()
+    placeholder.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH * 4))
+    data = base64.b64encode(_encode(placeholder, 'WEBP', {'quality': 30})).decode()
+    return {
+        'cover_width': width,
+        'cover_height': height,
+        'cover_placeholder': f'data:image/webp;base64,{data}',
+    }
+
+
+def init_worker(media_root):
+    django.setup()
+    # Use the parent's media root, which may be overridden (tests, custom settings)
+    settings.MEDIA_ROOT = media_root
+
+
+def render(item):
+    # Runs in the pool workers; failures are returned so one bad cover doesn't stop the batch
+    book_id, name = item
+    try:
+        return book_id, name, render_variants(name), None
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as error:
+        return book_id, name, None, repr(error)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+
+from django.core.files.storage import default_storage
+from django.core.management.color import no_style
+from django.db import connection
+
+from .models import Book
+from .utils import chunks
+
+LOAD_FIELDS = ('title', 'author', 'description', 'published_date', 'cover_image')
+READ_SIZE = 64 * 1024
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while block := file.read(READ_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def iter_json_array(file):
+    """Yield the items of a top-level JSON array without reading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = file.read(READ_SIZE).lstrip('\ufeff').lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array')
+    position = 1
+    eof = False
+    while True:
+        # Skip the separator before the next item, reading more input as needed
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer, position = file.read(READ_SIZE), 0
+            eof = not buffer
+        if position >= len(buffer):
+            raise ValueError('Unterminated JSON array')
+        if buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The item continues in the next block
+            block = file.read(READ_SIZE)
+            eof = not block
+            buffer, position = buffer[position:] + block, 0
+            continue
+        yield item
+        position = end
+
+
+def iter_ndjson_records(file):
+    for number, line in enumerate(file, 1):
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(f'Line {number}: {error}')
+
+
+def iter_records(file, format='auto'):
+    """
+    Yield the records of a catalog file, either a JSON array (a books.book fixture
+    like fixtures/books.json or the scraper's books.json) or NDJSON (export_catalog).
+    """
+    if format == 'auto':
+        start = file.read(READ_SIZE).lstrip('\ufeff').lstrip()[:1]
+        file.seek(0)
+        format = 'json' if start == '[' else 'ndjson'
+    if format == 'json':
+        return iter_json_array(file)
+    return iter_ndjson_records(file)
+
+
+def _storage_name(cover_image):
+    # export_catalog writes cover URLs, the database stores storage names
+    if cover_image and cover_image.startswith(default_storage.base_url):
+        return cover_image[len(default_storage.base_url):]
+    return cover_image
+
+
+def book_values(record):
+    """Map a fixture entry or an exported book to (pk, {field: value})."""
+    if 'fields' in record:
+        if record.get('model', 'books.book').lower() != 'books.book':
+            raise ValueError(f"Not a book: {record['model']}")
+        pk, fields = record['pk'], record['fields']
+    else:
+        pk, fields = record['id'], record
+    values = {}
+    for name in LOAD_FIELDS:
+        field = Book._meta.get_field(name)
+        value = fields[name] if not field.null and not field.blank else fields.get(name)
+        values[name] = field.to_python(value)
+    values['cover_image'] = _storage_name(values['cover_image'])
+    return int(pk), values
+
+
+def load_books(records, batch_size=1000):
+    """
+    Upsert `records` into Book in batches of `batch_size`, skipping books whose
+    fields haven't changed. Returns the number of created, updated and unchanged books
+    and the (id, cover) of the books whose cover changed.
+    """
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+    covers = []
+    for batch in chunks(records, batch_size):
+        books = dict(book_values(record) for record in batch)
+        existing = {
+            row.pop('id'): row
+            for row in Book.objects.filter(id__in=books).values('id', *LOAD_FIELDS)
+        }
+        changed = [
+            Book(id=pk, **values) for pk, values in books.items()
+            if existing.get(pk) != values
+        ]
+        updated = [book.id for book in changed if book.id in existing]
+        covers += [
+            (book.id, book.cover_image.name) for book in changed
+            if book.cover_image and book.cover_image.name != existing.get(book.id, {}).get('cover_image')
+        ]
+        counts['unchanged'] += len(books) - len(changed)
+        counts['created'] += len(changed) - len(updated)
+        counts['updated'] += len(updated)
+        if changed:
+            Book.objects.bulk_create(
+                changed, update_conflicts=True, unique_fields=['id'], update_fields=LOAD_FIELDS,
+            )
+        if updated:
+            Book.objects.filter(id__in=updated).bump_version()
+    return counts, covers
+
+
+def reset_book_sequence():
+    # Books were inserted with explicit ids, move the sequence past them like loaddata does
+    statements = connection.ops.sequence_reset_sql(no_style(), [Book])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import StringIO
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.migrations.recorder import MigrationRecorder
+
+from books.models import RankingParameters, RelatedBooksBuild
+from books.similar import CURRENT
+
+
+def _hash_files(files):
+    """Hash the names and contents of `files`, an iterable of (name, path)."""
+    digest = hashlib.sha256()
+    for name, path in sorted(files):
+        digest.update(name.encode())
+        with open(path, 'rb') as file:
+            while block := file.read(64 * 1024):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def migration_files():
+    for app_config in apps.get_app_configs():
+        directory = os.path.join(app_config.path, 'migrations')
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith('.py'):
+                    yield f'{app_config.label}/{name}', os.path.join(directory, name)
+
+
+def static_sources():
+    ignore_patterns = ['CVS', '.*', '*~']
+    for finder in get_finders():
+        for path, storage in finder.list(ignore_patterns):
+            prefix = getattr(storage, 'prefix', None)
+            yield os.path.join(prefix, path) if prefix else path, storage.path(path)
+
+
+def database_id():
+    # When the first migration was applied identifies the database, so a new or
+    # recreated database doesn't match the fingerprints recorded against the old one
+    recorder = MigrationRecorder(connection)
+    if not recorder.has_table():
+        return None
+    applied = recorder.migration_qs.order_by('id').values_list('applied', flat=True).first()
+    return applied.isoformat() if applied else None
+
+
+class Step:
+    def __init__(self, name, inputs, run, after=()):
+        self.name = name
+        self.inputs = inputs
+        self.run = run
+        self.after = set(after)
+
+    def fingerprint(self):
+        return hashlib.sha256(json.dumps(self.inputs(), sort_keys=True).encode()).hexdigest()
+
+
+class Command(BaseCommand):
+    help = (
+        "Bring the container up to date before serving: migrate, collect static files, load "
+        "fixtures, index the new books and rebuild the rankings and related books, each only when its inputs changed since the last boot. Independent steps run in parallel."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--state', default=os.path.join(settings.BASE_DIR, '.boot-state.json'),
+                            help="File the fingerprints of the last boot are kept in")
+        parser.add_argument('--users-fixture', default='fixtures/users.json')
+        parser.add_argument('--catalog', default='fixtures/books.json')
+        parser.add_argument('--jobs', type=int, default=4, help="Steps run at the same time")
+        parser.add_argument('--force', action='store_true', help="Run every step")
+
+    def get_steps(self, options):
+        users_fixture, catalog = options['users_fixture'], options['catalog']
+        static_root = str(settings.STATIC_ROOT)
+        return [
+            Step(
+                'migrate',
+                lambda: [_hash_files(migration_files()), database_id()],
+                lambda out: call_command('migrate', interactive=False, stdout=out),
+            ),
+            Step(
+                'collectstatic',
+                lambda: [
+                    _hash_files(static_sources()),
+                    # Collect again if the collected files were removed
+                    os.path.isdir(static_root) and len(os.listdir(static_root)),
+                ],
+                lambda out: call_command('collectstatic', interactive=False, stdout=out),
+            ),
+            Step(
+                'load users',
+                lambda: [_hash_files([(users_fixture, users_fixture)]), database_id()],
+                lambda out: call_command('loaddata', users_fixture, stdout=out),
+                after=['migrate'],
+            ),
+            Step(
+                'load catalog',
+                lambda: [_hash_files([(catalog, catalog)]), database_id()],
+                lambda out: call_command('load_catalog', catalog, stdout=out),
+                after=['migrate'],
+            ),
+            Step(
+                'cover variants',
+                lambda: [_hash_files([(catalog, catalog)]), database_id()],
+                lambda out: call_command('generate_cover_variants', stdout=out),
+                after=['load catalog'],
+            ),
+            Step(
+                'similar books',
+                lambda: [
+                    _hash_files([(catalog, catalog)]), database_id(),
+                    # Build again if the index was removed
+                    os.path.exists(os.path.join(settings.SIMILAR_BOOKS_INDEX, CURRENT)),
+                ],
+                # Only the books the catalog added are indexed
+                lambda out: call_command('build_similar_books', '--incremental', stdout=out),
+                after=['load catalog'],
+            ),
+            Step(
+                'rankings',
+                lambda: [
+                    _hash_files([(catalog, catalog)]), database_id(),
+                    # Backfill the rankings of a database that was never rebuilt
+                    RankingParameters.objects.filter(rebuilt_on__isnull=False).exists(),
+                ],
+                lambda out: call_command('rebuild_rankings', stdout=out),
+                after=['load catalog'],
+            ),
+            Step(
+                'related books',
+                lambda: [
+                    _hash_files([(catalog, catalog)]), database_id(),
+                    # Backfill the related books of a database they were never computed for
+                    RelatedBooksBuild.objects.exists(),
+                ],
+                # Only the books touched since the last build are recomputed
+                lambda out: call_command('build_related_books', '--incremental', stdout=out),
+                after=['load catalog'],
+            ),
+        ]
+
+    def handle(self, *args, **options):
+        state = {}
+        if os.path.exists(options['state']) and not options['force']:
+            with open(options['state']) as file:
+                state = json.load(file)
+
+        started = time.perf_counter()
+        pending = {step.name: step for step in self.get_steps(options)}
+        running = {}
+        done = set()
+        failed = set()
+        with ThreadPoolExecutor(max_workers=max(1, options['jobs'])) as executor:
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if step.after & failed:
+                        del pending[name]
+                        failed.add(name)
+                        self.stdout.write(f'{name:15} not run, {", ".join(sorted(step.after & failed))} failed')
+                    elif step.after <= done:
+                        del pending[name]
+                        running[executor.submit(self.run_step, step, state.get(name))] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        ran, fingerprint, elapsed, output = future.result()
+                    except Exception as error:
+                        failed.add(step.name)
+                        self.stderr.write(f'{step.name:15} failed: {error!r}')
+                        continue
+                    done.add(step.name)
+                    state[step.name] = fingerprint
+                    self.stdout.write(output, ending='')
+                    status = 'ran' if ran else 'unchanged, skipped'
+                    self.stdout.write(f'{step.name:15} {status} in {elapsed:.2f}s')
+
+        with open(options['state'], 'w') as file:
+            json.dump(state, file, indent=4, sort_keys=True)
+        self.stdout.write(f'Boot finished in {time.perf_counter() - started:.2f}s')
+        if failed:
+            raise CommandError(f'Boot steps failed: {", ".join(sorted(failed))}')
+
+    def run_step(self, step, previous):
+        started = time.perf_counter()
+        out = StringIO()
+        try:
+            ran = step.fingerprint() != previous
+            if ran:
+                step.run(out)
+            # Fingerprinted again after running: migrating a new database changes its id
+            fingerprint = step.fingerprint()
+        finally:
+            # Steps run in worker threads, each with its own connection
+            connections.close_all()
+        return ran, fingerprint, time.perf_counter() - started, out.getvalue()
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books.models import RelatedBooksBuild
+from books.related import MEASURES, build
+
+
+class Command(BaseCommand):
+    help = (
+        "Store the related books of every book for /books/<pk>/related/, from the books the same "
+        "users bookmarked or rated highly. --incremental only recomputes the books touched since the last run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', help="Only recompute the books whose neighbours may have changed")
+        parser.add_argument('--measure', choices=MEASURES, help="Normalization of the co-occurrence counts (default: the last run's, or cosine)")
+        parser.add_argument('--top-k', type=int, help="Related books stored per book (default: the last run's, or 20)")
+        parser.add_argument('--block-size', type=int, default=1000, help="Books whose co-occurrence rows are computed at once")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        last = RelatedBooksBuild.objects.order_by('-id').first()
+        measure = options['measure'] or (last.measure if last else 'cosine')
+        top_k = options['top_k'] or (last.top_k if last else 20)
+        started = time.perf_counter()
+
+        def progress(message):
+            self.stdout.write(f'{time.perf_counter() - started:7.1f}s  {message}')
+
+        try:
+            result = build(
+                top_k=top_k, measure=measure, incremental=options['incremental'],
+                block_size=options['block_size'], batch_size=options['batch_size'], progress=progress,
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(
+            f"Related books ({measure}, top {top_k}) of {result.books} book(s) computed in {time.perf_counter() - started:.1f}s"
+        ))
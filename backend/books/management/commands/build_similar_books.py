@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books.similar import build
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the index of content-similar books for /books/<pk>/similar/: TF-IDF over the titles, "
+        "authors and descriptions, with the top K neighbours of every book. --incremental only adds the new books."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', help="Only add the books that aren't in the index yet")
+        parser.add_argument('--top-k', type=int, default=20, help="Similar books kept per book")
+        parser.add_argument('--block-size', type=int, default=1000, help="Books compared with all the others at once")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        def progress(message):
+            self.stdout.write(f'{time.perf_counter() - started:7.1f}s  {message}')
+
+        try:
+            books = build(
+                k=options['top_k'], incremental=options['incremental'],
+                block_size=options['block_size'], batch_size=options['batch_size'], progress=progress,
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(
+            f"Similar books of {books} book(s) indexed in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,25 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from books.export import iter_ndjson
+
+
+class Command(BaseCommand):
+    help = "Stream the whole catalog with bookmark counts and rating stats as NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--output', help="File to write to (default: stdout)")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                self.write(output, options['chunk_size'])
+        else:
+            self.write(sys.stdout.buffer, options['chunk_size'])
+            sys.stdout.buffer.flush()
+
+    def write(self, output, chunk_size):
+        for block in iter_ndjson(chunk_size):
+            output.write(block)
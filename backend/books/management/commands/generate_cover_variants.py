@@ -0,0 +1,38 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from books.covers import generate_covers
+from books.models import Book
+
+
+class Command(BaseCommand):
+    help = "Generate the sized JPEG/WebP variants, dimensions and placeholders of book covers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('book_ids', nargs='*', type=int, help="Only these books")
+        parser.add_argument('--all', action='store_true', help="Also regenerate covers that already have variants")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Size of the process pool")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        books = Book.objects.exclude(cover_image='').exclude(cover_image__isnull=True).order_by('id')
+        if options['book_ids']:
+            books = books.filter(id__in=options['book_ids'])
+        if not options['all']:
+            books = books.filter(cover_width__isnull=True)
+
+        processed = failed = 0
+        last_id = 0
+        while True:
+            # Seek by id so regenerated books don't shift the batches
+            batch = list(books.filter(id__gt=last_id).values_list('id', 'cover_image')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            done, errors = generate_covers(batch, workers=options['workers'])
+            processed += done
+            failed += errors
+            self.stdout.write(f'{processed + failed} covers processed')
+
+        self.stdout.write(self.style.SUCCESS(f'Cover variants generated for {processed} book(s), {failed} failed'))
@@ -0,0 +1,60 @@
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from books.cache import invalidate_catalog, invalidate_stats
+from books.dataset import generate
+from books.rankings import rebuild as rebuild_rankings
+
+
+class Command(BaseCommand):
+    help = (
+        "Add a large synthetic catalog for load tests and benchmarks: users, books, and comments "
+        "and bookmarks whose popularity follows a Zipf distribution, with realistic ratings. "
+        "Uses COPY on PostgreSQL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=100_000)
+        parser.add_argument('--users', type=int, default=100_000)
+        parser.add_argument('--comments', type=int, default=10_000_000)
+        parser.add_argument('--bookmarks', type=int, default=1_000_000)
+        parser.add_argument('--zipf', type=float, default=1.1, help="Exponent of the popularity distribution")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='reader', help="Usernames are the prefix and a number")
+        parser.add_argument('--password', default='dataset', help="Password of every generated user")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f"Users named {options['prefix']}... already exist, pick another --prefix")
+
+        started = time.perf_counter()
+
+        def progress(message):
+            self.stdout.write(f'{time.perf_counter() - started:7.1f}s  {message}')
+
+        with transaction.atomic():
+            counts = generate(
+                options['books'], options['users'], options['comments'], options['bookmarks'],
+                exponent=options['zipf'], seed=options['seed'], prefix=options['prefix'],
+                password_hash=make_password(options['password']), batch_size=options['batch_size'],
+                progress=progress,
+            )
+            invalidate_catalog()
+            invalidate_stats()
+            # The rows were copied in without going through the writes that score them
+            rebuild_rankings(batch_size=options['batch_size'])
+            progress('rankings')
+        if connection.vendor == 'postgresql':
+            # Plan the benchmark queries with statistics of the new data
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {counts['users']} users, {counts['books']} books, {counts['comments']} comments and "
+            f"{counts['bookmarks']} bookmarks in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,54 @@
+import os
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from books.cache import invalidate_catalog
+from books.covers import generate_covers
+from books.loader import file_checksum, iter_records, load_books, reset_book_sequence
+from books.models import CatalogLoad
+
+
+class Command(BaseCommand):
+    help = (
+        "Upsert books from a JSON fixture (fixtures/books.json, the scraper's books.json) "
+        "or an NDJSON export in batches. Does nothing if the file hasn't changed since it was last loaded."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='fixtures/books.json')
+        parser.add_argument('--format', choices=['auto', 'json', 'ndjson'], default='auto')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--force', action='store_true', help="Load even if the file is unchanged")
+        parser.add_argument('--skip-covers', action='store_true', help="Don't generate variants of new or changed covers")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Processes generating cover variants")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f'No such file: {path}')
+        source = os.path.realpath(path)
+        checksum = file_checksum(path)
+        if not options['force'] and CatalogLoad.objects.filter(source=source, checksum=checksum).exists():
+            self.stdout.write(f'{path} is unchanged since it was last loaded, skipping')
+            return
+
+        try:
+            with transaction.atomic(), open(path, encoding='utf-8') as file:
+                counts, covers = load_books(iter_records(file, options['format']), options['batch_size'])
+                reset_book_sequence()
+                CatalogLoad.objects.update_or_create(
+                    source=source, defaults={'checksum': checksum, 'books': sum(counts.values())},
+                )
+                if counts['created'] or counts['updated']:
+                    invalidate_catalog()
+        except (ValueError, KeyError, TypeError, ValidationError) as error:
+            raise CommandError(f'Invalid catalog {path}: {error!r}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Loaded {path}: {counts['created']} created, {counts['updated']} updated, {counts['unchanged']} unchanged"
+        ))
+        if covers and not options['skip_covers']:
+            processed, failed = generate_covers(covers, workers=options['workers'])
+            self.stdout.write(f'Cover variants generated for {processed} book(s), {failed} failed')
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from books.models import BookRanking
+from books.rankings import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the scores of /books/top/ and /books/trending/ from all the ratings, bookmarks and "
+        "comments. Writes keep them up to date in between; run it periodically (see run_periodic) to "
+        "refresh the Bayesian prior and move the trending epoch forward."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        parameters = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Rankings of {BookRanking.objects.count()} book(s) rebuilt in {time.perf_counter() - started:.1f}s "
+            f"(prior: mean rating {parameters.mean_rating:.2f} weighted as {parameters.prior_weight:.1f} ratings)"
+        ))
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from books.cache import invalidate_stats
+from books.models import Book, BookStats
+
+
+class Command(BaseCommand):
+    help = "Rebuild BookStats from Comment and report books whose stats drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('book_ids', nargs='*', type=int, help="Only check these books")
+        parser.add_argument('--check', action='store_true', help="Report drift without fixing it and exit non-zero if any")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        book_ids = options['book_ids'] or None
+        fields = [f'rating_{i}' for i in BookStats.RATINGS] + ['rating_sum', 'text_count']
+        empty = dict.fromkeys(fields, 0)
+
+        books = Book.objects.order_by('id').values_list('id', flat=True)
+        if book_ids:
+            books = books.filter(id__in=book_ids)
+
+        drifted = []
+        batch = []
+        for book_id in books.iterator(chunk_size=options['batch_size']):
+            batch.append(book_id)
+            if len(batch) >= options['batch_size']:
+                drifted += self.process(batch, fields, empty, options['check'])
+                batch = []
+        if batch:
+            drifted += self.process(batch, fields, empty, options['check'])
+
+        for book_id, stored, expected in drifted:
+            diff = ', '.join(f'{field}: {stored[field]} -> {expected[field]}' for field in fields if stored[field] != expected[field])
+            self.stdout.write(f'Book {book_id} drifted ({diff})')
+
+        if options['check'] and drifted:
+            raise CommandError(f'{len(drifted)} book(s) have drifted stats')
+        verb = 'found' if options['check'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'Stats checked, {len(drifted)} drifted book(s) {verb}'))
+
+    def process(self, book_ids, fields, empty, check):
+        expected = BookStats.compute(book_ids)
+        stored = {
+            row.pop('book_id'): row
+            for row in BookStats.objects.filter(book_id__in=book_ids).values('book_id', *fields)
+        }
+        drifted = []
+        for book_id in book_ids:
+            want = expected.get(book_id, empty)
+            have = stored.get(book_id)
+            if have == want or (have is None and want == empty):
+                continue
+            drifted.append((book_id, have or empty, want))
+
+        if drifted and not check:
+            ids = [book_id for book_id, _, _ in drifted]
+            with transaction.atomic():
+                # Lock the rows and aggregate again so concurrent comment writes aren't lost
+                list(BookStats.objects.select_for_update().filter(book_id__in=ids).values_list('book_id'))
+                expected = BookStats.compute(ids)
+                for book_id in ids:
+                    BookStats.objects.update_or_create(book_id=book_id, defaults=expected.get(book_id, empty))
+                invalidate_stats()
+        return drifted
@@ -0,0 +1,115 @@
+import json
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from books.cache import invalidate_catalog
+from books.imaging import VARIANT_FORMATS, variant_name, variant_widths
+from books.models import Book
+from books.storage import content_hash, cover_storage, hashed_name, is_hashed_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Move covers stored under their original names (covers/1.jpg) to content-addressed "
+        "names, merging identical files, and point the books at the new names."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--fixture', action='append', default=[],
+                            help="Also rewrite the covers of the books in this JSON fixture (repeatable)")
+
+    def handle(self, *args, **options):
+        books = Book.objects.exclude(cover_image='').exclude(cover_image__isnull=True).order_by('id')
+        renamed = {}
+        widths = {}
+        missing = set()
+        rewritten = 0
+        last_id = 0
+        while True:
+            batch = list(
+                books.filter(id__gt=last_id).values_list('id', 'cover_image', 'cover_width')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            for book_id, name, width in batch:
+                if is_hashed_name(name) or name in missing:
+                    continue
+                if name not in renamed:
+                    if not cover_storage.exists(name):
+                        missing.add(name)
+                        self.stderr.write(f'Cover {name} of book {book_id} does not exist')
+                        continue
+                    renamed[name] = self.rehash(name, width, options['dry_run'])
+                    widths[name] = width
+                if not options['dry_run']:
+                    Book.objects.filter(pk=book_id, cover_image=name).update(
+                        cover_image=renamed[name], version=F('version') + 1,
+                    )
+                rewritten += 1
+
+        for path in options['fixture']:
+            self.rewrite_fixture(path, renamed, widths, options['dry_run'])
+
+        if not options['dry_run']:
+            for name in renamed:
+                # Another book may still point at the old file if it changed meanwhile
+                if not Book.objects.filter(cover_image=name).exists():
+                    for old in [name] + self.variants(name, widths[name]):
+                        default_storage.delete(old)
+            if rewritten:
+                invalidate_catalog()
+
+        verb = 'would be' if options['dry_run'] else 'were'
+        self.stdout.write(self.style.SUCCESS(
+            f'{rewritten} book(s) {verb} rewritten, {len(renamed)} file(s) {verb} stored as '
+            f'{len(set(renamed.values()))} content-addressed file(s), {len(missing)} missing'
+        ))
+
+    def variants(self, name, width):
+        if not width:
+            return []
+        return [
+            variant_name(name, variant_width, extension)
+            for variant_width in variant_widths(width) for extension, _, _ in VARIANT_FORMATS
+        ]
+
+    def rehash(self, name, width, dry_run):
+        with cover_storage.open(name, 'rb') as file:
+            if dry_run:
+                return hashed_name(name, content_hash(file))
+            new = cover_storage.save(name, file)
+        # The variants are the same images, move them along instead of regenerating them
+        for old, target in zip(self.variants(name, width), self.variants(new, width)):
+            if default_storage.exists(old) and not default_storage.exists(target):
+                with default_storage.open(old, 'rb') as file:
+                    default_storage.save(target, file)
+        return new
+
+    def rewrite_fixture(self, path, renamed, widths, dry_run):
+        with open(path, encoding='utf-8') as file:
+            records = json.load(file)
+        changed = 0
+        for record in records:
+            if record.get('model', '').lower() != 'books.book':
+                continue
+            name = record['fields'].get('cover_image')
+            if not name or is_hashed_name(name):
+                continue
+            if name not in renamed:
+                if not cover_storage.exists(name):
+                    continue
+                renamed[name] = self.rehash(name, None, dry_run)
+                widths[name] = None
+            record['fields']['cover_image'] = renamed[name]
+            changed += 1
+        if changed and not dry_run:
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+                json.dump(records, file, indent=4, ensure_ascii=False)
+            os.replace(f'{path}.tmp', path)
+        self.stdout.write(f'{path}: {changed} cover reference(s) rewritten')
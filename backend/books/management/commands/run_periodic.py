@@ -0,0 +1,43 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep running the maintenance commands, each every so many seconds: index the books added "
+        "since the last run for /books/<pk>/similar/, recompute the related books touched since the last "
+        "run for /books/<pk>/related/ and rebuild the rankings. Boot runs them first, so "
+        "each waits a full interval before its first run; a failed run is reported and retried at the next one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--similar-every', type=int, default=3600, metavar='SECONDS')
+        parser.add_argument('--related-every', type=int, default=3600, metavar='SECONDS')
+        parser.add_argument('--rankings-every', type=int, default=24 * 3600, metavar='SECONDS')
+
+    def get_jobs(self, options):
+        """(command, arguments, seconds between runs) of every job."""
+        return [
+            ('build_similar_books', ['--incremental'], options['similar_every']),
+            ('build_related_books', ['--incremental'], options['related_every']),
+            ('rebuild_rankings', [], options['rankings_every']),
+        ]
+
+    def handle(self, *args, **options):
+        jobs = self.get_jobs(options)
+        due = [time.monotonic() + every for _, _, every in jobs]
+        while True:
+            time.sleep(max(0, min(due) - time.monotonic()))
+            for i, (name, arguments, every) in enumerate(jobs):
+                if due[i] > time.monotonic():
+                    continue
+                # The connection may have been dropped by the server while sleeping
+                close_old_connections()
+                try:
+                    call_command(name, *arguments, stdout=self.stdout, stderr=self.stderr)
+                except Exception as error:
+                    self.stderr.write(f'{name} failed: {error!r}')
+                due[i] = time.monotonic() + every
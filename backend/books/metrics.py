@@ -0,0 +1,149 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# With PROMETHEUS_MULTIPROC_DIR set (see entrypoint.sh) every worker writes its samples
+# to files in that directory and /metrics adds them up
+LABELS = ['endpoint', 'method']
+REQUESTS = Counter('books_requests_total', 'Requests handled', LABELS + ['status'])
+REQUEST_SECONDS = Histogram('books_request_duration_seconds', 'Time to handle a request', LABELS)
+VIEW_SECONDS = Histogram('books_view_duration_seconds', 'Time spent in the view', LABELS)
+SERIALIZER_SECONDS = Histogram('books_serializer_duration_seconds', 'Time spent serializing', LABELS)
+DB_SECONDS = Histogram('books_db_duration_seconds', 'Time spent waiting for the database', LABELS)
+QUERIES = Histogram(
+    'books_db_queries', 'Queries per request', LABELS, buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, float('inf')),
+)
+
+_current = contextvars.ContextVar('books_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Timings of one request; also a database execute wrapper counting its queries."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.timings = {}
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.db_seconds += duration
+            # Only a reference to the SQL string, it is formatted when the request is slow
+            self.statements.append((duration, sql))
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def server_timing(self, total, view):
+        parts = [f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"']
+        parts += [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.timings.items()]
+        if view is not None:
+            parts.append(f'view;dur={view * 1000:.1f}')
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+    def worst_statements(self, limit):
+        """The `limit` statements that took longest in total, with how often each ran."""
+        grouped = {}
+        for duration, sql in self.statements:
+            count, total = grouped.get(sql, (0, 0.0))
+            grouped[sql] = (count + 1, total + duration)
+        return sorted(((total, count, sql) for sql, (count, total) in grouped.items()), reverse=True)[:limit]
+
+    def observe(self, endpoint, method, status, total, view):
+        requests, request_seconds, view_seconds, serializer_seconds, db_seconds, queries = _children(endpoint, method)
+        requests[status].inc()
+        request_seconds.observe(total)
+        if view is not None:
+            view_seconds.observe(view)
+        if 'serializer' in self.timings:
+            serializer_seconds.observe(self.timings['serializer'])
+        db_seconds.observe(self.db_seconds)
+        queries.observe(self.queries)
+
+
+_labelled = {}
+
+
+def _children(endpoint, method):
+    # labels() takes a lock and builds the key on every call; the endpoints are few
+    children = _labelled.get((endpoint, method))
+    if children is None:
+        children = _labelled[endpoint, method] = (
+            _StatusCounters(endpoint, method),
+            *(metric.labels(endpoint, method) for metric in (REQUEST_SECONDS, VIEW_SECONDS, SERIALIZER_SECONDS, DB_SECONDS, QUERIES)),
+        )
+    return children
+
+
+class _StatusCounters(dict):
+    def __init__(self, endpoint, method):
+        self.labels = (endpoint, method)
+
+    def __missing__(self, status):
+        counter = self[status] = REQUESTS.labels(*self.labels, status)
+        return counter
+
+
+def _execute(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def record_queries(sender, connection, **kwargs):
+    # On every connection rather than per request: under ASGI the queries run in the
+    # threads of sync_to_async(), which see the request's metrics in their context copy.
+    # The wrappers outlive reconnections.
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+def current_metrics():
+    return _current.get()
+
+
+def start_request():
+    metrics = RequestMetrics()
+    return metrics, _current.set(metrics)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current request's `name` timing."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - started)
+
+
+def metrics_view(request):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,85 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import current_metrics, end_request, start_request
+
+logger = logging.getLogger('books.slow_requests')
+
+
+def _view_started():
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.view_started = time.perf_counter()
+
+
+class RequestMetricsMiddleware:
+    """
+    Record the query count, database, serializer and view time of every request,
+    send them back in a Server-Timing header, add them to the per-endpoint
+    histograms of /metrics, and log the SQL of requests slower than
+    SLOW_REQUEST_SECONDS.
+
+    Keep it first in MIDDLEWARE so the total covers the other middleware too. It
+    runs in either mode, so under ASGI it doesn't turn the chain after it sync.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Also called in the event loop instead of through a thread
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        finished = time.perf_counter()
+        total = finished - metrics.started
+        view = finished - metrics.view_started if metrics.view_started is not None else None
+
+        match = request.resolver_match
+        endpoint = match.view_name if match else 'unmatched'
+        metrics.observe(endpoint, request.method, response.status_code, total, view)
+        response['Server-Timing'] = metrics.server_timing(total, view)
+        if total >= settings.SLOW_REQUEST_SECONDS:
+            self.log_slow_request(request, endpoint, metrics, total)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _view_started()
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        _view_started()
+
+    def log_slow_request(self, request, endpoint, metrics, total):
+        statements = '\n'.join(
+            f'  {duration * 1000:8.1f} ms  {count:3}x  {sql}'
+            for duration, count, sql in metrics.worst_statements(settings.SLOW_REQUEST_STATEMENTS)
+        )
+        logger.warning(
+            'Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms\n%s',
+            request.method, request.get_full_path(), endpoint, total * 1000, metrics.queries,
+            metrics.db_seconds * 1000, statements,
+        )
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.15 on 2026-10-18 19:00
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+import django.db.models.deletion
+
+
+def backfill_stats(apps, schema_editor):
+    Comment = apps.get_model('books', 'Comment')
+    BookStats = apps.get_model('books', 'BookStats')
+    rows = Comment.objects.order_by().values('book_id').annotate(
+        rating_sum=Sum('rating', filter=Q(rating__gte=1), default=0),
+        text_count=Count('id', filter=Q(text__isnull=False)),
+        **{f'rating_{i}': Count('id', filter=Q(rating=i)) for i in range(1, 6)},
+    )
+    BookStats.objects.bulk_create([BookStats(**row) for row in rows], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0006_book_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStats',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='books.book')),
+                ('rating_1', models.IntegerField(default=0)),
+                ('rating_2', models.IntegerField(default=0)),
+                ('rating_3', models.IntegerField(default=0)),
+                ('rating_4', models.IntegerField(default=0)),
+                ('rating_5', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('text_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'book stats',
+            },
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
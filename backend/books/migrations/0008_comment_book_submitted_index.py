@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0007_bookstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['book', 'submitted_on', 'id'], name='comment_book_submitted_idx'),
+        ),
+    ]
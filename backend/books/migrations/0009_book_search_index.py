@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from books.search import install_search_index
+    install_search_index(schema_editor)
+
+
+def uninstall(apps, schema_editor):
+    from books.search import uninstall_search_index
+    uninstall_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0008_comment_book_submitted_index'),
+    ]
+
+    operations = [
+        # PostgreSQL: a generated tsvector column with a GIN index.
+        # SQLite: an FTS5 table kept in sync by triggers.
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0010_book_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogLoad',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, unique=True)),
+                ('checksum', models.CharField(max_length=64)),
+                ('books', models.PositiveIntegerField(default=0)),
+                ('loaded_on', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
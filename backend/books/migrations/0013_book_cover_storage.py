@@ -0,0 +1,19 @@
+# Generated by Django 4.2.15 on 2026-10-18 19:27
+
+import books.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0012_book_cover_dimensions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='cover_image',
+            field=models.ImageField(blank=True, null=True, storage=books.storage.ContentAddressedStorage(), upload_to='covers'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def clear_zero_ratings(apps, schema_editor):
+    # Edits used to store "no rating" as 0 instead of NULL
+    Comment = apps.get_model('books', 'Comment')
+    Comment.objects.filter(rating=0).update(rating=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0013_book_cover_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_zero_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import time
+
+
+def create_parameters(apps, schema_editor):
+    # BookRanking.record() reads this row in the statement that updates the scores
+    RankingParameters = apps.get_model('books', 'RankingParameters')
+    RankingParameters.objects.create()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_related_books'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankingParameters',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mean_rating', models.FloatField(default=3.0)),
+                ('prior_weight', models.FloatField(default=10.0)),
+                ('trending_epoch', models.FloatField(default=time.time)),
+                ('rebuilt_on', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'ranking parameters',
+            },
+        ),
+        migrations.CreateModel(
+            name='BookRanking',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ranking', serialize=False, to='books.book')),
+                ('top_score', models.FloatField(null=True)),
+                ('trending_score', models.FloatField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-top_score', 'book'], name='ranking_top_idx'), models.Index(fields=['-trending_score', 'book'], name='ranking_trending_idx')],
+            },
+        ),
+        migrations.RunPython(create_parameters, migrations.RunPython.noop),
+    ]
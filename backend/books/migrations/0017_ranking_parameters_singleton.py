@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+def single_row(apps, schema_editor):
+    # The parameters are now always the row with id 1, which BookRanking.record() and
+    # RankingParameters.load() create when it is missing; keep the last rebuilt one
+    RankingParameters = apps.get_model('books', 'RankingParameters')
+    rows = RankingParameters.objects.order_by('-rebuilt_on', '-id')
+    kept = rows.filter(rebuilt_on__isnull=False).first() or rows.first()
+    if kept is None:
+        RankingParameters.objects.create(id=1)
+        return
+    RankingParameters.objects.exclude(pk=kept.pk).delete()
+    if kept.pk != 1:
+        RankingParameters.objects.filter(pk=kept.pk).update(id=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0016_rankings'),
+    ]
+
+    operations = [
+        migrations.RunPython(single_row, migrations.RunPython.noop),
+    ]
@@ -1,18 +1,64 @@
-from django.db import models
+import time
+from collections import defaultdict
+from django.db import connection, models
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 
+from .storage import cover_storage
+
+class BookQuerySet(models.QuerySet):
+    def with_total_bookmarks(self):
+        # A correlated subquery instead of a JOIN + GROUP BY keeps ORDER BY ... LIMIT
+        # answerable from the (title, id) index
+        total = Bookmark.objects.filter(book=OuterRef('pk')).order_by().values('book').annotate(
+            total=Count('*')
+        ).values('total')
+        return self.annotate(total_bookmarks=Coalesce(Subquery(total, output_field=IntegerField()), 0))
+
+    def with_bookmark_info(self, user):
+        # Resolve is_bookmarked and total_bookmarks in the same query as the books
+        bookmarks = Bookmark.objects.filter(book=OuterRef('pk'), user_id=user.pk)
+        return self.with_total_bookmarks().annotate(is_bookmarked=Exists(bookmarks))
+
+    def bump_version(self):
+        return self.update(version=F('version') + 1)
+
 class Book(models.Model):
     title = models.CharField(max_length=255)
     author = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     published_date = models.DateField()
-    cover_image = models.ImageField(upload_to='covers', blank=True, null=True)
+    cover_image = models.ImageField(upload_to='covers', storage=cover_storage, blank=True, null=True)
+    # Filled in by books.covers.generate_covers together with the sized variants
+    cover_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    cover_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    cover_placeholder = models.TextField(blank=True, default='', editable=False)
+    # Bumped by every write that changes the book's detail response, used as ETag validator
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = BookQuerySet.as_manager()
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+        if not isinstance(self.version, int):
+            self.refresh_from_db(fields=['version'])
+
     class Meta:
-        ordering = ['title']
+        ordering = ['title', 'id']
+        indexes = [
+            # Keyset pagination on /books/list/ seeks on (title, id)
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+            models.Index(fields=['author', 'title', 'id'], name='book_author_title_id_idx'),
+            models.Index(fields=['published_date'], name='book_published_date_idx'),
+        ]
 
 class Bookmark(models.Model):
     user = models.ForeignKey(User, related_name='bookmarks', on_delete=models.CASCADE)
@@ -25,6 +71,33 @@ class Bookmark(models.Model):
     def __str__(self):
         return f'{self.user.username} bookmarked {self.book.title}'
 
+    @classmethod
+    def remove(cls, user_id, book_ids):
+        """
+        Delete the bookmarks of `user_id` on `book_ids` in one DELETE ... RETURNING.
+        Returns {book_id: added_on} of the deleted ones.
+        """
+        if not book_ids:
+            return {}
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        user, book = cls._meta.get_field('user').column, cls._meta.get_field('book').column
+        added_on = cls._meta.get_field('added_on')
+        column = added_on.get_col(cls._meta.db_table)
+        converters = connection.ops.get_db_converters(column)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE {qn(user)} = %s AND {qn(book)} IN ({", ".join(["%s"] * len(book_ids))}) '
+                f'RETURNING {qn(book)}, {qn(added_on.column)}',
+                [user_id, *book_ids],
+            )
+            removed = {}
+            for book_id, value in cursor.fetchall():
+                for converter in converters:
+                    value = converter(value, column, connection)
+                removed[book_id] = value
+        return removed
+
 class Comment(models.Model):
     user = models.ForeignKey(User, related_name='comments', on_delete=models.CASCADE)
     book = models.ForeignKey(Book, related_name='comments', on_delete=models.CASCADE)
@@ -34,7 +107,268 @@ class Comment(models.Model):
 
     class Meta:
         unique_together = ('user', 'book')
+        indexes = [
+            # Newest-first keyset pagination of a book's comments
+            models.Index(fields=['book', 'submitted_on', 'id'], name='comment_book_submitted_idx'),
+        ]
 
     def __str__(self):
         return f'Comment by {self.user.username} on {self.book.title}'
 
+    @classmethod
+    def upsert(cls, user_id, book_id, text, rating, submitted_on):
+        """
+        Insert the comment of `user_id` on `book_id`, or replace the text and rating of
+        the existing one, in one INSERT ... ON CONFLICT DO UPDATE. Returns its id.
+        """
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        user, book = cls._meta.get_field('user').column, cls._meta.get_field('book').column
+        submitted_on = cls._meta.get_field('submitted_on').get_db_prep_value(submitted_on, connection)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} ({qn(user)}, {qn(book)}, {qn("text")}, {qn("rating")}, {qn("submitted_on")}) '
+                f'VALUES (%s, %s, %s, %s, %s) '
+                f'ON CONFLICT ({qn(user)}, {qn(book)}) DO UPDATE '
+                f'SET {qn("text")} = EXCLUDED.{qn("text")}, {qn("rating")} = EXCLUDED.{qn("rating")} '
+                f'RETURNING {qn("id")}',
+                [user_id, book_id, text, rating, submitted_on],
+            )
+            return cursor.fetchone()[0]
+
+
+class BookStats(models.Model):
+    """
+    Rating and comment aggregates of a book, kept up to date by SubmitCommentView
+    so the detail view reads one row instead of aggregating over Comment.
+    """
+    RATINGS = range(1, 6)
+
+    book = models.OneToOneField(Book, related_name='stats', on_delete=models.CASCADE, primary_key=True)
+    rating_1 = models.IntegerField(default=0)
+    rating_2 = models.IntegerField(default=0)
+    rating_3 = models.IntegerField(default=0)
+    rating_4 = models.IntegerField(default=0)
+    rating_5 = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    text_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'book stats'
+
+    def __str__(self):
+        return f'Stats of {self.book}'
+
+    @classmethod
+    def for_book(cls, book):
+        # Books nobody has commented on yet have no stats row
+        try:
+            return book.stats
+        except cls.DoesNotExist:
+            return cls(book=book)
+
+    @property
+    def total_rating(self):
+        return sum(getattr(self, f'rating_{i}') for i in self.RATINGS)
+
+    @property
+    def rating_avg(self):
+        total = self.total_rating
+        return self.rating_sum / total if total else None
+
+    @property
+    def rating_dict(self):
+        return {str(i): getattr(self, f'rating_{i}') for i in self.RATINGS}
+
+    @classmethod
+    def record(cls, book_id, old=None, new=None):
+        """
+        Apply a comment change to the stats of `book_id`. `old` and `new` are the
+        (text, rating) of the comment before and after the change, None when absent.
+        """
+        deltas = defaultdict(int)
+        for values, sign in ((old, -1), (new, 1)):
+            if values is None:
+                continue
+            text, rating = values
+            if text is not None:
+                deltas['text_count'] += sign
+            if rating:
+                deltas[f'rating_{rating}'] += sign
+                deltas['rating_sum'] += sign * int(rating)
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        # One INSERT ... ON CONFLICT DO UPDATE creates the row or applies the deltas to it
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        fields = [f'rating_{i}' for i in cls.RATINGS] + ['rating_sum', 'text_count']
+        columns = [cls._meta.get_field('book').column] + fields
+        updates = ', '.join(f'{qn(field)} = {table}.{qn(field)} + EXCLUDED.{qn(field)}' for field in deltas)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} ({", ".join(qn(column) for column in columns)}) '
+                f'VALUES ({", ".join(["%s"] * len(columns))}) '
+                f'ON CONFLICT ({qn(columns[0])}) DO UPDATE SET {updates}',
+                [book_id] + [deltas.get(field, 0) for field in fields],
+            )
+
+    @classmethod
+    def compute(cls, book_ids=None):
+        """Aggregate the stats from Comment, returning {book_id: {field: value}}."""
+        comments = Comment.objects.all()
+        if book_ids is not None:
+            comments = comments.filter(book_id__in=book_ids)
+        aggregates = {
+            f'rating_{i}': Count('id', filter=Q(rating=i)) for i in cls.RATINGS
+        }
+        rows = comments.order_by().values('book_id').annotate(
+            rating_sum=Sum('rating', filter=Q(rating__gte=1), default=0),
+            text_count=Count('id', filter=Q(text__isnull=False)),
+            **aggregates,
+        )
+        return {row.pop('book_id'): row for row in rows}
+
+
+class CatalogLoad(models.Model):
+    """Checksum of the last catalog file `load_catalog` loaded from `source`."""
+    source = models.CharField(max_length=255, unique=True)
+    checksum = models.CharField(max_length=64)
+    books = models.PositiveIntegerField(default=0)
+    loaded_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.source} ({self.checksum[:12]})'
+
+
+class RelatedBook(models.Model):
+    """
+    One of the books most often bookmarked or rated highly by the users who did so
+    for `book`, closest first by `rank`. Written by the build_related_books command.
+    """
+    book = models.ForeignKey(Book, related_name='related_books', on_delete=models.CASCADE)
+    related = models.ForeignKey(Book, related_name='related_to', on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            # Also the index /books/<pk>/related/ reads the neighbours from, in rank order
+            models.UniqueConstraint(fields=['book', 'rank'], name='related_book_rank_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.related_id} is #{self.rank + 1} related to {self.book_id}'
+
+
+class RelatedBooksSource(models.Model):
+    """Book.version when the RelatedBook rows of `book` were last computed."""
+    book = models.OneToOneField(Book, related_name='+', on_delete=models.CASCADE, primary_key=True)
+    version = models.PositiveIntegerField()
+
+
+class RelatedBooksBuild(models.Model):
+    """A run of build_related_books and the parameters incremental runs must reuse."""
+    measure = models.CharField(max_length=16)
+    top_k = models.PositiveSmallIntegerField()
+    incremental = models.BooleanField(default=False)
+    books = models.PositiveIntegerField(default=0)
+    built_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.measure} top {self.top_k}, {self.books} books ({self.built_on:%Y-%m-%d %H:%M})'
+
+
+class RankingParameters(models.Model):
+    """
+    The single row of global values BookRanking scores are computed with, set by the
+    rebuild_rankings command. Writes read it in the statement that updates the scores.
+    """
+    # Prior of the Bayesian average: the mean rating, counted as this many ratings
+    mean_rating = models.FloatField(default=3.0)
+    prior_weight = models.FloatField(default=10.0)
+    # Unix time trending scores are relative to, moved to now by the first rebuild after
+    # rankings.EPOCH_MAX_AGE
+    trending_epoch = models.FloatField(default=time.time)
+    rebuilt_on = models.DateTimeField(null=True, blank=True)
+
+    # Primary key of the single row
+    ID = 1
+
+    class Meta:
+        verbose_name_plural = 'ranking parameters'
+
+    @classmethod
+    def load(cls):
+        """The parameters, created with the defaults when the row is missing (e.g. after a flush)."""
+        return cls.objects.get_or_create(pk=cls.ID)[0]
+
+
+class BookRanking(models.Model):
+    """
+    Scores of /books/top/ and /books/trending/, updated by every comment and bookmark
+    write and rebuilt from scratch by the rebuild_rankings command.
+    """
+    BOOKMARK_WEIGHT = 1.0
+    COMMENT_WEIGHT = 2.0
+    # Activity counts half as much every TRENDING_HALF_LIFE seconds
+    TRENDING_HALF_LIFE = 3 * 24 * 3600
+
+    book = models.OneToOneField(Book, related_name='ranking', on_delete=models.CASCADE, primary_key=True)
+    # Bayesian average rating, None while the book has no rating
+    top_score = models.FloatField(null=True)
+    # Sum of weight * 2 ** ((time - trending_epoch) / TRENDING_HALF_LIFE) over the book's
+    # bookmarks and comments. Relative to a fixed epoch, so adding an event never decays
+    # the other rows and the order is the same as with the scores decayed to now.
+    trending_score = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-top_score', 'book'], name='ranking_top_idx'),
+            models.Index(fields=['-trending_score', 'book'], name='ranking_trending_idx'),
+        ]
+
+    def __str__(self):
+        return f'Ranking of {self.book}'
+
+    @classmethod
+    def top_score_sql(cls, stats, parameters):
+        qn = connection.ops.quote_name
+        ratings = ' + '.join(f'{stats}.{qn(f"rating_{i}")}' for i in BookStats.RATINGS)
+        return (
+            f'CASE WHEN {ratings} > 0 THEN ({parameters}.{qn("prior_weight")} * {parameters}.{qn("mean_rating")} '
+            f'+ {stats}.{qn("rating_sum")}) / ({parameters}.{qn("prior_weight")} + {ratings}) END'
+        )
+
+    @classmethod
+    def record(cls, activity):
+        """
+        Add the (book_id, weight, datetime) events of `activity` to the trending scores
+        of their books and recompute their top scores from BookStats, in one INSERT ...
+        ON CONFLICT DO UPDATE. Removed bookmarks and comments have a negative weight.
+        """
+        if not activity:
+            return
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        stats = qn(BookStats._meta.db_table)
+        parameters = qn(RankingParameters._meta.db_table)
+        book = qn(cls._meta.get_field('book').column)
+        values = ', '.join(['(%s, %s, %s)'] * len(activity))
+        params = [value for book_id, weight, when in activity for value in (book_id, float(weight), when.timestamp())]
+        sql = (
+            f'INSERT INTO {table} ({book}, {qn("top_score")}, {qn("trending_score")}) '
+            f'SELECT v.column1, MAX({cls.top_score_sql(stats, parameters)}), '
+            f'SUM(v.column2 * POWER(2, (v.column3 - {parameters}.{qn("trending_epoch")}) / {cls.TRENDING_HALF_LIFE})) '
+            f'FROM (VALUES {values}) AS v CROSS JOIN {parameters} '
+            f'LEFT JOIN {stats} ON {stats}.{qn(BookStats._meta.get_field("book").column)} = v.column1 '
+            f'GROUP BY v.column1 '
+            f'ON CONFLICT ({book}) DO UPDATE SET {qn("top_score")} = EXCLUDED.{qn("top_score")}, '
+            f'{qn("trending_score")} = {table}.{qn("trending_score")} + EXCLUDED.{qn("trending_score")}'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if not cursor.rowcount:
+                # Without the parameters row the join selects nothing
+                RankingParameters.load()
+                cursor.execute(sql, params)
@@ -0,0 +1,143 @@
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import Book, BookRanking, BookStats, Bookmark, Comment, RankingParameters
+from .utils import advisory_lock, chunks
+
+# Trending scores double every half-life from the epoch on; it moves to now once older
+# than this, long before they could overflow
+EPOCH_MAX_AGE = 30 * 24 * 3600
+
+
+def _timestamp_sql(column):
+    if connection.vendor == 'postgresql':
+        # numeric since PostgreSQL 14
+        return f'CAST(EXTRACT(EPOCH FROM {column}) AS DOUBLE PRECISION)'
+    # Julian day of the Unix epoch
+    return f'(JULIANDAY({column}) - 2440587.5) * 86400'
+
+
+def _trending(epoch, batch_size):
+    """
+    {book_id: trending score} of all the bookmarks and comments, with the same decay
+    as BookRanking.record() and summed by the database.
+    """
+    qn = connection.ops.quote_name
+    activity = []
+    for model, field, weight in (
+        (Bookmark, 'added_on', BookRanking.BOOKMARK_WEIGHT), (Comment, 'submitted_on', BookRanking.COMMENT_WEIGHT),
+    ):
+        table = qn(model._meta.db_table)
+        time = _timestamp_sql(f'{table}.{qn(model._meta.get_field(field).column)}')
+        activity.append(
+            f'SELECT {table}.{qn(model._meta.get_field("book").column)} AS book_id, '
+            f'{weight} * POWER(2, ({time} - %s) / {BookRanking.TRENDING_HALF_LIFE}) AS score FROM {table}'
+        )
+    scores = {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT activity.book_id, SUM(activity.score) FROM ({" UNION ALL ".join(activity)}) AS activity '
+            f'GROUP BY activity.book_id',
+            [epoch, epoch],
+        )
+        while rows := cursor.fetchmany(batch_size):
+            scores.update(rows)
+    return scores
+
+
+def _update_parameters(now):
+    """Recompute the Bayesian prior from BookStats and move an old trending epoch to `now`."""
+    RankingParameters.load()
+    with transaction.atomic():
+        parameters = RankingParameters.objects.select_for_update().get(pk=RankingParameters.ID)
+        ratings = sum((F(f'rating_{i}') for i in BookStats.RATINGS[1:]), F(f'rating_{BookStats.RATINGS[0]}'))
+        rated = BookStats.objects.annotate(ratings=ratings).filter(ratings__gt=0).aggregate(
+            books=Count('pk'), count=Sum('ratings'), total=Sum('rating_sum'),
+        )
+        if rated['books']:
+            parameters.mean_rating = rated['total'] / rated['count']
+            # As many prior ratings as a rated book has on average
+            parameters.prior_weight = rated['count'] / rated['books']
+        if now.timestamp() - parameters.trending_epoch > EPOCH_MAX_AGE:
+            if connection.vendor == 'postgresql':
+                # Only for this one statement: writes that wait for it compute their
+                # activity with the new epoch
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LOCK TABLE {connection.ops.quote_name(BookRanking._meta.db_table)} IN SHARE ROW EXCLUSIVE MODE')
+            factor = 2 ** ((parameters.trending_epoch - now.timestamp()) / BookRanking.TRENDING_HALF_LIFE)
+            BookRanking.objects.update(trending_score=F('trending_score') * factor)
+            parameters.trending_epoch = now.timestamp()
+        parameters.rebuilt_on = now
+        parameters.save()
+    return parameters
+
+
+def _snapshot(parameters, batch_size):
+    """
+    Trending scores computed from all the bookmarks and comments, the stored ones and
+    the rated books, all read from the same snapshot of the database.
+    """
+    # Must be the first statement of the transaction, so not when already in one
+    repeatable_read = connection.vendor == 'postgresql' and not connection.in_atomic_block
+    with transaction.atomic():
+        if repeatable_read:
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        trending = _trending(parameters.trending_epoch, batch_size)
+        stored = dict(BookRanking.objects.values_list('book_id', 'trending_score').iterator(chunk_size=batch_size))
+        ratings = sum((F(f'rating_{i}') for i in BookStats.RATINGS[1:]), F(f'rating_{BookStats.RATINGS[0]}'))
+        rated = BookStats.objects.annotate(ratings=ratings).filter(ratings__gt=0).values_list('book_id', flat=True)
+        rated_ids = np.fromiter(rated.iterator(chunk_size=batch_size), dtype=np.int64)
+    return trending, stored, rated_ids
+
+
+def _apply(rows):
+    """
+    Upsert (book_id, trending delta) `rows`: add the delta to the trending score and
+    recompute the top score from BookStats, like BookRanking.record(). Books deleted
+    in the meantime are skipped.
+    """
+    qn = connection.ops.quote_name
+    table = qn(BookRanking._meta.db_table)
+    stats = qn(BookStats._meta.db_table)
+    parameters = qn(RankingParameters._meta.db_table)
+    books = qn(Book._meta.db_table)
+    book = qn(BookRanking._meta.get_field('book').column)
+    values = ', '.join(['(%s, %s)'] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({book}, {qn("top_score")}, {qn("trending_score")}) '
+            f'SELECT v.column1, {BookRanking.top_score_sql(stats, parameters)}, v.column2 '
+            f'FROM (VALUES {values}) AS v JOIN {books} ON {books}.{qn("id")} = v.column1 CROSS JOIN {parameters} '
+            f'LEFT JOIN {stats} ON {stats}.{qn(BookStats._meta.get_field("book").column)} = v.column1 '
+            # Without a WHERE, SQLite would parse ON CONFLICT as the join's ON clause
+            f'WHERE 1 = 1 '
+            f'ON CONFLICT ({book}) DO UPDATE SET {qn("top_score")} = EXCLUDED.{qn("top_score")}, '
+            f'{qn("trending_score")} = {table}.{qn("trending_score")} + EXCLUDED.{qn("trending_score")}',
+            [value for row in rows for value in row],
+        )
+
+
+def rebuild(batch_size=10000):
+    """
+    Recompute the Bayesian prior and every BookRanking without holding up the writes.
+
+    The trending scores are computed from a snapshot of the bookmarks and comments
+    and written in batches of `batch_size` books, each in its own short transaction.
+    A batch adds the difference between the computed score and the one stored in
+    the snapshot, so the activity recorded by writes since the snapshot is kept.
+    Rebuilds run one at a time: two applying the same difference would count it twice.
+    Returns the new RankingParameters.
+    """
+    with advisory_lock('rankings rebuild'):
+        parameters = _update_parameters(timezone.now())
+        trending, stored, rated_ids = _snapshot(parameters, batch_size)
+        book_ids = sorted(set(trending) | set(stored) | set(rated_ids.tolist()))
+        for chunk in chunks(book_ids, batch_size):
+            with transaction.atomic():
+                _apply([(book_id, trending.get(book_id, 0.0) - stored.get(book_id, 0.0)) for book_id in chunk])
+        # Books that lost all their ratings and activity
+        BookRanking.objects.filter(top_score__isnull=True, trending_score=0).delete()
+    return parameters
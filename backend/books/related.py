@@ -0,0 +1,142 @@
+import itertools
+
+import numpy as np
+from scipy import sparse
+from django.db import transaction
+
+from .dataset import insert_rows
+from .models import Book, Bookmark, Comment, RelatedBook, RelatedBooksBuild, RelatedBooksSource
+from .utils import advisory_lock, chunks
+
+MEASURES = ('cosine', 'jaccard')
+# A comment counts as liking the book from this rating on
+POSITIVE_RATING = 4
+
+
+def _pairs(queryset, batch_size):
+    """The (user_id, book_id) rows of `queryset` as an n x 2 array, streamed from the database."""
+    rows = queryset.order_by().values_list('user_id', 'book_id').iterator(chunk_size=batch_size)
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, 2)
+
+
+def interactions(book_ids, batch_size=10000):
+    """
+    Sparse users x books matrix with a 1 where the user bookmarked the book or rated
+    it POSITIVE_RATING or more. Columns are the positions in the sorted `book_ids`.
+    """
+    pairs = np.concatenate([
+        _pairs(Bookmark.objects.all(), batch_size),
+        _pairs(Comment.objects.filter(rating__gte=POSITIVE_RATING), batch_size),
+    ])
+    _, users = np.unique(pairs[:, 0], return_inverse=True)
+    columns = np.searchsorted(book_ids, pairs[:, 1])
+    # Books added after `book_ids` was read are left for the next run
+    known = columns < len(book_ids)
+    known[known] = book_ids[columns[known]] == pairs[known, 1]
+    matrix = sparse.csr_matrix(
+        (np.ones(known.sum(), dtype=np.float32), (users[known], columns[known])),
+        shape=(users.max() + 1 if len(users) else 0, len(book_ids)),
+    )
+    # A bookmark and a liked comment of the same book count once
+    matrix.data[:] = 1
+    return matrix
+
+
+def neighbours(by_book, matrix, rows, top_k, measure):
+    """
+    Yield (row, columns, scores) with the `top_k` books closest to each of the `rows`,
+    best first, ties by id. `by_book` is the transposed `matrix` in CSR form.
+    """
+    counts = np.diff(by_book.indptr).astype(np.float64)
+    cooccurrence = (by_book[rows] @ matrix).tocsr()
+    own = counts[np.repeat(rows, np.diff(cooccurrence.indptr))]
+    other = counts[cooccurrence.indices]
+    shared = cooccurrence.data.astype(np.float64)
+    if measure == 'jaccard':
+        scores = shared / (own + other - shared)
+    else:
+        scores = shared / np.sqrt(own * other)
+
+    for i, row in enumerate(rows):
+        start, end = cooccurrence.indptr[i], cooccurrence.indptr[i + 1]
+        columns, values = cooccurrence.indices[start:end], scores[start:end]
+        other_books = columns != row
+        columns, values = columns[other_books], values[other_books]
+        if len(values) > top_k:
+            keep = values >= np.partition(values, -top_k)[-top_k]
+            columns, values = columns[keep], values[keep]
+        order = np.lexsort((columns, -values))[:top_k]
+        yield row, columns[order], values[order]
+
+
+def affected_rows(by_book, matrix, book_ids, touched, batch_size):
+    """
+    Rows whose neighbours may have changed with the interactions of the `touched`
+    books: theirs, those of the books they share a user with, and those they were
+    a neighbour of.
+    """
+    users = np.unique(by_book[touched].indices)
+    rows = {*touched.tolist(), *np.unique(matrix[users].indices).tolist()}
+    for chunk in chunks(book_ids[touched].tolist(), batch_size):
+        pointing = RelatedBook.objects.filter(related_id__in=chunk).values_list('book_id', flat=True).distinct()
+        positions = np.searchsorted(book_ids, np.fromiter(pointing, dtype=np.int64))
+        rows.update(positions[positions < len(book_ids)].tolist())
+    return np.array(sorted(rows), dtype=np.int64)
+
+
+def build(top_k=20, measure='cosine', incremental=False, block_size=1000, batch_size=10000, progress=None):
+    """
+    Store the `top_k` related books of every book from the item-item co-occurrence of
+    bookmarks and positive comments, normalized with `measure`. An incremental build
+    only recomputes the rows touched since the previous one, see affected_rows().
+    Returns the RelatedBooksBuild.
+    """
+    # Two builds at once would both replace the same rows
+    with advisory_lock('related books build'):
+        if measure not in MEASURES:
+            raise ValueError(f"Unknown measure {measure}, use one of {', '.join(MEASURES)}")
+        progress = progress or (lambda message: None)
+        last = RelatedBooksBuild.objects.order_by('-id').first()
+        if incremental and last and (last.measure, last.top_k) != (measure, top_k):
+            raise ValueError(f'The stored neighbours are {last.measure} top {last.top_k}, rebuild them all to change it')
+
+        # Read before the interactions, so a write during the scan leaves its book touched
+        versions = np.array(Book.objects.order_by('id').values_list('id', 'version'), dtype=np.int64).reshape(-1, 2)
+        book_ids = versions[:, 0]
+        matrix = interactions(book_ids, batch_size)
+        by_book = matrix.T.tocsr()
+        progress(f'{matrix.nnz} interactions of {matrix.shape[0]} users with {len(book_ids)} books')
+
+        if incremental:
+            stored = dict(RelatedBooksSource.objects.values_list('book_id', 'version'))
+            touched = np.array([
+                i for i, (book_id, version) in enumerate(versions.tolist()) if stored.get(book_id) != version
+            ], dtype=np.int64)
+            rows = affected_rows(by_book, matrix, book_ids, touched, batch_size)
+            progress(f'{len(touched)} books touched, {len(rows)} rows to recompute')
+        else:
+            touched = rows = np.arange(len(book_ids))
+
+        with transaction.atomic():
+            if not incremental:
+                RelatedBook.objects.all().delete()
+                RelatedBooksSource.objects.all().delete()
+            stored = 0
+            for start in range(0, len(rows), block_size):
+                block = rows[start:start + block_size]
+                if incremental:
+                    for chunk in chunks(book_ids[block].tolist(), batch_size):
+                        RelatedBook.objects.filter(book_id__in=chunk).delete()
+                stored += insert_rows(RelatedBook, ['book', 'related', 'rank', 'score'], (
+                    (book_id, related_id, rank, score)
+                    for row, columns, scores in neighbours(by_book, matrix, block, top_k, measure)
+                    for book_id in [int(book_ids[row])]
+                    for rank, (related_id, score) in enumerate(zip(book_ids[columns].tolist(), scores.tolist()))
+                ), batch_size)
+                progress(f'{min(start + block_size, len(rows))}/{len(rows)} rows, {stored} neighbours')
+
+            if incremental:
+                for chunk in chunks(book_ids[touched].tolist(), batch_size):
+                    RelatedBooksSource.objects.filter(book_id__in=chunk).delete()
+            insert_rows(RelatedBooksSource, ['book', 'version'], versions[touched].tolist(), batch_size)
+            return RelatedBooksBuild.objects.create(measure=measure, top_k=top_k, incremental=incremental, books=len(rows))
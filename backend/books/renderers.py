@@ -0,0 +1,56 @@
+import msgpack
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+from .metrics import timed
+
+# orjson writes the same JSON as JSONRenderer with the default COMPACT_JSON and
+# UNICODE_JSON settings, except for the exponent notation of very large or small floats
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+LINE_SEPARATORS = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer encoding with orjson. Types orjson doesn't know (querysets, lazy
+    strings, decimals...) go through DRF's JSONEncoder, so the bytes are the same.
+    Pretty printed output and non-default JSON settings are left to JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        if self.ensure_ascii or not self.compact or self.get_indent(accepted_media_type, renderer_context) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        with timed('render'):
+            try:
+                ret = orjson.dumps(data, default=self.encoder_class().default, option=ORJSON_OPTIONS)
+            except orjson.JSONEncodeError:
+                # e.g. integers wider than 64 bits
+                return super().render(data, accepted_media_type, renderer_context)
+            # Escaped like JSONRenderer does, so the output stays a JavaScript subset
+            for character, escaped in LINE_SEPARATORS:
+                if character in ret:
+                    ret = ret.replace(character, escaped)
+            return ret
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    MessagePack for clients sending `Accept: application/msgpack`. Values JSON has no
+    type for (datetimes, dates, decimals...) are encoded as in the JSON responses.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    encoder_class = encoders.JSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        with timed('render'):
+            return msgpack.packb(data, default=self.encoder_class().default, use_bin_type=True)
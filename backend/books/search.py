@@ -0,0 +1,184 @@
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .models import Book
+
+# Characters folded before indexing and querying. The catalog is scraped from
+# Taaghche and mixes Arabic and Persian code points for the same letters.
+PERSIAN_CHAR_MAP = {
+    '\u064a': '\u06cc',  # Arabic yeh -> Persian yeh
+    '\u0649': '\u06cc',  # Alef maksura -> Persian yeh
+    '\u0643': '\u06a9',  # Arabic kaf -> Persian kaf
+    '\u0629': '\u0647',  # Teh marbuta -> heh
+    '\u200c': ' ',  # ZWNJ joins the parts of a word, index them as separate words
+    '\u0640': '',  # Tatweel
+    **{chr(code): '' for code in range(0x064b, 0x0653)},  # Harakat
+    **{chr(0x06f0 + i): str(i) for i in range(10)},  # Persian digits
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic digits
+}
+
+_translation = str.maketrans(PERSIAN_CHAR_MAP)
+_token_re = re.compile(r'\w+')
+
+SEARCH_FIELDS = (('title', 'A', 10.0), ('author', 'B', 5.0), ('description', 'C', 1.0))
+SQLITE_FTS_TABLE = 'books_book_fts'
+SQLITE_NORMALIZE_FUNCTION = 'books_normalize'
+POSTGRES_VECTOR_COLUMN = 'search_vector'
+POSTGRES_VECTOR_INDEX = 'book_search_vector_idx'
+
+
+def normalize_persian(text):
+    return (text or '').translate(_translation).lower()
+
+
+def tokenize(text):
+    return _token_re.findall(normalize_persian(text))
+
+
+def search_books(queryset, query, limit):
+    """
+    Return up to `limit` books of `queryset` matching `query`, best match first.
+    PostgreSQL uses the generated tsvector column, SQLite the FTS5 table.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    if connection.vendor == 'postgresql':
+        return _search_postgresql(queryset, tokens, limit)
+    return _search_sqlite(queryset, tokens, limit)
+
+
+def _search_postgresql(queryset, tokens, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+
+    # Every word must match, the last one as a prefix so partial input finds results
+    raw = ' & '.join([f"'{token}'" for token in tokens[:-1]] + [f"'{tokens[-1]}':*"])
+    search_query = SearchQuery(raw, search_type='raw', config='simple')
+    vector = RawSQL(f'"{Book._meta.db_table}"."{POSTGRES_VECTOR_COLUMN}"', [], output_field=SearchVectorField())
+    return list(
+        queryset.annotate(search=vector)
+        .filter(search=search_query)
+        .annotate(rank=SearchRank(vector, search_query))
+        .order_by('-rank', 'id')[:limit]
+    )
+
+
+def _search_sqlite(queryset, tokens, limit):
+    match = ' '.join(f'"{token}"' for token in tokens) + '*'
+    weights = ', '.join(str(weight) for _, _, weight in SEARCH_FIELDS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s '
+            f'ORDER BY bm25({SQLITE_FTS_TABLE}, {weights}) LIMIT %s',
+            [match, limit],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    books = queryset.in_bulk(ids)
+    return [books[pk] for pk in ids if pk in books]
+
+
+def register_sqlite_functions(sender, connection, **kwargs):
+    # The FTS5 triggers normalize with the same code as the queries
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function(
+            SQLITE_NORMALIZE_FUNCTION, 1, normalize_persian, deterministic=True
+        )
+
+
+def _postgresql_normalize_sql(schema_editor, expression):
+    # translate() drops the characters that have no counterpart in the target string,
+    # so the deletions go last
+    pairs = sorted(PERSIAN_CHAR_MAP.items(), key=lambda pair: pair[1] == '')
+    source = ''.join(source for source, _ in pairs)
+    target = ''.join(target for _, target in pairs)
+    return (
+        f'lower(translate(coalesce({expression}, \'\'), '
+        f'{schema_editor.quote_value(source)}, {schema_editor.quote_value(target)}))'
+    )
+
+
+def install_search_index(schema_editor):
+    table = Book._meta.db_table
+    if schema_editor.connection.vendor == 'postgresql':
+        vector = ' || '.join(
+            f"setweight(to_tsvector('simple'::regconfig, {_postgresql_normalize_sql(schema_editor, field)}), '{weight}')"
+            for field, weight, _ in SEARCH_FIELDS
+        )
+        schema_editor.execute(
+            f'ALTER TABLE "{table}" ADD COLUMN "{POSTGRES_VECTOR_COLUMN}" tsvector '
+            f'GENERATED ALWAYS AS ({vector}) STORED'
+        )
+        schema_editor.execute(
+            f'CREATE INDEX "{POSTGRES_VECTOR_INDEX}" ON "{table}" USING GIN ("{POSTGRES_VECTOR_COLUMN}")'
+        )
+    elif schema_editor.connection.vendor == 'sqlite':
+        columns = ', '.join(field for field, _, _ in SEARCH_FIELDS)
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_FTS_TABLE} USING fts5({columns}, tokenize='unicode61')"
+        )
+        ensure_sqlite_search_index(schema_editor.connection, rebuild=True)
+
+
+def uninstall_search_index(schema_editor):
+    table = Book._meta.db_table
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{POSTGRES_VECTOR_INDEX}"')
+        schema_editor.execute(f'ALTER TABLE "{table}" DROP COLUMN IF EXISTS "{POSTGRES_VECTOR_COLUMN}"')
+    elif schema_editor.connection.vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            for event in ('insert', 'update', 'delete'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_{event}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SQLITE_FTS_TABLE}')
+
+
+def _sqlite_triggers(table):
+    """The CREATE TRIGGER statements keeping the FTS5 table in sync, by name, as sqlite_master stores them."""
+    columns = ', '.join(field for field, _, _ in SEARCH_FIELDS)
+    new_values = ', '.join(f'{SQLITE_NORMALIZE_FUNCTION}(new.{field})' for field, _, _ in SEARCH_FIELDS)
+    insert = f'INSERT INTO {SQLITE_FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values});'
+    delete = f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid = old.id;'
+    # Only the indexed columns: the version bumps of every comment and bookmark
+    # mustn't rewrite the FTS row
+    bodies = {
+        'insert': f'AFTER INSERT ON {table} BEGIN {insert} END',
+        'update': f'AFTER UPDATE OF {columns} ON {table} BEGIN {delete} {insert} END',
+        'delete': f'AFTER DELETE ON {table} BEGIN {delete} END',
+    }
+    return {
+        f'{SQLITE_FTS_TABLE}_{event}': f'CREATE TRIGGER {SQLITE_FTS_TABLE}_{event} {body}' for event, body in bodies.items()
+    }
+
+
+def ensure_sqlite_search_index(connection, rebuild=False):
+    """
+    Create the triggers that keep the FTS5 table in sync with books_book.
+
+    SQLite migrations that alter books_book rebuild the table and drop its triggers,
+    so this runs after every migrate and reindexes when they had to be recreated.
+    Triggers whose definition changed are replaced.
+    """
+    table = Book._meta.db_table
+    triggers = _sqlite_triggers(table)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [SQLITE_FTS_TABLE])
+        if cursor.fetchone() is None:
+            return
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [table])
+        existing = dict(cursor.fetchall())
+        if all(existing.get(name) == sql for name, sql in triggers.items()) and not rebuild:
+            return
+
+        for name, sql in triggers.items():
+            if existing.get(name) != sql:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                cursor.execute(sql)
+        if not rebuild and triggers.keys() <= existing.keys():
+            # Only redefined, the index is in sync
+            return
+
+        columns = ', '.join(field for field, _, _ in SEARCH_FIELDS)
+        values = ', '.join(f'{SQLITE_NORMALIZE_FUNCTION}({field})' for field, _, _ in SEARCH_FIELDS)
+        cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE}')
+        cursor.execute(f'INSERT INTO {SQLITE_FTS_TABLE}(rowid, {columns}) SELECT id, {values} FROM {table}')
@@ -1,6 +1,7 @@
+from django.core.files.storage import default_storage
 from rest_framework import serializers
-from django.db.models import Avg, Count
-from .models import Book, Comment, Bookmark
+from .imaging import VARIANT_FORMATS, variant_name, variant_widths
+from .models import Book, BookStats, Comment, Bookmark
 
 class CommentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -18,28 +19,161 @@ class BookmarkSerializer(serializers.ModelSerializer):
         model = Bookmark
         fields = ['user', 'added_on']
 
+class BulkBookmarkSerializer(serializers.Serializer):
+    MAX_BOOKS = 500
+
+    add = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, default=list)
+    remove = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, default=list)
+
+    def validate(self, data):
+        add, remove = set(data['add']), set(data['remove'])
+        if not add and not remove:
+            raise serializers.ValidationError("Either add or remove must contain book ids.")
+        if len(add) + len(remove) > self.MAX_BOOKS:
+            raise serializers.ValidationError(f"At most {self.MAX_BOOKS} books can be changed at once.")
+        if add & remove:
+            raise serializers.ValidationError("A book can't be both added and removed.")
+        # Drop duplicates but keep the order the client sent
+        data['add'] = list(dict.fromkeys(data['add']))
+        data['remove'] = list(dict.fromkeys(data['remove']))
+        return data
+
 class BookSerializer(serializers.ModelSerializer):
+    # Number of newest comments embedded in the detail view, the rest is paginated
+    # by /books/<pk>/comments/
+    COMMENTS_PREVIEW_SIZE = 5
+
     class Meta:
         model = Book
         fields = ['id', 'title', 'author', 'description', 'published_date', 'cover_image']
 
+    # Fields of the list and search results, and of the detail response. The `fields`,
+    # `exclude` and `expand` query parameters pick among them, see select_fields()
+    LIST_FIELDS = (*Meta.fields, 'cover', 'is_bookmarked', 'total_bookmarks')
+    STATS_FIELDS = ('total_comments', 'total_rating', 'rating_avg', 'rating_dict')
+    DETAIL_FIELDS = (*LIST_FIELDS, *STATS_FIELDS, 'users_actions')
+    # Columns read by the computed fields
+    COVER_COLUMNS = ('cover_image', 'cover_width', 'cover_height', 'cover_placeholder')
+    STATS_COLUMNS = {
+        'total_comments': ('text_count',),
+        'total_rating': tuple(f'rating_{i}' for i in BookStats.RATINGS),
+        'rating_avg': (*(f'rating_{i}' for i in BookStats.RATINGS), 'rating_sum'),
+        'rating_dict': tuple(f'rating_{i}' for i in BookStats.RATINGS),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selected = self.context.get('fields')
+        if self.selected is None:
+            self.selected = set(self.DETAIL_FIELDS if self.context.get('detailed', False) else self.LIST_FIELDS)
+        for name in set(self.fields) - set(self.selected):
+            self.fields.pop(name)
+
+    @classmethod
+    def select_fields(cls, params, detailed=False):
+        """
+        The set of fields asked for by the `fields`, `exclude` and `expand` query
+        parameters. `expand` adds the stats fields to the list and search results.
+        Raises ValueError when a name is unknown.
+        """
+        default = cls.DETAIL_FIELDS if detailed else cls.LIST_FIELDS
+        available = cls.DETAIL_FIELDS if detailed else (*cls.LIST_FIELDS, *cls.STATS_FIELDS)
+        requested = {
+            param: [name.strip() for name in params.get(param, '').split(',') if name.strip()]
+            for param in ('fields', 'exclude', 'expand')
+        }
+        unknown = [name for names in requested.values() for name in names if name not in available]
+        if unknown:
+            raise ValueError(f"Unknown field(s): {', '.join(unknown)}. Available fields: {', '.join(available)}")
+        selected = set(requested['fields'] or default) | set(requested['expand'])
+        return selected - set(requested['exclude'])
+
+    @classmethod
+    def has_stats(cls, fields):
+        return not set(fields).isdisjoint(cls.STATS_FIELDS)
+
+    @classmethod
+    def get_queryset(cls, fields, ordering=('id',)):
+        """
+        Books with only the columns, annotations and joins that `fields` need.
+        `ordering` columns are always loaded, the paginator reads them.
+        """
+        columns = {'id', *ordering, *(name for name in cls.Meta.fields if name in fields)}
+        if 'cover' in fields:
+            columns.update(cls.COVER_COLUMNS)
+        books = Book.objects.all()
+        if 'total_bookmarks' in fields:
+            books = books.with_total_bookmarks()
+        stats_columns = {column for name in fields for column in cls.STATS_COLUMNS.get(name, ())}
+        if stats_columns:
+            books = books.select_related('stats')
+            columns.update(f'stats__{column}' for column in stats_columns)
+        return books.only(*columns)
+
+    @classmethod
+    def users_actions(cls, comments):
+        return comments.order_by('-submitted_on', '-id').values(
+            'user__username', 'text', 'rating', 'submitted_on'
+        )[:cls.COMMENTS_PREVIEW_SIZE]
+
+    def get_cover(self, instance):
+        # Sized variants of the cover, srcset strings per format
+        if not instance.cover_image or not instance.cover_width:
+            return None
+        request = self.context.get('request')
+        name = instance.cover_image.name
+        cover = {
+            'width': instance.cover_width,
+            'height': instance.cover_height,
+            'placeholder': instance.cover_placeholder,
+        }
+        for extension, _, _ in VARIANT_FORMATS:
+            candidates = []
+            for width in variant_widths(instance.cover_width):
+                url = default_storage.url(variant_name(name, width, extension))
+                if request is not None:
+                    url = request.build_absolute_uri(url)
+                candidates.append(f'{url} {width}w')
+            cover[f'srcset_{extension}'] = ', '.join(candidates)
+        return cover
+
     def to_representation(self, instance):
         data = super().to_representation(instance)
-    
-        data['is_bookmarked'] = Bookmark.objects.filter(book=instance, user=self.context.get('request').user).exists()
-        data['total_bookmarks'] = instance.bookmarked_by.count()
-
-        # Check if the 'detailed' context flag is set to True
-        if self.context.get('detailed', False):
-            # Add additional fields for detailed view
-            comments = instance.comments
-            data['total_comments'] = comments.exclude(text=None).count()
-            data['total_rating'] = comments.exclude(rating=0).count()
-            data['rating_avg'] = comments.exclude(rating=0).aggregate(average_rating=Avg('rating'))['average_rating']
-            rating_counts = comments.exclude(rating=0).values('rating').annotate(count=Count('rating')).order_by('rating')
-            rating_dict = {str(i): 0 for i in range(1, 6)}
-            for rating in rating_counts:
-                rating_dict[str(rating['rating'])] = rating['count']
-            data['rating_dict'] = rating_dict
-            data['users_actions'] = comments.values('user__username', 'text', 'rating', 'submitted_on')
+        selected = self.selected
+        if 'cover' in selected:
+            data['cover'] = self.get_cover(instance)
+
+        # Prefer the cached bookmark set and the annotations from
+        # Book.objects.with_bookmark_info() when present
+        if 'is_bookmarked' in selected:
+            if 'bookmarked_ids' in self.context:
+                data['is_bookmarked'] = instance.id in self.context['bookmarked_ids']
+            elif hasattr(instance, 'is_bookmarked'):
+                data['is_bookmarked'] = instance.is_bookmarked
+            else:
+                data['is_bookmarked'] = Bookmark.objects.filter(book=instance, user=self.context.get('request').user).exists()
+        if 'total_bookmarks' in selected:
+            if hasattr(instance, 'total_bookmarks'):
+                data['total_bookmarks'] = instance.total_bookmarks
+            else:
+                data['total_bookmarks'] = instance.bookmarked_by.count()
+
+        # The stats are in the detailed response, and in list results when expanded;
+        # they are read from the maintained stats row
+        if any(name in selected for name in self.STATS_FIELDS):
+            stats = BookStats.for_book(instance)
+            if 'total_comments' in selected:
+                data['total_comments'] = stats.text_count
+            if 'total_rating' in selected:
+                data['total_rating'] = stats.total_rating
+            if 'rating_avg' in selected:
+                data['rating_avg'] = stats.rating_avg
+            if 'rating_dict' in selected:
+                data['rating_dict'] = stats.rating_dict
+        if 'users_actions' in selected:
+            if 'users_actions' in self.context:
+                # Loaded by the caller, e.g. concurrently with the book
+                data['users_actions'] = self.context['users_actions']
+            else:
+                data['users_actions'] = self.users_actions(instance.comments)
         return data
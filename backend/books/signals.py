@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .cache import invalidate_catalog
+from .covers import generate_covers
+from .models import Book, Bookmark, Comment
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def book_changed(sender, **kwargs):
+    invalidate_catalog()
+
+
+@receiver(pre_save, sender=Book)
+def detect_cover_upload(sender, instance, **kwargs):
+    # An uploaded file isn't committed to the storage until the model is saved
+    instance._cover_uploaded = bool(instance.cover_image) and not instance.cover_image._committed
+
+
+@receiver(post_save, sender=Book)
+def generate_uploaded_cover(sender, instance, **kwargs):
+    if getattr(instance, '_cover_uploaded', False):
+        covers = [(instance.pk, instance.cover_image.name)]
+        transaction.on_commit(lambda: generate_covers(covers))
+
+
+@receiver(post_delete, sender=Bookmark)
+@receiver(post_delete, sender=Comment)
+def interaction_deleted(sender, instance, **kwargs):
+    # The API views bump the version themselves; this catches the admin and the
+    # cascades of a deleted user, so incremental related books builds see the book
+    Book.objects.filter(pk=instance.book_id).bump_version()
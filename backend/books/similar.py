@@ -0,0 +1,246 @@
+import json
+import os
+import shutil
+import time
+import zlib
+
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+
+from .models import Book
+from .search import tokenize
+from .utils import advisory_lock, chunks
+
+# Tokens are hashed into this many columns, so books added later need no new vocabulary
+FEATURES = 2 ** 20
+FIELD_WEIGHTS = (('title', 2.0), ('author', 1.0), ('description', 1.0))
+# The whole author name is also a token of its own, books by the same author are close
+AUTHOR_WEIGHT = 3.0
+# Tokens in more than this share of the books say nothing about which are similar
+MAX_DF = 0.5
+# Normalized like the text; ZWNJ splits off the می and ها affixes as separate tokens
+STOPWORDS = frozenset(tokenize(
+    'و در به از که این را با است برای آن یک خود تا کرد بر هم نیز می ها های ای هر او ما اما یا بود شد شده '
+    'کند کنند شود باشد دارد بین پس اگر همه چه وی ان the a an of and in to is'
+))
+CURRENT = 'CURRENT'
+
+
+def term_counts(books):
+    """Hashed, field-weighted token counts of `books`, (title, author, description) tuples, as a CSR matrix."""
+    indptr, indices, data = [0], [], []
+    for book in books:
+        counts = {}
+        for text, (_, weight) in zip(book, FIELD_WEIGHTS):
+            for token in tokenize(text):
+                if token not in STOPWORDS:
+                    column = zlib.crc32(token.encode()) % FEATURES
+                    counts[column] = counts.get(column, 0) + weight
+        author = ' '.join(tokenize(book[1]))
+        if author:
+            column = zlib.crc32(f'author:{author}'.encode()) % FEATURES
+            counts[column] = counts.get(column, 0) + AUTHOR_WEIGHT
+        indices.extend(counts)
+        data.extend(counts.values())
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, FEATURES),
+    )
+
+
+def read_term_counts(books, batch_size):
+    """term_counts() of the `books` queryset, read and tokenized `batch_size` books at a time."""
+    rows = books.order_by('id').values_list('title', 'author', 'description').iterator(chunk_size=batch_size)
+    batches = [term_counts(batch) for batch in chunks(rows, batch_size)]
+    return sparse.vstack(batches, format='csr') if batches else sparse.csr_matrix((0, FEATURES), dtype=np.float32)
+
+
+def tfidf(counts):
+    """L2-normalized rows of sublinear TF times smoothed IDF, computed over all the rows of `counts`."""
+    books = counts.shape[0]
+    df = np.bincount(counts.indices, minlength=FEATURES)
+    idf = (np.log((1 + books) / (1 + df)) + 1).astype(np.float32)
+    idf[df > MAX_DF * books] = 0
+    vectors = counts.copy()
+    vectors.data = (1 + np.log(vectors.data)) * idf[vectors.indices]
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).astype(np.float32) @ vectors
+
+
+def top_k(scores, ids, k):
+    """
+    The `k` best of each row of the dense `scores`, best first, as (ids, scores) arrays
+    of `k` columns. `ids` has the shape of `scores` or broadcasts to it; a score of 0
+    is no neighbour and has id 0.
+    """
+    rows = scores.shape[0]
+    neighbours, best_scores = np.zeros((rows, k), dtype=np.int64), np.zeros((rows, k), dtype=np.float32)
+    columns = min(k, scores.shape[1])
+    if not columns:
+        return neighbours, best_scores
+    best = np.argpartition(-scores, columns - 1, axis=1)[:, :columns]
+    values = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    best, values = np.take_along_axis(best, order, axis=1), np.take_along_axis(values, order, axis=1)
+    found = values > 0
+    neighbours[:, :columns] = np.where(found, np.take_along_axis(np.broadcast_to(ids, scores.shape), best, axis=1), 0)
+    best_scores[:, :columns] = np.where(found, values, 0)
+    return neighbours, best_scores
+
+
+def _similar_rows(block, rows, ids, k):
+    """top_k() of every row of `block`, the sparse similarities of the books at `rows` to all the books."""
+    neighbours, scores = np.zeros((len(rows), k), dtype=np.int64), np.zeros((len(rows), k), dtype=np.float32)
+    for i, row in enumerate(rows):
+        start, end = block.indptr[i], block.indptr[i + 1]
+        columns, values = block.indices[start:end], block.data[start:end]
+        # A book isn't similar to itself
+        values = np.where(columns == row, 0, values)
+        neighbours[i], scores[i] = (array[0] for array in top_k(values[np.newaxis], ids[columns][np.newaxis], k))
+    return neighbours, scores
+
+
+def build(k=20, incremental=False, block_size=1000, batch_size=2000, progress=None):
+    """
+    Write a new generation of the similar books index and publish it. An incremental
+    build only adds the books that aren't in the current index yet: it computes their
+    neighbours and merges them into those of the indexed books. Returns the number of
+    books whose neighbours were computed.
+    """
+    # Two builds at once would both add the same books
+    with advisory_lock('similar books build'):
+        progress = progress or (lambda message: None)
+        index = get_index() if incremental else None
+        if index is not None and index.top_k != k:
+            raise ValueError(f'The index keeps the top {index.top_k} books, rebuild it to change it')
+
+        if index is None:
+            book_ids = np.array(Book.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+            counts = read_term_counts(Book.objects.all(), batch_size)
+            neighbours = np.zeros((0, k), dtype=np.int64)
+            scores = np.zeros((0, k), dtype=np.float32)
+        else:
+            all_ids = np.array(Book.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+            new_ids = np.setdiff1d(all_ids, index.book_ids)
+            if not len(new_ids):
+                return 0
+            new_counts = sparse.vstack([
+                read_term_counts(Book.objects.filter(id__in=chunk), batch_size) for chunk in chunks(new_ids.tolist(), batch_size)
+            ], format='csr')
+            book_ids = np.concatenate([index.book_ids, new_ids])
+            counts = sparse.vstack([index.term_counts(), new_counts], format='csr')
+            # Indexes written before the ids were 64-bit have int32 neighbours
+            neighbours, scores = np.array(index.neighbours, dtype=np.int64), np.array(index.scores)
+        indexed = len(neighbours)
+        progress(f'{len(book_ids) - indexed} books to add to {indexed}')
+
+        # IDF over all the books; the neighbours already indexed keep the scores computed
+        # with the previous one until the next full build
+        vectors = tfidf(counts)
+        # Converted once instead of by every block's product
+        transposed = vectors.T.tocsr()
+        added_neighbours, added_scores = [], []
+        for start in range(indexed, len(book_ids), block_size):
+            rows = np.arange(start, min(start + block_size, len(book_ids)))
+            block = (vectors[rows] @ transposed).tocsr()
+            block_neighbours, block_scores = _similar_rows(block, rows, book_ids, k)
+            added_neighbours.append(block_neighbours)
+            added_scores.append(block_scores)
+            if indexed:
+                # The added books may now be among the best of the indexed ones
+                candidates = block[:, :indexed].T.tocsr()
+                better = np.flatnonzero(candidates.max(axis=1).toarray().ravel() > scores[:, -1])
+                merged_ids = np.concatenate([neighbours[better], np.broadcast_to(book_ids[rows], (len(better), len(rows)))], axis=1)
+                merged_scores = np.concatenate([scores[better], candidates[better].toarray()], axis=1)
+                neighbours[better], scores[better] = top_k(merged_scores, merged_ids, k)
+            progress(f'{rows[-1] + 1 - indexed}/{len(book_ids) - indexed} books')
+
+        neighbours = np.concatenate([neighbours, *added_neighbours])
+        scores = np.concatenate([scores, *added_scores])
+        # Rows stay in id order for SimilarBooksIndex.similar()'s binary search
+        order = np.argsort(book_ids, kind='stable')
+        publish(book_ids[order], counts[order], neighbours[order], scores[order])
+        return len(book_ids) - indexed
+
+
+def publish(book_ids, counts, neighbours, scores):
+    """Write the arrays to a new generation directory and point CURRENT at it."""
+    root = settings.SIMILAR_BOOKS_INDEX
+    generation = str(time.time_ns())
+    path = os.path.join(root, generation)
+    os.makedirs(path)
+    arrays = {
+        'book_ids': book_ids, 'neighbours': neighbours, 'scores': scores,
+        'counts_indptr': counts.indptr, 'counts_indices': counts.indices, 'counts_data': counts.data,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    with open(os.path.join(path, 'index.json'), 'w') as file:
+        json.dump({'books': len(book_ids), 'top_k': neighbours.shape[1], 'features': FEATURES}, file)
+
+    # Replaced in one rename, so workers see either the old or the new generation
+    pointer = os.path.join(root, f'{CURRENT}.{generation}')
+    with open(pointer, 'w') as file:
+        file.write(generation)
+    os.replace(pointer, os.path.join(root, CURRENT))
+
+    # The previous generation is kept for workers that read CURRENT just before the
+    # rename; the mappings of older ones outlive their files
+    generations = sorted((name for name in os.listdir(root) if name.isdigit()), key=int)
+    for name in generations[:-2]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+class SimilarBooksIndex:
+    """
+    A generation of the index. The arrays are memory-mapped, so the worker processes
+    share the page cache's copy instead of each loading its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as file:
+            meta = json.load(file)
+        self.top_k = meta['top_k']
+        self.features = meta['features']
+        self.book_ids = self.load('book_ids')
+        self.neighbours = self.load('neighbours')
+        self.scores = self.load('scores')
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def term_counts(self):
+        return sparse.csr_matrix(
+            (self.load('counts_data'), self.load('counts_indices'), self.load('counts_indptr')),
+            shape=(len(self.book_ids), self.features),
+        )
+
+    def similar(self, book_id, limit):
+        """(id, score) of up to `limit` books closest to `book_id`, best first."""
+        row = np.searchsorted(self.book_ids, book_id)
+        if row == len(self.book_ids) or self.book_ids[row] != book_id:
+            return []
+        found = self.scores[row, :limit] > 0
+        return list(zip(self.neighbours[row, :limit][found].tolist(), self.scores[row, :limit][found].tolist()))
+
+
+_loaded = None
+
+
+def get_index():
+    """The published index, reopened after a build publishes a new one. None before the first build."""
+    global _loaded
+    root = settings.SIMILAR_BOOKS_INDEX
+    try:
+        with open(os.path.join(root, CURRENT)) as file:
+            path = os.path.join(root, file.read().strip())
+    except FileNotFoundError:
+        return None
+    loaded = _loaded
+    if loaded is None or loaded.path != path:
+        loaded = _loaded = SimilarBooksIndex(path)
+    return loaded
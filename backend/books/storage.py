@@ -0,0 +1,66 @@
+import hashlib
+import os
+import posixpath
+import re
+import uuid
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+_hashed_name_re = re.compile(r'(^|/)([0-9a-f]{2})/\2[0-9a-f]{62}\.\w+$')
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def hashed_name(name, digest):
+    """`covers/x.JPG` with content hash `abcd...` -> `covers/ab/abcd....jpg`"""
+    directory = posixpath.dirname(name)
+    extension = posixpath.splitext(name)[1].lower()
+    return posixpath.join(directory, digest[:2], f'{digest}{extension}')
+
+
+def is_hashed_name(name):
+    return bool(_hashed_name_re.search(name or ''))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that names files by the SHA-256 of their content, so a URL
+    always serves the same bytes (and can be cached forever) and saving a file that is
+    already stored reuses it instead of writing a copy.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        return super().save(hashed_name(name, content_hash(content)), content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        # The name identifies the content, an existing file with it is the same file
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            return name
+        # Write under a unique temporary name and move it into place, so concurrent
+        # saves of the same content can't interleave
+        directory, filename = posixpath.split(name)
+        temporary = super()._save(posixpath.join(directory, f'.{uuid.uuid4().hex}.{filename}.tmp'), content)
+        os.replace(self.path(temporary), self.path(name))
+        return name
+
+
+cover_storage = ContentAddressedStorage()
@@ -1,8 +1,58 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from decimal import Decimal
+from unittest import mock
+from unittest import skipUnless
+from django.db import connection
+from django.db.models import F
+from asgiref.sync import async_to_sync
+from django.core.handlers.asgi import ASGIHandler
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+import msgpack
+from rest_framework.renderers import JSONRenderer
+from django.core.management import CommandError, call_command
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from .models import Book, Bookmark, Comment
+from rest_framework.permissions import BasePermission
+from rest_framework.throttling import BaseThrottle
+from rest_framework.views import APIView
+from PIL import Image
+from .models import (
+    Book, BookRanking, BookStats, Bookmark, CatalogLoad, Comment, RankingParameters, RelatedBook, RelatedBooksSource,
+)
+from . import rankings
+from .search import SQLITE_FTS_TABLE, ensure_sqlite_search_index
+from .similar import get_index as get_similar_index
+from .serializers import BookSerializer, CommentSerializer
+from .renderers import ORJSONRenderer
+from .pagination import BookCursorPagination
+from .async_views import AsyncAPIView, AsyncBookCommentsView, AsyncBookDetailView, AsyncBookListView
+from .covers import generate_covers
+from .imaging import variant_name
+from .export import iter_ndjson
+from .loader import iter_json_array
+from .storage import cover_storage, is_hashed_name
+from .cache import (
+    bookmark_cache_stats, bookmark_version, catalog_version, get_bookmarked_ids, invalidate_bookmarks, invalidate_catalog,
+    list_page_cache_stats,
+)
 from django.db.utils import IntegrityError
 
 class BookModelTest(TestCase):
@@ -143,6 +193,7 @@ class BookAPITestCase(APITestCase):
     def setUp(self):
         
         self.user = User.objects.create_user(username='testuser', password='testpass')
+        cache.clear()
         self.client = APIClient()
         response = self.client.post('/auth/token/', {'username': 'testuser', 'password': 'testpass'})
         self.token = response.data['access']
@@ -163,8 +214,8 @@ class BookAPITestCase(APITestCase):
         response = self.client.get(url)
         
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data[0]['author'], self.book.author)
-        self.assertEqual(response.data[0]['is_bookmarked'], True)
+        self.assertEqual(response.data['results'][0]['author'], self.book.author)
+        self.assertEqual(response.data['results'][0]['is_bookmarked'], True)
 
     def test_get_single_book(self):
         """Test retrieving a single book by its ID"""
@@ -236,7 +287,7 @@ class BookAPITestCase(APITestCase):
         self.test_add_comment()
         url = f'/books/list/'
         response = self.client.get(url)
-        self.assertEqual(response.data[0]['is_bookmarked'], False)
+        self.assertEqual(response.data['results'][0]['is_bookmarked'], False)
 
     def test_cant_bookmark_when_have_comment(self):
         """users cant bookmark when have comment on the book"""
@@ -246,4 +297,1850 @@ class BookAPITestCase(APITestCase):
         
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data['message'], 'You have Comment on this book')
-        
\ No newline at end of file
+        
+    def test_list_query_count_is_constant(self):
+        """The book list runs the same number of queries however many books there are"""
+        self.test_bookmark_book()
+        url = f'/books/list/'
+        self.client.get(url)
+        invalidate_catalog()
+        # One query for the annotated books, the user and the bookmark set come
+        # from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 1)
+
+        for i in range(10):
+            book = Book.objects.create(title=f"Book {i}", author="Author Name", published_date="2024-01-01")
+            Bookmark.objects.create(user=self.user, book=book)
+        invalidate_bookmarks(self.user.id)
+        self.client.get(url)
+        invalidate_catalog()
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 11)
+        self.assertTrue(all(book['is_bookmarked'] for book in response.data['results']))
+        self.assertTrue(all(book['total_bookmarks'] == 1 for book in response.data['results']))
+
+
+class BookListPaginationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='pageuser', password='testpass')
+        cache.clear()
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'pageuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+
+        # Duplicate titles make sure the id tiebreaker is honoured
+        for i in range(25):
+            Book.objects.create(
+                title=f"Book {i // 2:02d}",
+                author="Author A" if i % 2 else "Author B",
+                published_date=f"20{10 + i}-01-01",
+            )
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(book['id'] for book in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_pages_cover_catalog_in_order(self):
+        """Following next links returns every book once, ordered by (title, id)"""
+        expected = list(Book.objects.order_by('title', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/books/list/?limit=4'), expected)
+
+    def test_previous_link(self):
+        """The previous link of the second page returns the first page"""
+        first = self.client.get('/books/list/?limit=5')
+        self.assertIsNone(first.data['previous'])
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(
+            [book['id'] for book in back.data['results']],
+            [book['id'] for book in first.data['results']],
+        )
+        self.assertIsNotNone(back.data['next'])
+
+    def test_limit_is_capped(self):
+        """limit can't exceed the paginator's max page size"""
+        with mock.patch.object(BookCursorPagination, 'max_page_size', 10):
+            response = self.client.get('/books/list/?limit=100000')
+        self.assertEqual(len(response.data['results']), 10)
+        response = self.client.get('/books/list/')
+        self.assertEqual(len(response.data['results']), 20)
+
+    def test_invalid_cursor(self):
+        """A tampered cursor is rejected"""
+        response = self.client.get('/books/list/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_filters(self):
+        """author and published_date range filters narrow the pages"""
+        ids = self.walk('/books/list/?limit=3&author=Author A&published_from=2015-01-01&published_to=2025-12-31')
+        expected = Book.objects.filter(
+            author="Author A", published_date__gte="2015-01-01", published_date__lte="2025-12-31",
+        ).order_by('title', 'id').values_list('id', flat=True)
+        self.assertEqual(ids, list(expected))
+
+        response = self.client.get('/books/list/?published_from=yesterday')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BookStatsTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='statsuser', password='testpass')
+        cache.clear()
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'statsuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.book = Book.objects.create(title="Stats Book", author="Author Name", published_date="2024-01-01")
+
+    def add_comment(self, user, text, rating):
+        Comment.objects.create(user=user, book=self.book, text=text, rating=rating)
+        BookStats.record(self.book.id, new=(text, rating))
+
+    def test_detail_reads_stats_row(self):
+        """The detail view serves rating aggregates from BookStats"""
+        for i, (text, rating) in enumerate([("Good", 4), (None, 5), ("Meh", None), ("Bad", 1)]):
+            user = User.objects.create(username=f'reader{i}')
+            self.add_comment(user, text, rating)
+
+        # The ETag version lookup, the book joined with its stats, and the
+        # users_actions preview
+        self.client.get(f'/books/{self.book.id}/')
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/books/{self.book.id}/')
+        self.assertEqual(response.data['total_comments'], 3)
+        self.assertEqual(response.data['total_rating'], 3)
+        self.assertAlmostEqual(response.data['rating_avg'], 10 / 3)
+        self.assertEqual(response.data['rating_dict'], {'1': 1, '2': 0, '3': 0, '4': 1, '5': 1})
+
+    def test_book_without_comments(self):
+        """Books without a stats row report empty aggregates"""
+        response = self.client.get(f'/books/{self.book.id}/')
+        self.assertEqual(response.data['total_comments'], 0)
+        self.assertIsNone(response.data['rating_avg'])
+        self.assertEqual(response.data['rating_dict'], {str(i): 0 for i in range(1, 6)})
+
+    def test_submit_and_edit_comment_update_stats(self):
+        """Editing a comment moves its rating instead of counting it twice"""
+        url = f'/books/comment/{self.book.id}/'
+        self.client.post(url, data={'text': 'First', 'rating': 5})
+        self.client.post(url, data={'text': '', 'rating': 2})
+
+        stats = BookStats.objects.get(book=self.book)
+        self.assertEqual(stats.rating_dict, {'1': 0, '2': 1, '3': 0, '4': 0, '5': 0})
+        self.assertEqual(stats.rating_sum, 2)
+        self.assertEqual(stats.text_count, 0)
+
+        self.client.post(url, data={'text': 'Only text', 'rating': ''})
+        stats.refresh_from_db()
+        self.assertEqual(stats.total_rating, 0)
+        self.assertEqual(stats.rating_sum, 0)
+        self.assertEqual(stats.text_count, 1)
+        expected = BookStats.compute()[self.book.id]
+        self.assertEqual(expected, {field: getattr(stats, field) for field in expected})
+
+    def test_recompute_book_stats_command(self):
+        """recompute_book_stats detects and repairs drift"""
+        self.add_comment(self.user, "Nice", 4)
+        BookStats.objects.filter(book=self.book).update(rating_4=7, rating_sum=28)
+
+        with self.assertRaises(CommandError):
+            call_command('recompute_book_stats', '--check', stdout=StringIO())
+
+        out = StringIO()
+        call_command('recompute_book_stats', stdout=out)
+        self.assertIn(f'Book {self.book.id} drifted', out.getvalue())
+        stats = BookStats.objects.get(book=self.book)
+        self.assertEqual((stats.rating_4, stats.rating_sum, stats.text_count), (1, 4, 1))
+
+        call_command('recompute_book_stats', '--check', stdout=StringIO())
+
+
+class BookCommentsTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='commentsuser', password='testpass')
+        cache.clear()
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'commentsuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.book = Book.objects.create(title="Popular Book", author="Author Name", published_date="2024-01-01")
+        for i in range(12):
+            user = User.objects.create(username=f'commenter{i}')
+            Comment.objects.create(user=user, book=self.book, text=f"Comment {i}", rating=i % 5 + 1)
+        self.newest_first = list(Comment.objects.order_by('-submitted_on', '-id').values_list('id', flat=True))
+
+    def test_comments_pages(self):
+        """Comments are paginated newest first without gaps or repeats"""
+        ids = []
+        url = f'/books/{self.book.id}/comments/?limit=5'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(comment['id'] for comment in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, self.newest_first)
+
+    def test_rating_filter(self):
+        """rating narrows the comments to one star value"""
+        response = self.client.get(f'/books/{self.book.id}/comments/?rating=3')
+        self.assertEqual({comment['rating'] for comment in response.data['results']}, {3})
+        self.assertEqual(len(response.data['results']), Comment.objects.filter(rating=3).count())
+
+        response = self.client.get(f'/books/{self.book.id}/comments/?rating=9')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_missing_book(self):
+        response = self.client.get('/books/999999/comments/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_detail_embeds_newest_comments_only(self):
+        """The detail view keeps a bounded preview of the newest comments"""
+        response = self.client.get(f'/books/{self.book.id}/')
+        preview = response.data['users_actions']
+        self.assertEqual(len(preview), BookSerializer.COMMENTS_PREVIEW_SIZE)
+        comments = Comment.objects.in_bulk(self.newest_first[:BookSerializer.COMMENTS_PREVIEW_SIZE])
+        self.assertEqual(
+            [action['text'] for action in preview],
+            [comments[pk].text for pk in self.newest_first[:BookSerializer.COMMENTS_PREVIEW_SIZE]],
+        )
+
+
+class BookmarkCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        bookmark_cache_stats.reset()
+        self.user = User.objects.create_user(username='cacheuser', password='testpass')
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'cacheuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.books = [
+            Book.objects.create(title=f"Cached Book {i}", author="Author Name", published_date="2024-01-01")
+            for i in range(3)
+        ]
+
+    def test_hits_and_misses(self):
+        """The set is loaded once and then served from the cache"""
+        with self.assertNumQueries(1):
+            self.assertEqual(get_bookmarked_ids(self.user.id), frozenset())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_bookmarked_ids(self.user.id), frozenset())
+        self.assertEqual((bookmark_cache_stats.hits, bookmark_cache_stats.misses), (1, 1))
+
+    def test_toggles_invalidate(self):
+        """Bookmark toggles and comment submission keep the cached set in sync"""
+        book = self.books[0]
+        get_bookmarked_ids(self.user.id)
+
+        self.client.post(f'/books/bookmark/{book.id}/')
+        self.assertEqual(get_bookmarked_ids(self.user.id), {book.id})
+
+        self.client.delete(f'/books/bookmark/{book.id}/')
+        self.assertEqual(get_bookmarked_ids(self.user.id), frozenset())
+
+        self.client.post(f'/books/bookmark/{book.id}/')
+        get_bookmarked_ids(self.user.id)
+        self.client.post(f'/books/comment/{book.id}/', data={'text': 'Read it', 'rating': 4})
+        self.assertEqual(get_bookmarked_ids(self.user.id), frozenset())
+
+    def test_stale_reader_cannot_overwrite(self):
+        """A set loaded before a concurrent write is discarded once the write lands"""
+        book = self.books[1]
+        version = bookmark_version(self.user.id)
+        stale = frozenset(Bookmark.objects.filter(user=self.user).values_list('book_id', flat=True))
+
+        # A writer commits and invalidates while the reader is still loading
+        Bookmark.objects.create(user=self.user, book=book)
+        invalidate_bookmarks(self.user.id)
+
+        # The slow reader stores what it loaded under the version it started with
+        cache.set(f'books:bookmarks:{self.user.id}', (version, stale))
+        self.assertEqual(get_bookmarked_ids(self.user.id), {book.id})
+
+
+
+class BookmarkCacheConcurrencyTest(TestCase):
+    class SlowBookmarkTable:
+        """Stands in for the Bookmark table; reads snapshot the rows and then stall
+        before returning, like a reader that loses the race with a writer."""
+
+        def __init__(self):
+            self.rows = set()
+            self.lock = threading.Lock()
+            self.objects = self
+
+        def filter(self, **kwargs):
+            return self
+
+        def values_list(self, *fields, flat=False):
+            with self.lock:
+                snapshot = set(self.rows)
+            time.sleep(random.random() / 1000)
+            return snapshot
+
+        def toggle(self, book_id, add):
+            with self.lock:
+                (self.rows.add if add else self.rows.discard)(book_id)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_toggles(self):
+        """Interleaved toggles and reads from several threads leave the cache matching the table"""
+        table = self.SlowBookmarkTable()
+        user_id = 1
+        book_ids = range(1, 9)
+        barrier = threading.Barrier(len(book_ids))
+
+        def toggle(book_id):
+            barrier.wait()
+            for i in range(30):
+                table.toggle(book_id, add=i % 2 == 0)
+                invalidate_bookmarks(user_id)
+                get_bookmarked_ids(user_id)
+            table.toggle(book_id, add=book_id % 2 == 0)
+            invalidate_bookmarks(user_id)
+
+        with mock.patch('books.cache.Bookmark', table):
+            with ThreadPoolExecutor(max_workers=len(book_ids)) as executor:
+                list(executor.map(toggle, book_ids))
+            self.assertEqual(get_bookmarked_ids(user_id), {book_id for book_id in book_ids if book_id % 2 == 0})
+
+
+class BookSearchTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='searchuser', password='testpass')
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'searchuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        # Arabic yeh and kaf in the title, as the scraped catalog sometimes has them
+        self.tao = Book.objects.create(
+            title="كتاب تائو تي چينگ", author="لائوتزو", description="کتاب‌های کهن چین", published_date="2017-05-06",
+        )
+        self.other = Book.objects.create(
+            title="نظر به درد دیگران", author="سوزان سونتاگ", description="درباره کتاب عکاسی جنگ", published_date="2020-01-01",
+        )
+
+    def search(self, q):
+        response = self.client.get('/books/search/', {'q': q})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book['id'] for book in response.data['results']]
+
+    def test_persian_normalization(self):
+        """Persian and Arabic yeh/kaf spellings match each other"""
+        self.assertEqual(self.search("تائو تی"), [self.tao.id])
+        self.assertEqual(self.search("لائوتزو"), [self.tao.id])
+
+    def test_zwnj_and_prefix(self):
+        """Words joined with ZWNJ are indexed separately and the last word matches as a prefix"""
+        self.assertEqual(self.search("کهن"), [self.tao.id])
+        self.assertEqual(self.search("سونتا"), [self.other.id])
+
+    def test_ranking(self):
+        """A title match ranks above a description match"""
+        self.assertEqual(self.search("کتاب"), [self.tao.id, self.other.id])
+
+    def test_index_follows_updates(self):
+        """Updated and deleted books are reflected in the index"""
+        self.other.title = "رساله درباره تائو"
+        self.other.save()
+        self.assertEqual(set(self.search("رساله")), {self.other.id})
+        self.other.delete()
+        self.assertEqual(self.search("رساله"), [])
+
+    def test_missing_query(self):
+        response = self.client.get('/books/search/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @skipUnless(connection.vendor == 'sqlite', "the FTS5 triggers are SQLite's")
+    def test_sqlite_update_trigger(self):
+        """An outdated trigger is replaced, and only changes of the indexed columns rewrite the FTS row"""
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {SQLITE_FTS_TABLE}_update')
+            cursor.execute(
+                f'CREATE TRIGGER {SQLITE_FTS_TABLE}_update AFTER UPDATE ON books_book BEGIN '
+                f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid = old.id; END'
+            )
+            ensure_sqlite_search_index(connection)
+            cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s", [f'{SQLITE_FTS_TABLE}_update'])
+            self.assertIn('AFTER UPDATE OF title, author, description ON', cursor.fetchone()[0])
+
+        def changes(**fields):
+            # Counts the rows written by the triggers too
+            before = connection.connection.total_changes
+            Book.objects.filter(pk=self.tao.pk).update(**fields)
+            return connection.connection.total_changes - before
+
+        self.assertEqual(changes(version=F('version') + 1), 1)
+        self.assertGreater(changes(title="رساله تائو"), 1)
+        self.assertEqual(self.search("رساله"), [self.tao.id])
+
+
+class RelatedBooksTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='relateduser', password='testpass')
+        response = self.client.post('/auth/token/', {'username': 'relateduser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.a, self.b, self.c, self.d, self.e, self.f = Book.objects.bulk_create([
+            Book(title=f"Related {name}", author="Author Name", published_date="2024-01-01") for name in 'abcdef'
+        ])
+        r1, r2, r3, r4 = (User.objects.create(username=f'reader{i}') for i in range(4))
+        for user, book in ((r1, self.a), (r1, self.b), (r2, self.a), (r2, self.b), (self.user, self.a), (r4, self.e), (r4, self.f)):
+            Bookmark.objects.create(user=user, book=book)
+        # Ratings below 4 don't count as liking the book
+        for user, book, rating in ((r2, self.c, 5), (r3, self.a, 5), (r3, self.c, 4), (self.user, self.d, 2)):
+            Comment.objects.create(user=user, book=book, text="Comment", rating=rating)
+        self.r1 = r1
+
+    def build(self, *args):
+        out = StringIO()
+        call_command('build_related_books', '--block-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def related(self, book, query=''):
+        response = self.client.get(f'/books/{book.id}/related/{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        return [(item['id'], item['score']) for item in response.data['results']]
+
+    def test_cosine(self):
+        self.assertIn("of 6 book(s)", self.build())
+        # a is liked by 4 readers, b and c by 2, and each pair of them share 2 or 1 readers
+        self.assertEqual(self.related(self.a), [(self.b.id, 0.7071), (self.c.id, 0.7071)])
+        self.assertEqual(self.related(self.b), [(self.a.id, 0.7071), (self.c.id, 0.5)])
+        self.assertEqual(self.related(self.e), [(self.f.id, 1.0)])
+        self.assertEqual(self.related(self.d), [])
+        self.assertEqual(self.related(self.b, '?limit=1'), [(self.a.id, 0.7071)])
+
+    def test_jaccard(self):
+        self.build('--measure', 'jaccard', '--top-k', '1')
+        self.assertEqual(self.related(self.a), [(self.b.id, 0.5)])
+        self.assertEqual(self.related(self.b), [(self.a.id, 0.5)])
+        with self.assertRaises(CommandError):
+            self.build('--incremental', '--measure', 'cosine')
+
+    def test_single_query(self):
+        self.build()
+        url = f'/books/{self.b.id}/related/'
+        self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(set(response.data['results'][0]), {*BookSerializer.LIST_FIELDS, 'score'})
+        with self.assertNumQueries(1):
+            response = self.client.get(url + '?fields=id,title')
+        self.assertEqual(response.data['results'][0], {'id': self.a.id, 'title': "Related a", 'score': 0.7071})
+
+    def test_missing_book(self):
+        response = self.client.get('/books/999999/related/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f'/books/{self.a.id}/related/?fields=nope')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_incremental(self):
+        """Only the rows the new interactions can change are recomputed, to the same result as a full build"""
+        self.build()
+        self.assertIn("of 0 book(s)", self.build('--incremental'))
+
+        self.client.post(f'/books/comment/{self.c.id}/', data={'text': 'Loved it', 'rating': 5})
+        self.client.post(f'/books/bookmark/{self.b.id}/')
+        # Deleted outside the API views, as in the admin
+        Bookmark.objects.filter(user=self.r1, book=self.b).delete()
+        self.assertIn("of 3 book(s)", self.build('--incremental'))
+        incremental = list(RelatedBook.objects.order_by('book', 'rank').values_list('book', 'related', 'rank', 'score'))
+        self.assertEqual(RelatedBooksSource.objects.get(book=self.c).version, Book.objects.get(pk=self.c.pk).version)
+
+        self.build()
+        full = list(RelatedBook.objects.order_by('book', 'rank').values_list('book', 'related', 'rank', 'score'))
+        self.assertEqual(incremental, full)
+        self.assertEqual(self.related(self.b), [(self.c.id, 0.8165), (self.a.id, 0.7071)])
+
+    def test_deleted_user(self):
+        """The bookmarks and comments a deleted user takes with them leave their books touched"""
+        self.build()
+        self.r1.delete()
+        # a and b, and the rows their changes reach
+        self.assertIn("of 3 book(s)", self.build('--incremental'))
+        incremental = list(RelatedBook.objects.order_by('book', 'rank').values_list('book', 'related', 'rank', 'score'))
+        self.build()
+        self.assertEqual(incremental, list(RelatedBook.objects.order_by('book', 'rank').values_list('book', 'related', 'rank', 'score')))
+
+
+class SimilarBooksTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        index = override_settings(SIMILAR_BOOKS_INDEX=directory.name)
+        index.enable()
+        self.addCleanup(index.disable)
+        self.directory = directory.name
+        self.user = User.objects.create_user(username='similaruser', password='testpass')
+        response = self.client.post('/auth/token/', {'username': 'similaruser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        # The second title spells yeh the Arabic way, the third joins its words with ZWNJ
+        self.a, self.b, self.c, self.d, self.e = Book.objects.bulk_create([
+            Book(title="سفر به دریا", author="احمد محمود", description="داستان ماهیگیری در جنوب و دریا", published_date="2024-01-01"),
+            Book(title="دريا و ماهيگير", author="همینگوی", description="پیرمرد ماهیگیر و دریا", published_date="2024-01-01"),
+            Book(title="همسایه‌ها", author="احمد محمود", description="داستان زندگی در اهواز", published_date="2024-01-01"),
+            Book(title="تاریخ ایران", author="عباس اقبال", description="تاریخ دوره قاجار", published_date="2024-01-01"),
+            Book(title="Cooking basics", author="Chef", description="Recipes for the kitchen", published_date="2024-01-01"),
+        ])
+
+    def build(self, *args):
+        out = StringIO()
+        call_command('build_similar_books', '--block-size', '2', '--batch-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def similar(self, book):
+        response = self.client.get(f'/books/{book.id}/similar/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        scores = [item['score'] for item in response.data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        return [item['id'] for item in response.data['results']]
+
+    def test_similar(self):
+        self.assertEqual(self.similar(self.a), [])
+        self.assertIn("of 5 book(s)", self.build())
+        self.assertCountEqual(self.similar(self.a), [self.b.id, self.c.id])
+        self.assertEqual(self.similar(self.b), [self.a.id])
+        self.assertEqual(self.similar(self.c), [self.a.id])
+        self.assertEqual(self.similar(self.e), [])
+
+    def test_single_query(self):
+        self.build()
+        url = f'/books/{self.b.id}/similar/'
+        self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url + '?fields=id,title')
+        self.assertEqual(response.data['results'], [{'id': self.a.id, 'title': "سفر به دریا", 'score': mock.ANY}])
+
+    def test_missing_book(self):
+        self.build()
+        self.assertEqual(self.client.get('/books/999999/similar/').status_code, status.HTTP_404_NOT_FOUND)
+        self.b.delete()
+        self.assertEqual(self.similar(self.a), [self.c.id])
+
+    def test_large_ids(self):
+        """Ids past 32 bits, as a BigAutoField allows, are stored whole"""
+        big = Book.objects.create(
+            id=2 ** 31 + 7, title="دریا", author="احمد محمود", description="ماهیگیری در دریا", published_date="2024-01-01",
+        )
+        self.build()
+        self.assertIn(big.id, self.similar(self.a))
+        self.assertIn(self.a.id, self.similar(big))
+
+    def test_incremental(self):
+        self.build()
+        index = get_similar_index()
+        self.assertIn("of 0 book(s)", self.build('--incremental'))
+        self.assertIs(get_similar_index(), index)
+
+        added = Book.objects.create(title="دریا", author="همینگوی", description="ماهیگیر پیر", published_date="2024-01-01")
+        self.assertIn("of 1 book(s)", self.build('--incremental'))
+        self.assertIsNot(get_similar_index(), index)
+        self.assertEqual(self.similar(added)[0], self.b.id)
+        self.assertEqual(self.similar(self.b)[0], added.id)
+        self.assertEqual(len(get_similar_index().book_ids), 6)
+
+        with self.assertRaises(CommandError):
+            self.build('--incremental', '--top-k', '5')
+        self.build('--top-k', '5')
+        # The generation a worker may still be opening is kept, older ones are removed
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.isdigit()]), 2)
+
+
+class RankingsTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='rankinguser', password='testpass')
+        response = self.client.post('/auth/token/', {'username': 'rankinguser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.a, self.b, self.c = Book.objects.bulk_create([
+            Book(title=f"Ranked {name}", author="Author Name", published_date="2024-01-01") for name in 'abc'
+        ])
+        self.readers = []
+        for i in range(10):
+            reader = APIClient()
+            reader.force_authenticate(User.objects.create(username=f'ranker{i}'))
+            self.readers.append(reader)
+        for reader in self.readers[:2]:
+            reader.post(f'/books/comment/{self.a.id}/', {'rating': 5})
+        for reader in self.readers:
+            reader.post(f'/books/comment/{self.b.id}/', {'text': 'Good', 'rating': 4})
+        for reader in self.readers[:3]:
+            reader.post(f'/books/bookmark/{self.c.id}/')
+
+    def ranking(self, name):
+        response = self.client.get(f'/books/{name}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        return [(item['id'], item['score']) for item in response.data['results']]
+
+    def test_top(self):
+        # Prior of 10 ratings of 3 until the first rebuild
+        self.assertEqual(self.ranking('top'), [(self.b.id, 3.5), (self.a.id, 3.3333)])
+        self.assertIn("Rankings of 3 book(s) rebuilt", self.rebuild())
+        self.assertEqual(BookRanking.objects.filter(top_score__isnull=True).get().book, self.c)
+        self.assertEqual(RankingParameters.objects.get().prior_weight, 6)
+        self.assertEqual(self.ranking('top'), [(self.a.id, 4.375), (self.b.id, 4.0625)])
+        # Writes recompute the score with the rebuilt prior
+        self.readers[2].post(f'/books/comment/{self.a.id}/', {'rating': 1})
+        self.assertEqual(self.ranking('top'), [(self.b.id, 4.0625), (self.a.id, 4.0)])
+
+    def test_trending(self):
+        """A comment counts as 2 bookmarks and activity halves every 3 days"""
+        expected = [(self.b.id, 20), (self.a.id, 4), (self.c.id, 3)]
+        self.assertRankingAlmostEqual(self.ranking('trending'), expected)
+        self.rebuild()
+        self.assertRankingAlmostEqual(self.ranking('trending'), expected)
+
+        Bookmark.objects.filter(book=self.c).update(added_on=timezone.now() - datetime.timedelta(days=6))
+        Comment.objects.filter(book=self.b).update(submitted_on=timezone.now() - datetime.timedelta(days=9))
+        self.rebuild()
+        self.assertRankingAlmostEqual(self.ranking('trending'), [(self.a.id, 4), (self.b.id, 2.5), (self.c.id, 0.75)])
+
+    def test_removed_activity(self):
+        """Removed bookmarks take their activity back, as a rebuild from the remaining rows would"""
+        self.readers[3].post(f'/books/bookmark/{self.a.id}/')
+        self.readers[3].delete(f'/books/bookmark/{self.a.id}/')
+        self.readers[4].post('/books/bookmark/bulk/', {'add': [self.a.id, self.c.id]}, format='json')
+        self.readers[4].post('/books/bookmark/bulk/', {'remove': [self.c.id]}, format='json')
+        # Commenting replaces the bookmark
+        self.readers[4].post(f'/books/comment/{self.a.id}/', {'text': 'Read it'})
+        self.readers[0].post(f'/books/comment/{self.c.id}/', {'text': 'Read it'})
+        expected = [(self.b.id, 20), (self.a.id, 6), (self.c.id, 4)]
+        self.assertRankingAlmostEqual(self.ranking('trending'), expected)
+        self.rebuild()
+        self.assertRankingAlmostEqual(self.ranking('trending'), expected)
+
+        for reader in self.readers[:3]:
+            reader.delete(f'/books/bookmark/{self.c.id}/')
+        Comment.objects.filter(book=self.c).delete()
+        self.rebuild()
+        self.assertEqual([book_id for book_id, _ in self.ranking('trending')], [self.b.id, self.a.id])
+
+    def test_racing_bookmark_delete(self):
+        """Of two DELETEs of the same bookmark only the one that deleted it takes its activity back"""
+        remove = Bookmark.remove
+        url = f'/books/bookmark/{self.c.id}/'
+
+        def raced(user_id, book_ids):
+            # The other request deletes the bookmark first
+            if not raced.done:
+                raced.done = True
+                self.assertEqual(self.readers[0].delete(url).status_code, status.HTTP_204_NO_CONTENT)
+            return remove(user_id, book_ids)
+
+        raced.done = False
+        with mock.patch.object(Bookmark, 'remove', raced):
+            self.assertEqual(self.readers[0].delete(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertRankingAlmostEqual(self.ranking('trending'), [(self.b.id, 20), (self.a.id, 4), (self.c.id, 2)])
+
+    def test_missing_parameters(self):
+        """Writes recreate the parameters row with the defaults instead of recording nothing"""
+        RankingParameters.objects.all().delete()
+        self.readers[3].post(f'/books/bookmark/{self.a.id}/')
+        self.assertEqual(RankingParameters.objects.get().pk, RankingParameters.ID)
+        self.assertRankingAlmostEqual(self.ranking('trending'), [(self.b.id, 20), (self.a.id, 5), (self.c.id, 3)])
+        self.rebuild()
+        self.assertEqual(RankingParameters.objects.get().pk, RankingParameters.ID)
+
+    def test_concurrent_write(self):
+        """Activity recorded while a rebuild runs is kept, not overwritten by its snapshot"""
+        snapshot = rankings._snapshot
+
+        def write_after(*args):
+            result = snapshot(*args)
+            self.readers[3].post(f'/books/bookmark/{self.a.id}/')
+            return result
+
+        with mock.patch.object(rankings, '_snapshot', write_after):
+            self.rebuild()
+        expected = [(self.b.id, 20), (self.a.id, 5), (self.c.id, 3)]
+        self.assertRankingAlmostEqual(self.ranking('trending'), expected)
+        self.rebuild()
+        self.assertRankingAlmostEqual(self.ranking('trending'), expected)
+
+    def test_epoch(self):
+        """An old epoch moves to now and the stored scores are rescaled to it"""
+        epoch = time.time() - rankings.EPOCH_MAX_AGE - 3600
+        factor = 2 ** ((RankingParameters.load().trending_epoch - epoch) / BookRanking.TRENDING_HALF_LIFE)
+        RankingParameters.objects.update(trending_epoch=epoch)
+        BookRanking.objects.update(trending_score=F('trending_score') * factor)
+        self.rebuild()
+        self.assertGreater(RankingParameters.objects.get().trending_epoch, epoch + rankings.EPOCH_MAX_AGE)
+        self.assertRankingAlmostEqual(self.ranking('trending'), [(self.b.id, 20), (self.a.id, 4), (self.c.id, 3)])
+        self.assertAlmostEqual(BookRanking.objects.get(book=self.c).trending_score, 3, places=2)
+
+    def test_single_query(self):
+        self.client.get('/books/top/')
+        for name in ('top', 'trending'):
+            with self.assertNumQueries(1):
+                response = self.client.get(f'/books/{name}/?fields=id&limit=1')
+            self.assertEqual(set(response.data['results'][0]), {'id', 'score'})
+        self.assertEqual(self.client.get('/books/top/?fields=nope').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def rebuild(self):
+        out = StringIO()
+        call_command('rebuild_rankings', '--batch-size', '4', stdout=out)
+        return out.getvalue()
+
+    def assertRankingAlmostEqual(self, ranking, expected):
+        self.assertEqual([book_id for book_id, _ in ranking], [book_id for book_id, _ in expected])
+        for (_, score), (_, want) in zip(ranking, expected):
+            self.assertAlmostEqual(score, want, places=2)
+
+
+class SparseFieldsetTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='fieldsuser', password='testpass')
+        response = self.client.post('/auth/token/', {'username': 'fieldsuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.book = Book.objects.create(title="Fields Book", author="Author Name", description="Long text", published_date="2024-01-01")
+        Bookmark.objects.create(user=User.objects.create(username='bookmarker'), book=self.book)
+        for i, rating in enumerate([4, 5]):
+            Comment.upsert(User.objects.create(username=f'fields{i}').id, self.book.id, f"Comment {i}", rating, timezone.now())
+            BookStats.record(self.book.id, new=(f"Comment {i}", rating))
+
+    def get(self, url, queries):
+        # Warm up the user and bookmark caches, drop the shared list pages, then count
+        # what the response itself costs
+        self.client.get(url)
+        invalidate_catalog()
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertEqual(len(captured), queries, '\n'.join(query['sql'] for query in captured))
+        return response, ' '.join(query['sql'] for query in captured)
+
+    def test_list(self):
+        response, sql = self.get('/books/list/', 1)
+        self.assertEqual(set(response.data['results'][0]), set(BookSerializer.LIST_FIELDS))
+        self.assertIn('"books_bookmark"', sql)
+        self.assertIn('"description"', sql)
+
+        response, sql = self.get('/books/list/?fields=id,title', 1)
+        self.assertEqual(response.data['results'][0], {'id': self.book.id, 'title': "Fields Book"})
+        self.assertNotIn('"books_bookmark"', sql)
+        self.assertNotIn('"description"', sql)
+        self.assertNotIn('"cover_placeholder"', sql)
+
+        response, sql = self.get('/books/list/?exclude=description,total_bookmarks,cover', 1)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title', 'author', 'published_date', 'cover_image', 'is_bookmarked'})
+        self.assertNotIn('"books_bookmark"', sql)
+        self.assertNotIn('"description"', sql)
+
+        response, sql = self.get('/books/list/?fields=title&expand=rating_avg,total_comments', 1)
+        self.assertEqual(response.data['results'][0], {'title': "Fields Book", 'total_comments': 2, 'rating_avg': 4.5})
+        self.assertIn('"books_bookstats"."rating_sum"', sql)
+        self.assertNotIn('"books_bookmark"', sql)
+
+    def test_list_pages_without_title(self):
+        """The cursor columns are loaded even when they aren't returned"""
+        Book.objects.create(title="Another Book", author="Author Name", published_date="2024-01-01")
+        response, _ = self.get('/books/list/?fields=id&limit=1', 1)
+        next_page, _ = self.get(response.data['next'].replace('http://testserver', ''), 1)
+        self.assertEqual(next_page.data['results'], [{'id': self.book.id}])
+
+    def test_detail(self):
+        url = f'/books/{self.book.id}/'
+        # The ETag version lookup, the book joined with its stats, and the users_actions preview
+        response, sql = self.get(url, 3)
+        self.assertEqual(set(response.data), set(BookSerializer.DETAIL_FIELDS))
+
+        response, sql = self.get(f'{url}?fields=title,rating_avg', 2)
+        self.assertEqual(response.data, {'title': "Fields Book", 'rating_avg': 4.5})
+        self.assertNotIn('"books_bookmark"', sql)
+        self.assertNotIn('"books_comment"', sql)
+        self.assertNotIn('"books_bookstats"."text_count"', sql)
+
+        response, sql = self.get(f'{url}?exclude=users_actions,rating_dict,total_rating,total_comments,rating_avg', 2)
+        self.assertEqual(response.data['total_bookmarks'], 1)
+        self.assertNotIn('"books_bookstats"', sql)
+        self.assertNotIn('"books_comment"', sql)
+
+        response, sql = self.get(f'{url}?fields=users_actions', 3)
+        self.assertEqual(len(response.data['users_actions']), 2)
+        self.assertNotIn('"books_bookstats"', sql)
+
+    def test_search(self):
+        response = self.client.get('/books/search/?q=fields&fields=id,title')
+        self.assertEqual(response.data['results'], [{'id': self.book.id, 'title': "Fields Book"}])
+        response = self.client.get('/books/search/?q=fields&expand=total_comments&exclude=description')
+        self.assertEqual(response.data['results'][0]['total_comments'], 2)
+        self.assertNotIn('description', response.data['results'][0])
+
+    def test_unknown_field(self):
+        for url in ('/books/list/?fields=title,secret', f'/books/{self.book.id}/?exclude=secret',
+                    '/books/list/?expand=users_actions', '/books/search/?q=fields&fields=secret'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, url)
+            self.assertIn('Unknown field(s)', response.data['error'])
+
+
+class RenderersTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='renderuser', password='testpass')
+        response = self.client.post('/auth/token/', {'username': 'renderuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.book = Book.objects.create(title="کتاب\u2028 Render", author="نویسنده", description="\u2029", published_date="2024-01-01")
+        for i, rating in enumerate([4, 5, None]):
+            Comment.upsert(User.objects.create(username=f'render{i}').id, self.book.id, f"نظر {i}", rating,
+                           timezone.now() - datetime.timedelta(microseconds=i * 1001))
+            BookStats.record(self.book.id, new=(f"نظر {i}", rating))
+
+    def test_same_bytes_as_json_renderer(self):
+        for url in ('/books/list/', f'/books/{self.book.id}/', f'/books/{self.book.id}/comments/', '/books/999999/'):
+            response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertEqual(response.content, JSONRenderer().render(response.data), url)
+        self.assertIn(b'\\u2028 Render', self.client.get('/books/list/').content)
+
+        tehran = datetime.timezone(datetime.timedelta(hours=3, minutes=30))
+        data = {
+            'text': 'متن \u2028 "quoted" \\ \u2029',
+            'when': datetime.datetime(2024, 1, 2, 3, 4, 5, 6007, tzinfo=datetime.timezone.utc),
+            'local': datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=tehran),
+            'naive': datetime.datetime(2024, 1, 2, 3, 4, 5),
+            'date': datetime.date(2024, 1, 2),
+            'decimal': Decimal('4.50'),
+            'lazy': gettext_lazy('Book'),
+            'floats': [10 / 3, 0.1, 4.0, -1.5],
+            'keys': {1: 'one', 'two': None, 'nested': (True, False)},
+            'comments': Comment.objects.order_by('id').values('text', 'rating', 'submitted_on'),
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            ORJSONRenderer().render(data, 'application/json; indent=4'), JSONRenderer().render(data, 'application/json; indent=4'),
+        )
+        self.assertEqual(ORJSONRenderer().render({'big': 2 ** 70}), JSONRenderer().render({'big': 2 ** 70}))
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+    def test_msgpack(self):
+        for url in ('/books/list/', f'/books/{self.book.id}/', f'/books/{self.book.id}/comments/'):
+            expected = self.client.get(url)
+            response = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            self.assertEqual(msgpack.unpackb(response.content), json.loads(expected.content), url)
+            if expected.has_header('ETag'):
+                # Cached per format
+                self.assertNotEqual(response['ETag'], expected['ETag'])
+
+
+class ListPageCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        list_page_cache_stats.reset()
+        self.books = [
+            Book.objects.create(title=f"Cached Book {i}", author="Author Name", published_date="2024-01-01")
+            for i in range(3)
+        ]
+        self.clients = {}
+        for name in ('reader', 'other'):
+            User.objects.create_user(username=name, password='testpass')
+            client = APIClient()
+            response = client.post('/auth/token/', {'username': name, 'password': 'testpass'})
+            client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+            self.clients[name] = client
+        self.reader, self.other = self.clients['reader'], self.clients['other']
+        self.reader.post(f'/books/bookmark/{self.books[1].id}/')
+        for client in self.clients.values():
+            # Warm up the user and bookmark caches
+            client.get(f'/books/{self.books[0].id}/')
+
+    def results(self, response):
+        return {book['title']: (book['is_bookmarked'], book['total_bookmarks']) for book in response.data['results']}
+
+    def test_shared_between_users(self):
+        with self.assertNumQueries(1):
+            response = self.reader.get('/books/list/')
+        self.assertEqual(self.results(response)["Cached Book 1"], (True, 1))
+        with self.assertNumQueries(0):
+            response = self.other.get('/books/list/')
+        self.assertEqual(self.results(response)["Cached Book 1"], (False, 1))
+        with self.assertNumQueries(0):
+            cached = self.reader.get('/books/list/')
+        self.assertEqual(self.results(cached)["Cached Book 1"], (True, 1))
+        self.assertEqual((list_page_cache_stats.hits, list_page_cache_stats.misses), (2, 1))
+
+        # Same bytes as a page built for this request
+        invalidate_catalog()
+        self.assertEqual(self.reader.get('/books/list/').content, cached.content)
+
+    def test_keyed_by_query(self):
+        self.reader.get('/books/list/?limit=1')
+        response = self.reader.get('/books/list/?limit=2')
+        self.assertEqual(len(response.data['results']), 2)
+        page = self.reader.get(response.data['next'].replace('http://testserver', ''))
+        self.assertEqual([book['title'] for book in page.data['results']], ["Cached Book 2"])
+        response = self.reader.get('/books/list/?limit=2', HTTP_HOST='books.ir')
+        self.assertTrue(response.data['next'].startswith('http://books.ir/'))
+        self.assertEqual(list_page_cache_stats.hits, 0)
+
+    def test_invalidation(self):
+        self.reader.get('/books/list/')
+        self.other.post(f'/books/bookmark/{self.books[1].id}/')
+        self.assertEqual(self.results(self.reader.get('/books/list/'))["Cached Book 1"], (True, 2))
+
+        book = self.books[0]
+        book.title = "Renamed Book"
+        book.save()
+        self.assertIn("Renamed Book", self.results(self.reader.get('/books/list/')))
+        self.books[2].delete()
+        self.assertNotIn("Cached Book 2", self.results(self.reader.get('/books/list/')))
+        self.assertEqual(list_page_cache_stats.hits, 0)
+
+    def test_stats_pages(self):
+        self.reader.get('/books/list/')
+        response = self.reader.get('/books/list/?expand=total_comments')
+        self.assertEqual(response.data['results'][0]['total_comments'], 0)
+        etag = response['ETag']
+
+        self.other.post(f'/books/comment/{self.books[2].id}/', {'text': "Nice", 'rating': 4})
+        with self.assertNumQueries(0):
+            self.reader.get('/books/list/')
+        response = self.reader.get('/books/list/?expand=total_comments', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({book['title']: book['total_comments'] for book in response.data['results']}["Cached Book 2"], 1)
+
+    def test_hit_ratio_metrics(self):
+        self.reader.get('/books/list/')
+        self.other.get('/books/list/')
+        self.assertEqual(list_page_cache_stats.ratio, 0.5)
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('books_cache_requests_total{cache="list_pages",result="hit"}', body)
+        self.assertIn('books_cache_requests_total{cache="bookmarks",result="miss"}', body)
+
+
+class ConditionalGetTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='etaguser', password='testpass')
+        self.other = User.objects.create_user(username='etagother', password='testpass')
+        self.client = self.client_for('etaguser')
+        self.other_client = self.client_for('etagother')
+        self.book = Book.objects.create(title="ETag Book", author="Author Name", published_date="2024-01-01")
+        self.list_url = '/books/list/'
+        self.detail_url = f'/books/{self.book.id}/'
+
+    def client_for(self, username):
+        client = APIClient()
+        response = client.post('/auth/token/', {'username': username, 'password': 'testpass'})
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        return client
+
+    def etags(self):
+        return self.client.get(self.list_url)['ETag'], self.client.get(self.detail_url)['ETag']
+
+    def assertNotModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def assertModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_not_modified_skips_the_view(self):
+        """A matching If-None-Match is answered without serializing"""
+        list_etag, detail_etag = self.etags()
+        # The list needs no query at all
+        with self.assertNumQueries(0):
+            self.assertNotModified(self.list_url, list_etag)
+        # Only the book's version
+        with self.assertNumQueries(1):
+            self.assertNotModified(self.detail_url, detail_etag)
+
+    def test_own_bookmark_invalidates(self):
+        list_etag, detail_etag = self.etags()
+        self.client.post(f'/books/bookmark/{self.book.id}/')
+        self.assertModified(self.list_url, list_etag)
+        self.assertModified(self.detail_url, detail_etag)
+
+    def test_other_users_bookmark_invalidates(self):
+        """total_bookmarks changes when anyone bookmarks"""
+        list_etag, detail_etag = self.etags()
+        self.other_client.post(f'/books/bookmark/{self.book.id}/')
+        self.assertModified(self.list_url, list_etag)
+        self.assertModified(self.detail_url, detail_etag)
+
+        list_etag, detail_etag = self.etags()
+        self.other_client.delete(f'/books/bookmark/{self.book.id}/')
+        self.assertModified(self.list_url, list_etag)
+        self.assertModified(self.detail_url, detail_etag)
+
+    def test_comment_invalidates_detail_only(self):
+        """Comments change the detail aggregates but not the list"""
+        list_etag, detail_etag = self.etags()
+        self.other_client.post(f'/books/comment/{self.book.id}/', data={'text': 'Nice', 'rating': 5})
+        self.assertNotModified(self.list_url, list_etag)
+        self.assertModified(self.detail_url, detail_etag)
+
+        detail_etag = self.client.get(self.detail_url)['ETag']
+        self.other_client.post(f'/books/comment/{self.book.id}/', data={'text': 'Changed my mind', 'rating': 2})
+        self.assertModified(self.detail_url, detail_etag)
+
+    def test_book_changes_invalidate(self):
+        list_etag, detail_etag = self.etags()
+        self.book.title = "Renamed ETag Book"
+        self.book.save()
+        self.assertModified(self.list_url, list_etag)
+        self.assertModified(self.detail_url, detail_etag)
+
+        list_etag = self.client.get(self.list_url)['ETag']
+        Book.objects.create(title="Another ETag Book", author="Author Name", published_date="2024-01-01")
+        self.assertModified(self.list_url, list_etag)
+
+    def test_etag_depends_on_user_and_query(self):
+        list_etag, detail_etag = self.etags()
+        self.assertNotEqual(self.other_client.get(self.list_url)['ETag'], list_etag)
+        self.assertNotEqual(self.client.get(self.list_url + '?limit=5')['ETag'], list_etag)
+
+
+class BulkBookmarkTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.books = [
+            Book.objects.create(title=f"Bulk Book {i}", author="Author Name", published_date="2024-01-01")
+            for i in range(4)
+        ]
+        self.missing_id = self.books[-1].id + 100
+        self.single_user, self.single_client = self.user_with_client('single')
+        self.bulk_user, self.bulk_client = self.user_with_client('bulk')
+        for user in (self.single_user, self.bulk_user):
+            Bookmark.objects.create(user=user, book=self.books[0])
+            Comment.objects.create(user=user, book=self.books[1], text="Read it")
+
+    def user_with_client(self, username):
+        user = User.objects.create_user(username=username, password='testpass')
+        client = APIClient()
+        response = client.post('/auth/token/', {'username': username, 'password': 'testpass'})
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        return user, client
+
+    def assertMatchesSingle(self, results, method, ids):
+        for book_id in ids:
+            single = getattr(self.single_client, method)(f'/books/bookmark/{book_id}/')
+            self.assertEqual(results[str(book_id)]['status'], single.status_code, book_id)
+            if single.data and 'message' in single.data:
+                self.assertEqual(results[str(book_id)]['message'], single.data['message'])
+
+    def test_add_matches_single_endpoint(self):
+        """Each id gets the outcome the single-book endpoint gives"""
+        ids = [book.id for book in self.books] + [self.missing_id]
+        response = self.bulk_client.post('/books/bookmark/bulk/', {'add': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertMatchesSingle(response.data['results'], 'post', ids)
+        self.assertEqual(
+            set(Bookmark.objects.filter(user=self.bulk_user).values_list('book_id', flat=True)),
+            {self.books[0].id, self.books[2].id, self.books[3].id},
+        )
+
+    def test_remove_matches_single_endpoint(self):
+        ids = [self.books[0].id, self.books[2].id, self.missing_id]
+        response = self.bulk_client.post('/books/bookmark/bulk/', {'remove': ids}, format='json')
+        self.assertMatchesSingle(response.data['results'], 'delete', ids)
+        self.assertFalse(Bookmark.objects.filter(user=self.bulk_user).exists())
+
+    def test_query_count_is_constant(self):
+        """The number of queries doesn't grow with the number of books"""
+        books = [
+            Book.objects.create(title=f"Extra Bulk Book {i}", author="Author Name", published_date="2024-01-01")
+            for i in range(30)
+        ]
+        ids = [book.id for book in books]
+        # Auth, savepoint, books, comments, bookmarks, insert, version bump, rankings, release
+        with self.assertNumQueries(9):
+            response = self.bulk_client.post('/books/bookmark/bulk/', {'add': ids}, format='json')
+        self.assertTrue(all(result['status'] == 201 for result in response.data['results'].values()))
+
+    def test_caches_and_versions_follow(self):
+        """Bulk writes invalidate the bookmark set and book versions like single toggles"""
+        self.assertEqual(get_bookmarked_ids(self.bulk_user.id), {self.books[0].id})
+        version = Book.objects.get(pk=self.books[2].id).version
+        self.bulk_client.post('/books/bookmark/bulk/', {'add': [self.books[2].id]}, format='json')
+        self.assertEqual(get_bookmarked_ids(self.bulk_user.id), {self.books[0].id, self.books[2].id})
+        self.assertEqual(Book.objects.get(pk=self.books[2].id).version, version + 1)
+
+    def test_validation(self):
+        url = '/books/bookmark/bulk/'
+        self.assertEqual(self.bulk_client.post(url, {}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.bulk_client.post(url, {'add': [1], 'remove': [1]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.bulk_client.post(url, {'add': list(range(1, 502))}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.bulk_client.post(url, {'add': ['abc']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CatalogExportTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username='exportadmin', password='testpass', is_staff=True)
+        self.user = User.objects.create_user(username='exportuser', password='testpass')
+        self.book = Book.objects.create(title="Exported Book", author="Author Name", published_date="2024-01-01")
+        Bookmark.objects.create(user=self.admin, book=self.book)
+        Comment.objects.create(user=self.user, book=self.book, text="Good", rating=4)
+        BookStats.record(self.book.id, new=("Good", 4))
+
+    def client_for(self, username):
+        client = APIClient()
+        response = client.post('/auth/token/', {'username': username, 'password': 'testpass'})
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        return client
+
+    def create_books(self, count):
+        Book.objects.bulk_create([
+            Book(title=f"Bulk {i}", author="Author Name", description="x" * 500, published_date="2024-01-01")
+            for i in range(count)
+        ])
+
+    def test_staff_only(self):
+        response = self.client_for('exportuser').get('/books/export/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_stream(self):
+        """Every book is exported as one NDJSON line with its aggregates"""
+        self.create_books(5)
+        response = self.client_for('exportadmin').get('/books/export/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertTrue(response['Content-Type'].startswith('application/x-ndjson'))
+        records = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([record['id'] for record in records], list(Book.objects.order_by('id').values_list('id', flat=True)))
+        exported = records[0]
+        self.assertEqual(exported['title'], "Exported Book")
+        self.assertEqual(exported['total_bookmarks'], 1)
+        self.assertEqual(exported['rating_avg'], 4)
+        self.assertEqual(exported['rating_dict']['4'], 1)
+
+    def test_asgi_stream(self):
+        """Under ASGI the blocks come from an async iterator, a sync one would be read whole first"""
+        self.create_books(5)
+        response = self.client_for('exportadmin').get('/books/export/')
+        expected = b''.join(response.streaming_content)
+        self.assertFalse(response.is_async)
+        token = self.client.post('/auth/token/', {'username': 'exportadmin', 'password': 'testpass'}).data['access']
+
+        async def export():
+            response = await AsyncClient().get('/books/export/', headers={'authorization': f'Bearer {token}'})
+            return response, [block async for block in response.streaming_content]
+
+        response, blocks = async_to_sync(export)()
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join(blocks), expected)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.ndjson')
+            call_command('export_catalog', '--output', path, '--chunk-size', '2')
+            with open(path, encoding='utf-8') as exported:
+                self.assertEqual(json.loads(exported.readline())['title'], "Exported Book")
+
+    def peak_memory(self, chunk_size):
+        tracemalloc.start()
+        try:
+            for _ in iter_ndjson(chunk_size):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_stays_flat(self):
+        """Peak memory depends on the chunk size, not on the catalog size"""
+        self.create_books(300)
+        small = self.peak_memory(chunk_size=100)
+        self.create_books(2700)
+        large = self.peak_memory(chunk_size=100)
+        self.assertLess(large, small * 1.5)
+
+
+class LoadCatalogTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, records, ndjson=False):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            if ndjson:
+                file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            else:
+                json.dump(records, file, indent=4, ensure_ascii=False)
+        return path
+
+    def fixture(self, count, title="Book"):
+        return [
+            {
+                "model": "books.book",
+                "pk": pk,
+                "fields": {
+                    "title": f"{title} {pk}",
+                    "description": "توضیحات",
+                    "published_date": "2017-05-06",
+                    "cover_image": f"covers/{pk}.jpg",
+                    "author": "نویسنده",
+                },
+            }
+            for pk in range(1, count + 1)
+        ]
+
+    def load(self, path, *args):
+        out = StringIO()
+        call_command('load_catalog', path, '--batch-size', '3', '--skip-covers', *args, stdout=out)
+        return out.getvalue()
+
+    def test_load_fixture(self):
+        path = self.write('books.json', self.fixture(10))
+        self.assertIn("10 created", self.load(path))
+        book = Book.objects.get(pk=7)
+        self.assertEqual(book.title, "Book 7")
+        self.assertEqual(book.cover_image.name, "covers/7.jpg")
+        self.assertEqual(str(book.published_date), "2017-05-06")
+        self.assertEqual(CatalogLoad.objects.get().books, 10)
+        # New books get ids after the loaded ones
+        self.assertEqual(Book.objects.create(title="New", author="A", published_date="2024-01-01").pk, 11)
+
+    def test_unchanged_file_is_skipped(self):
+        path = self.write('books.json', self.fixture(10))
+        self.load(path)
+        with self.assertNumQueries(1):
+            self.assertIn("unchanged since it was last loaded", self.load(path))
+
+    def test_upsert(self):
+        """Changed books are updated in place, unchanged ones aren't written"""
+        self.load(self.write('books.json', self.fixture(5)))
+        Bookmark.objects.create(user=User.objects.create(username='reader'), book_id=2)
+        version = catalog_version()
+        records = self.fixture(6)
+        records[1]["fields"]["title"] = "Renamed"
+        output = self.load(self.write('books.json', records))
+        self.assertIn("1 created, 1 updated, 4 unchanged", output)
+        self.assertEqual(Book.objects.get(pk=2).title, "Renamed")
+        self.assertEqual(Book.objects.get(pk=2).version, 1)
+        self.assertEqual(Book.objects.get(pk=3).version, 0)
+        self.assertEqual(Bookmark.objects.get().book_id, 2)
+        self.assertNotEqual(catalog_version(), version)
+
+    def test_load_ndjson_export(self):
+        Book.objects.create(title="Exported", author="Author", published_date="2024-01-01", cover_image="covers/x.jpg")
+        path = os.path.join(self.directory.name, 'catalog.ndjson')
+        call_command('export_catalog', '--output', path)
+        Book.objects.all().delete()
+        self.assertIn("1 created", self.load(path))
+        book = Book.objects.get()
+        self.assertEqual(book.title, "Exported")
+        self.assertEqual(book.cover_image.name, "covers/x.jpg")
+
+    def test_invalid_file(self):
+        records = self.fixture(2)
+        del records[1]["fields"]["title"]
+        with self.assertRaises(CommandError):
+            self.load(self.write('books.json', records))
+        self.assertFalse(Book.objects.exists())
+        self.assertFalse(CatalogLoad.objects.exists())
+
+    def test_json_array_spanning_reads(self):
+        """Items split across read blocks are parsed whole"""
+        records = self.fixture(3000)
+        with open(self.write('books.json', records), encoding='utf-8') as file:
+            self.assertEqual(list(iter_json_array(file)), records)
+
+
+class GenerateDatasetTest(TestCase):
+    def generate(self, *args):
+        out = StringIO()
+        call_command(
+            'generate_dataset', '--books', '200', '--users', '50', '--comments', '2000', '--bookmarks', '300',
+            '--batch-size', '64', '--password', 'x', *args, stdout=out,
+        )
+        return out.getvalue()
+
+    def test_generate(self):
+        self.assertIn("50 users, 200 books", self.generate())
+        self.assertEqual(User.objects.filter(username__startswith='reader').count(), 50)
+        self.assertEqual(Book.objects.count(), 200)
+        # The most popular books are capped at one comment or bookmark per user
+        self.assertGreater(Comment.objects.count(), 1000)
+        self.assertGreater(Bookmark.objects.count(), 100)
+        comments = set(Comment.objects.values_list('user_id', 'book_id'))
+        self.assertFalse(comments & set(Bookmark.objects.values_list('user_id', 'book_id')))
+        self.assertTrue(Comment.objects.filter(rating__isnull=True).exists())
+        self.assertTrue(Comment.objects.filter(text__isnull=True).exists())
+        self.assertFalse(Comment.objects.filter(text__isnull=True, rating__isnull=True).exists())
+        # Stats match the comments
+        call_command('recompute_book_stats', '--check', stdout=StringIO())
+
+        counts = sorted(BookStats.compute().values(), key=lambda row: row['text_count'], reverse=True)
+        top = sum(row['text_count'] for row in counts[:20])
+        self.assertGreater(top, sum(row['text_count'] for row in counts) / 2)
+
+    def test_existing_prefix(self):
+        self.generate()
+        with self.assertRaises(CommandError):
+            self.generate()
+        self.assertEqual(Book.objects.count(), 200)
+        self.assertIn("50 users", self.generate('--prefix', 'other'))
+        self.assertEqual(Book.objects.count(), 400)
+
+
+class BootCommandTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.catalog = os.path.join(self.directory, 'books.json')
+        self.users = os.path.join(self.directory, 'users.json')
+        for filename in (self.catalog, self.users):
+            with open(filename, 'w') as file:
+                file.write('[]')
+        static_root = override_settings(STATIC_ROOT=os.path.join(self.directory, 'static'))
+        static_root.enable()
+        self.addCleanup(static_root.disable)
+
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        lock = threading.Lock()
+
+        def fake_call_command(name, *args, **kwargs):
+            with lock:
+                self.calls.append(name)
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(0.05)
+            if name == 'collectstatic':
+                os.makedirs(os.path.join(self.directory, 'static', 'admin'), exist_ok=True)
+            with lock:
+                self.running -= 1
+
+        patcher = mock.patch('books.management.commands.boot.call_command', side_effect=fake_call_command)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def boot(self, *args):
+        out = StringIO()
+        call_command(
+            'boot', '--state', os.path.join(self.directory, 'state.json'),
+            '--catalog', self.catalog, '--users-fixture', self.users, *args, stdout=out, stderr=StringIO(),
+        )
+        return out.getvalue()
+
+    def test_steps_run_once(self):
+        output = self.boot()
+        self.assertCountEqual(self.calls, [
+            'migrate', 'collectstatic', 'loaddata', 'load_catalog', 'generate_cover_variants', 'build_similar_books',
+            'rebuild_rankings', 'build_related_books',
+        ])
+        self.assertRegex(output, r'migrate +ran in \d+\.\d+s')
+        self.calls.clear()
+        output = self.boot()
+        self.assertEqual(self.calls, [])
+        self.assertIn('unchanged, skipped', output)
+
+    def test_changed_input_reruns_its_step(self):
+        self.boot()
+        self.calls.clear()
+        with open(self.catalog, 'w') as file:
+            file.write('[ ]')
+        self.boot()
+        self.assertEqual(self.calls[0], 'load_catalog')
+        self.assertCountEqual(self.calls, [
+            'load_catalog', 'generate_cover_variants', 'build_similar_books', 'rebuild_rankings', 'build_related_books',
+        ])
+
+    def test_removed_static_files_are_collected_again(self):
+        self.boot()
+        self.calls.clear()
+        os.rmdir(os.path.join(self.directory, 'static', 'admin'))
+        self.boot()
+        self.assertEqual(self.calls, ['collectstatic'])
+
+    def test_force(self):
+        self.boot()
+        self.calls.clear()
+        self.boot('--force')
+        self.assertEqual(len(self.calls), 8)
+
+    def test_independent_steps_run_in_parallel(self):
+        self.boot()
+        self.assertGreater(self.max_running, 1)
+        self.assertLess(self.calls.index('migrate'), self.calls.index('load_catalog'))
+
+    def test_failed_step_stops_dependents(self):
+        with mock.patch('books.management.commands.boot.call_command', side_effect=RuntimeError('boom')):
+            with self.assertRaises(CommandError):
+                self.boot('--jobs', '1')
+        self.boot()
+        self.assertCountEqual(self.calls, [
+            'migrate', 'collectstatic', 'loaddata', 'load_catalog', 'generate_cover_variants', 'build_similar_books',
+            'rebuild_rankings', 'build_related_books',
+        ])
+
+
+class PeriodicCommandTest(TestCase):
+    def test_schedule(self):
+        """Every job waits its interval before its first run, and a failed run doesn't stop the others"""
+        clock = [0]
+        calls = []
+
+        def sleep(seconds):
+            if clock[0] + seconds > 60:
+                raise KeyboardInterrupt
+            clock[0] += seconds
+
+        def fake_call_command(name, *args, **kwargs):
+            calls.append((clock[0], name, *args))
+            if name == 'rebuild_rankings' and clock[0] == 25:
+                raise RuntimeError('boom')
+
+        err = StringIO()
+        with mock.patch('books.management.commands.run_periodic.time.monotonic', lambda: clock[0]), \
+                mock.patch('books.management.commands.run_periodic.time.sleep', sleep), \
+                mock.patch('books.management.commands.run_periodic.call_command', fake_call_command), \
+                mock.patch('books.management.commands.run_periodic.close_old_connections'), \
+                self.assertRaises(KeyboardInterrupt):
+            call_command(
+                'run_periodic', '--similar-every', '10', '--related-every', '30', '--rankings-every', '25',
+                stdout=StringIO(), stderr=err,
+            )
+        self.assertEqual(calls, [
+            (10, 'build_similar_books', '--incremental'), (20, 'build_similar_books', '--incremental'),
+            (25, 'rebuild_rankings'), (30, 'build_similar_books', '--incremental'),
+            (30, 'build_related_books', '--incremental'), (40, 'build_similar_books', '--incremental'),
+            (50, 'build_similar_books', '--incremental'), (50, 'rebuild_rankings'),
+            (60, 'build_similar_books', '--incremental'), (60, 'build_related_books', '--incremental'),
+        ])
+        self.assertIn("rebuild_rankings failed: RuntimeError('boom')", err.getvalue())
+
+
+class CoverVariantsTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_root = override_settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def image(self, size=(400, 600), format='JPEG'):
+        buffer = BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, format)
+        return buffer.getvalue()
+
+    def create_book(self, name, size=(400, 600)):
+        default_storage.save(name, ContentFile(self.image(size)))
+        return Book.objects.create(title="Cover", author="A", published_date="2024-01-01", cover_image=name)
+
+    def test_generate(self):
+        book = self.create_book('covers/1.jpg')
+        self.assertEqual(generate_covers([(book.id, book.cover_image.name)]), (1, 0))
+        book.refresh_from_db()
+        self.assertEqual((book.cover_width, book.cover_height), (400, 600))
+        self.assertTrue(book.cover_placeholder.startswith('data:image/webp;base64,'))
+        for width in (160, 320, 400):
+            with default_storage.open(variant_name('covers/1.jpg', width, 'webp')) as file:
+                self.assertEqual(Image.open(file).size, (width, round(600 * width / 400)))
+        self.assertFalse(default_storage.exists(variant_name('covers/1.jpg', 640, 'jpg')))
+
+    def test_serializer(self):
+        book = self.create_book('covers/1.jpg')
+        self.assertIsNone(BookSerializer(book, context={'bookmarked_ids': set()}).data['cover'])
+        generate_covers([(book.id, book.cover_image.name)])
+        book.refresh_from_db()
+        cover = BookSerializer(book, context={'bookmarked_ids': set()}).data['cover']
+        self.assertEqual(cover['width'], 400)
+        self.assertEqual(
+            cover['srcset_webp'],
+            '/media/covers/variants/1-160.webp 160w, /media/covers/variants/1-320.webp 320w, '
+            '/media/covers/variants/1-400.webp 400w',
+        )
+
+    def test_upload_generates_variants(self):
+        book = Book(title="Uploaded", author="A", published_date="2024-01-01")
+        book.cover_image = SimpleUploadedFile('up.png', self.image(size=(1000, 1500), format='PNG'))
+        with self.captureOnCommitCallbacks(execute=True):
+            book.save()
+        book.refresh_from_db()
+        self.assertEqual(book.cover_width, 1000)
+        self.assertTrue(default_storage.exists(variant_name(book.cover_image.name, 640, 'jpg')))
+
+    def test_missing_file(self):
+        book = Book.objects.create(title="Missing", author="A", published_date="2024-01-01", cover_image='covers/none.jpg')
+        with self.assertLogs('books.covers', 'WARNING'):
+            self.assertEqual(generate_covers([(book.id, book.cover_image.name)]), (0, 1))
+
+    def test_backfill_command(self):
+        for i in range(3):
+            self.create_book(f'covers/{i}.jpg')
+        out = StringIO()
+        call_command('generate_cover_variants', '--workers', '2', stdout=out)
+        self.assertIn('generated for 3 book(s), 0 failed', out.getvalue())
+        self.assertEqual(Book.objects.filter(cover_width=400).count(), 3)
+        out = StringIO()
+        call_command('generate_cover_variants', stdout=out)
+        self.assertIn('generated for 0 book(s)', out.getvalue())
+
+
+class CoverStorageTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        media_root = override_settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def image(self, color=(10, 20, 30)):
+        buffer = BytesIO()
+        Image.new('RGB', (200, 300), color).save(buffer, 'JPEG')
+        return buffer.getvalue()
+
+    def test_named_by_content(self):
+        first = cover_storage.save('covers/a.JPG', ContentFile(self.image()))
+        second = cover_storage.save('covers/b.jpg', ContentFile(self.image()))
+        other = cover_storage.save('covers/a.jpg', ContentFile(self.image(color=(200, 0, 0))))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertTrue(is_hashed_name(first))
+        self.assertRegex(first, r'^covers/([0-9a-f]{2})/\1[0-9a-f]{62}\.jpg$')
+        self.assertEqual(len(os.listdir(os.path.dirname(cover_storage.path(first)))), 1)
+
+    def test_upload(self):
+        books = []
+        for title in ("One", "Two"):
+            book = Book(title=title, author="A", published_date="2024-01-01")
+            book.cover_image = SimpleUploadedFile('cover.jpg', self.image())
+            book.save()
+            books.append(book)
+        self.assertEqual(books[0].cover_image.name, books[1].cover_image.name)
+        self.assertTrue(is_hashed_name(books[0].cover_image.name))
+
+    def test_rehash_command(self):
+        for name in ('covers/1.jpg', 'covers/2.jpg'):
+            default_storage.save(name, ContentFile(self.image()))
+        default_storage.save('covers/3.jpg', ContentFile(self.image(color=(200, 0, 0))))
+        books = [
+            Book.objects.create(title=f"Book {i}", author="A", published_date="2024-01-01", cover_image=f'covers/{i}.jpg')
+            for i in (1, 2, 3)
+        ]
+        Book.objects.create(title="Missing", author="A", published_date="2024-01-01", cover_image='covers/4.jpg')
+        generate_covers([(books[0].id, 'covers/1.jpg')])
+        version = catalog_version()
+
+        out = StringIO()
+        call_command('rehash_covers', stdout=out, stderr=StringIO())
+        self.assertIn('3 book(s) were rewritten, 3 file(s) were stored as 2 content-addressed file(s), 1 missing', out.getvalue())
+        names = [Book.objects.get(pk=book.pk).cover_image.name for book in books]
+        self.assertEqual(names[0], names[1])
+        self.assertNotEqual(names[0], names[2])
+        self.assertTrue(all(cover_storage.exists(name) for name in names))
+        for i in (1, 2, 3):
+            self.assertFalse(default_storage.exists(f'covers/{i}.jpg'))
+        # The variants moved along with the cover
+        self.assertTrue(default_storage.exists(variant_name(names[0], 160, 'webp')))
+        self.assertFalse(default_storage.exists(variant_name('covers/1.jpg', 160, 'webp')))
+        self.assertEqual(Book.objects.get(pk=books[2].pk).version, 1)
+        self.assertNotEqual(catalog_version(), version)
+
+        out = StringIO()
+        call_command('rehash_covers', stdout=out, stderr=StringIO())
+        self.assertIn('0 book(s) were rewritten', out.getvalue())
+
+    def test_rehash_fixture(self):
+        default_storage.save('covers/1.jpg', ContentFile(self.image()))
+        path = os.path.join(self.media_root, 'books.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump([{"model": "books.book", "pk": 1, "fields": {"title": "کتاب", "cover_image": "covers/1.jpg"}}], file)
+        call_command('rehash_covers', '--fixture', path, stdout=StringIO())
+        with open(path, encoding='utf-8') as file:
+            name = json.load(file)[0]["fields"]["cover_image"]
+        self.assertTrue(is_hashed_name(name))
+        self.assertTrue(cover_storage.exists(name))
+        self.assertFalse(default_storage.exists('covers/1.jpg'))
+
+
+class CommentUpsertTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='upsertuser', password='testpass')
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'upsertuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.book = Book.objects.create(title="Upsert", author="A", published_date="2024-01-01")
+        self.url = f'/books/comment/{self.book.id}/'
+
+    def test_fixed_statement_count(self):
+        """Creating and editing run the same statements: version bump, old row, upsert, bookmark delete, stats, rankings"""
+        Bookmark.objects.create(user=self.user, book=self.book)
+        # Authenticates, so the user is cached
+        self.client.get(f'/books/{self.book.id}/')
+        with self.assertNumQueries(8):
+            response = self.client.post(self.url, {'text': 'First', 'rating': 4})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with self.assertNumQueries(8):
+            response = self.client.post(self.url, {'text': 'Edited', 'rating': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['text'], 'Edited')
+
+        comment = Comment.objects.get()
+        self.assertEqual((comment.text, comment.rating), ('Edited', 2))
+        self.assertEqual(response.data['submitted_on'], CommentSerializer(comment).data['submitted_on'])
+        self.assertFalse(Bookmark.objects.exists())
+        self.assertEqual(Book.objects.get(pk=self.book.pk).version, 2)
+
+    def test_edit_without_rating_stores_null(self):
+        self.client.post(self.url, {'text': 'First', 'rating': 4})
+        self.client.post(self.url, {'text': 'Only text', 'rating': ''})
+        self.assertIsNone(Comment.objects.get().rating)
+        stats = BookStats.objects.get(book=self.book)
+        self.assertEqual((stats.total_rating, stats.rating_sum, stats.text_count), (0, 0, 1))
+
+    def test_missing_book(self):
+        response = self.client.post('/books/comment/999999/', {'text': 'x', 'rating': 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Comment.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "needs a database that allows concurrent writers")
+class CommentConcurrencyTest(TransactionTestCase):
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def test_concurrent_submissions(self):
+        """Concurrent creates and edits leave one comment per user and consistent stats"""
+        book = Book.objects.create(title="Busy", author="A", published_date="2024-01-01")
+        users = [User.objects.create(username=f'concurrent{i}') for i in range(4)]
+        for user in users[:2]:
+            Bookmark.objects.create(user=user, book=book)
+        submissions = [(user, str(rating)) for user in users for rating in range(1, 6)]
+        random.shuffle(submissions)
+        barrier = threading.Barrier(len(submissions))
+
+        def submit(submission):
+            user, rating = submission
+            try:
+                barrier.wait()
+                return self.client_for(user).post(f'/books/comment/{book.id}/', {'text': 'x', 'rating': rating}).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=len(submissions)) as executor:
+            codes = list(executor.map(submit, submissions))
+
+        self.assertEqual(codes.count(status.HTTP_201_CREATED), len(users))
+        self.assertEqual(codes.count(status.HTTP_200_OK), len(submissions) - len(users))
+        self.assertEqual(Comment.objects.filter(book=book).count(), len(users))
+        self.assertFalse(Bookmark.objects.filter(book=book).exists())
+        stats = BookStats.objects.get(book=book)
+        expected = BookStats.compute([book.id])[book.id]
+        self.assertEqual(expected, {field: getattr(stats, field) for field in expected})
+        self.assertEqual(stats.total_rating, len(users))
+        self.assertEqual(Book.objects.get(pk=book.pk).version, len(submissions))
+
+
+@skipUnless(connection.vendor == 'postgresql', "needs a database that allows concurrent writers")
+class RankingsConcurrencyTest(TransactionTestCase):
+    def test_overlapping_rebuilds(self):
+        """A rebuild started while another runs waits for it instead of adding the same scores again"""
+        book = Book.objects.create(title="Trending", author="A", published_date="2024-01-01")
+        for i in range(3):
+            Bookmark.objects.create(user=User.objects.create(username=f'overlap{i}'), book=book)
+        snapshot = rankings._snapshot
+        release = threading.Event()
+
+        def paused(*args):
+            result = snapshot(*args)
+            release.wait(5)
+            return result
+
+        def rebuild():
+            try:
+                rankings.rebuild()
+            finally:
+                connection.close()
+
+        with mock.patch.object(rankings, '_snapshot', paused), ThreadPoolExecutor(max_workers=2) as executor:
+            runs = [executor.submit(rebuild) for _ in range(2)]
+            # Long enough for the second to take its snapshot too, were it not waiting
+            time.sleep(0.5)
+            release.set()
+            for run in runs:
+                run.result()
+        self.assertAlmostEqual(BookRanking.objects.get(book=book).trending_score, 3, places=2)
+
+
+class AsyncReadURLs:
+    """URLconf serving the reads with the async views, as under ASGI."""
+    urlpatterns = [
+        path('auth/', include('users.urls')),
+        path('books/list/', AsyncBookListView.as_view()),
+        path('books/<int:pk>/', AsyncBookDetailView.as_view()),
+        path('books/<int:pk>/comments/', AsyncBookCommentsView.as_view()),
+    ]
+
+
+class AsyncReadViewsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='asyncuser', password='testpass')
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'asyncuser', 'password': 'testpass'})
+        self.authorization = f"Bearer {response.data['access']}"
+        self.client.credentials(HTTP_AUTHORIZATION=self.authorization)
+        self.books = [
+            Book.objects.create(title=f"Async Book {i}", author="Author Name", published_date="2024-01-01")
+            for i in range(5)
+        ]
+        self.book = self.books[0]
+        Bookmark.objects.create(user=self.user, book=self.books[1])
+        for i, rating in enumerate([5, 3, 5]):
+            Comment.upsert(User.objects.create(username=f'async{i}').id, self.book.id, f"Comment {i}", rating, timezone.now())
+            BookStats.record(self.book.id, old=None, new=(f"Comment {i}", rating))
+
+    def async_get(self, url, **headers):
+        headers.setdefault('authorization', self.authorization)
+        async def get():
+            return await AsyncClient().get(url, headers=headers)
+
+        with override_settings(ROOT_URLCONF=AsyncReadURLs):
+            return async_to_sync(get)()
+
+    def assertSameResponse(self, url, **headers):
+        expected = self.client.get(url, **{f'HTTP_{name.upper().replace("-", "_")}': value for name, value in headers.items()})
+        response = self.async_get(url, **headers)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.content, expected.content)
+        for header in ('Content-Type', 'ETag', 'Cache-Control', 'Vary', 'Allow', 'WWW-Authenticate'):
+            self.assertEqual(response.get(header), expected.get(header), header)
+        return response
+
+    def test_list(self):
+        response = self.assertSameResponse('/books/list/?limit=2')
+        self.assertSameResponse(response.json()['next'].replace('http://testserver', ''))
+        self.assertSameResponse('/books/list/?author=Nobody')
+        self.assertSameResponse('/books/list/?published_from=yesterday')
+        self.assertSameResponse('/books/list/?fields=title,is_bookmarked&expand=rating_avg')
+        self.assertSameResponse('/books/list/?fields=secret')
+        self.assertSameResponse('/books/list/', accept='application/msgpack')
+        # No browsable API over ASGI
+        self.assertEqual(self.async_get('/books/list/', accept='text/html')['Content-Type'], 'application/json')
+
+    def test_detail(self):
+        response = self.assertSameResponse(f'/books/{self.book.id}/')
+        self.assertEqual(len(response.json()['users_actions']), 3)
+        self.assertSameResponse(f'/books/{self.books[1].id}/')
+        self.assertSameResponse('/books/999999/')
+        self.assertSameResponse(f'/books/{self.book.id}/', if_none_match=response['ETag'])
+        self.assertSameResponse(f'/books/{self.book.id}/?fields=title,rating_avg')
+        self.assertSameResponse(f'/books/{self.book.id}/?exclude=users_actions,is_bookmarked')
+        self.assertSameResponse(f'/books/{self.book.id}/', accept='application/msgpack')
+
+    def test_comments(self):
+        response = self.assertSameResponse(f'/books/{self.book.id}/comments/?limit=2')
+        self.assertSameResponse(response.json()['next'].replace('http://testserver', ''))
+        self.assertSameResponse(f'/books/{self.book.id}/comments/?rating=5')
+        self.assertSameResponse(f'/books/{self.book.id}/comments/?rating=9')
+        self.assertSameResponse(f'/books/{self.book.id}/comments/?cursor=bogus')
+        self.assertSameResponse('/books/999999/comments/?rating=9')
+
+    def test_async_query_count(self):
+        """The queries the async views make through sync_to_async() are counted"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.async_get(f'/books/{self.book.id}/')
+        self.assertGreater(len(queries), 0)
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+        self.assertIn('view;dur=', response['Server-Timing'])
+
+    def test_authentication(self):
+        self.client.credentials()
+        self.assertSameResponse('/books/list/', authorization='')
+        self.assertSameResponse('/books/list/', authorization='Bearer bogus')
+
+    def test_permissions_and_throttles(self):
+        """The permission and throttle classes apply as they do to the APIViews"""
+        class Denied(BasePermission):
+            message = 'Not for you'
+
+            def has_permission(self, request, view):
+                return False
+
+        class Exhausted(BaseThrottle):
+            def allow_request(self, request, view):
+                return False
+
+            def wait(self):
+                return 30
+
+        with mock.patch.object(APIView, 'permission_classes', [Denied]), \
+                mock.patch.object(AsyncAPIView, 'permission_classes', [Denied]):
+            response = self.assertSameResponse('/books/list/')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self.assertEqual(response.json(), {'detail': 'Not for you'})
+            self.client.credentials()
+            self.assertEqual(self.assertSameResponse('/books/list/', authorization='').status_code, status.HTTP_401_UNAUTHORIZED)
+            self.client.credentials(HTTP_AUTHORIZATION=self.authorization)
+        with mock.patch.object(APIView, 'throttle_classes', [Exhausted]), \
+                mock.patch.object(AsyncAPIView, 'throttle_classes', [Exhausted]):
+            response = self.assertSameResponse(f'/books/{self.book.id}/')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '30')
+
+
+class RequestMetricsTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user(username='metricsuser', password='testpass')
+        response = self.client.post('/auth/token/', {'username': 'metricsuser', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.book = Book.objects.create(title="Metrics Book", author="Author Name", published_date="2024-01-01")
+
+    def timings(self, response):
+        return {part.split(';')[0]: part for part in response['Server-Timing'].split(', ')}
+
+    def test_server_timing(self):
+        self.client.get('/books/list/')
+        invalidate_catalog()
+        with self.assertNumQueries(1):
+            response = self.client.get('/books/list/')
+        timings = self.timings(response)
+        self.assertEqual(set(timings), {'db', 'serializer', 'render', 'view', 'total'})
+        self.assertIn('desc="1 queries"', timings['db'])
+
+    def test_metrics_endpoint(self):
+        self.client.get(f'/books/{self.book.id}/')
+        self.client.credentials()
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('books_request_duration_seconds_bucket{endpoint="book-detail",le="0.005",method="GET"}', body)
+        self.assertIn('books_db_queries_count{endpoint="book-detail",method="GET"}', body)
+
+    def test_slow_request_log(self):
+        with override_settings(SLOW_REQUEST_SECONDS=0), self.assertLogs('books.slow_requests') as logs:
+            self.client.get(f'/books/{self.book.id}/')
+        self.assertIn(f'GET /books/{self.book.id}/ (book-detail)', logs.output[0])
+        self.assertIn('FROM "books_book"', logs.output[0])
+
+    def test_async_chain(self):
+        """Under ASGI no middleware is adapted to sync, which would hold a thread per request"""
+        # Django only logs the adaptations with DEBUG on
+        with override_settings(DEBUG=True), self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    def test_fast_request_not_logged(self):
+        with self.assertNoLogs('books.slow_requests'):
+            self.client.get('/books/list/')
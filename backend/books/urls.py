@@ -1,9 +1,26 @@
+from django.conf import settings
 from django.urls import path
-from .views import BookListView, BookDetailView, BookmarkToggleView, SubmitCommentView
+from .async_views import AsyncBookCommentsView, AsyncBookDetailView, AsyncBookListView
+from .views import BookListView, BookDetailView, BookCommentsView, BookRelatedView, BookSearchView, BookSimilarView, TopBooksView, TrendingBooksView, BookmarkToggleView, BulkBookmarkView, CatalogExportView, SubmitCommentView
+
+# Under ASGI the reads are served by the async views, see backend/asgi.py
+if settings.ASYNC_READ_VIEWS:
+    read_views = AsyncBookListView, AsyncBookDetailView, AsyncBookCommentsView
+else:
+    read_views = BookListView, BookDetailView, BookCommentsView
+list_view, detail_view, comments_view = (view.as_view() for view in read_views)
 
 urlpatterns = [
-    path('list/', BookListView.as_view(), name='book-list'),
-    path('<int:pk>/', BookDetailView.as_view(), name='book-detail'),
+    path('list/', list_view, name='book-list'),
+    path('export/', CatalogExportView.as_view(), name='catalog-export'),
+    path('search/', BookSearchView.as_view(), name='book-search'),
+    path('top/', TopBooksView.as_view(), name='book-top'),
+    path('trending/', TrendingBooksView.as_view(), name='book-trending'),
+    path('<int:pk>/', detail_view, name='book-detail'),
+    path('<int:pk>/comments/', comments_view, name='book-comments'),
+    path('<int:pk>/related/', BookRelatedView.as_view(), name='book-related'),
+    path('<int:pk>/similar/', BookSimilarView.as_view(), name='book-similar'),
+    path('bookmark/bulk/', BulkBookmarkView.as_view(), name='bookmark-bulk'),
     path('bookmark/<int:pk>/', BookmarkToggleView.as_view(), name='bookmark-toggle'),
     path('comment/<int:pk>/', SubmitCommentView.as_view(), name='submit-comment'),
-]
\ No newline at end of file
+]
@@ -0,0 +1,31 @@
+import zlib
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connection
+
+
+def chunks(iterable, size):
+    """Lists of up to `size` consecutive items of `iterable`."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+@contextmanager
+def advisory_lock(name):
+    """
+    Hold the PostgreSQL advisory lock `name` for the block, waiting for whoever holds
+    it to finish first. SQLite databases only serve one process, so there it does nothing.
+    """
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    key = zlib.crc32(name.encode())
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', [key])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [key])
@@ -1,50 +1,387 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db import IntegrityError, transaction
-from .serializers import BookSerializer, CommentSerializer
-from .models import Book, Bookmark, Comment
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, FloatField, Subquery
+from django.db.models.functions import Power
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from .serializers import BookSerializer, BulkBookmarkSerializer, CommentSerializer
+from .models import Book, BookRanking, BookStats, Bookmark, Comment, RankingParameters
+from .cache import get_bookmarked_ids, get_list_page, invalidate_bookmarks, invalidate_catalog, invalidate_stats, set_list_page
+from .etags import book_detail_etag, book_list_etag, condition
+from .metrics import timed
+from .export import aiter_ndjson, iter_ndjson
+from .pagination import BookCursorPagination, CommentCursorPagination
+from .search import search_books
+from .similar import get_index as get_similar_index
+
+FIELDS_PARAMETERS = [
+    openapi.Parameter('fields', openapi.IN_QUERY, description="Comma-separated fields to return, the others are neither returned nor queried", type=openapi.TYPE_STRING),
+    openapi.Parameter('exclude', openapi.IN_QUERY, description="Comma-separated fields to leave out", type=openapi.TYPE_STRING),
+    openapi.Parameter('expand', openapi.IN_QUERY, description="Comma-separated optional fields to add: total_comments, total_rating, rating_avg, rating_dict", type=openapi.TYPE_STRING),
+]
+
+
+def select_fields(request, detailed=False):
+    """The fields asked for by the request, or a 400 response naming the unknown ones."""
+    try:
+        return BookSerializer.select_fields(request.query_params, detailed), None
+    except ValueError as exc:
+        return None, Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def list_filters(request):
+    """Lookups of the book list filters in the request, or a 400 response."""
+    filters = {}
+    author = request.query_params.get('author')
+    if author:
+        filters['author'] = author
+    for param, lookup in (('published_from', 'published_date__gte'), ('published_to', 'published_date__lte')):
+        value = request.query_params.get(param)
+        if not value:
+            continue
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            return None, Response({"error": f"{param} must be a date in YYYY-MM-DD format"}, status=status.HTTP_400_BAD_REQUEST)
+        filters[lookup] = date
+    return filters, None
+
+
+def list_page(paginator, books, request, fields):
+    """
+    The user-independent data of a book list page, as cached by get_list_page():
+    the paginated response with every is_bookmarked false, and the book ids.
+    """
+    serializer = BookSerializer(books, many=True, context={'request': request, 'fields': fields, 'bookmarked_ids': frozenset()})
+    with timed('serializer'):
+        data = serializer.data
+    return dict(paginator.get_paginated_response(data).data), [book.id for book in books]
+
+
+def with_bookmarks(page, bookmarked_ids):
+    """The response data of a list page with the user's is_bookmarked flags."""
+    data, ids = page
+    if bookmarked_ids is None:
+        return data
+    results = [{**book, 'is_bookmarked': book_id in bookmarked_ids} for book, book_id in zip(data['results'], ids)]
+    return {**data, 'results': results}
+
+
+def scored_results(request, fields, books):
+    """The serialized `books`, each with its `score` attribute."""
+    context = {'request': request, 'fields': fields}
+    if 'is_bookmarked' in fields:
+        context['bookmarked_ids'] = get_bookmarked_ids(request.user.id)
+    serializer = BookSerializer(books, many=True, context=context)
+    with timed('serializer'):
+        data = serializer.data
+    return [{**item, 'score': round(book.score, 4)} for item, book in zip(data, books)]
+
 
 class BookListView(APIView):
+    pagination_class = BookCursorPagination
+
     @swagger_auto_schema(
-        operation_description="Get a list of all books in the system.",
+        operation_description="Get a page of books ordered by title. Follow the `next`/`previous` links to move between pages.",
+        manual_parameters=[
+            openapi.Parameter('cursor', openapi.IN_QUERY, description="Opaque cursor taken from a `next`/`previous` link", type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description=f"Page size (max {BookCursorPagination.max_page_size})", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('author', openapi.IN_QUERY, description="Only books by this author", type=openapi.TYPE_STRING),
+            openapi.Parameter('published_from', openapi.IN_QUERY, description="Only books published on or after this date (YYYY-MM-DD)", type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE),
+            openapi.Parameter('published_to', openapi.IN_QUERY, description="Only books published on or before this date (YYYY-MM-DD)", type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE),
+            *FIELDS_PARAMETERS,
+        ],
         responses={
             200: openapi.Response(
-                description="A list of books",
+                description="A page of books",
                 schema=BookSerializer(many=True)
             ),
+            304: openapi.Response(
+                description="Not modified since the ETag sent in If-None-Match"
+            ),
             400: openapi.Response(
                 description="Bad request"
             ),
+            404: openapi.Response(
+                description="Invalid cursor"
+            ),
         },
     )
+    @condition(book_list_etag)
     def get(self, request):
-        books = Book.objects.all()
-        context = {'request': request}
-        serializer = BookSerializer(books, many=True, context=context)
-        return Response(serializer.data, status=status.HTTP_200_OK)
-    
+        fields, error = select_fields(request)
+        if error:
+            return error
+        filters, error = list_filters(request)
+        if error:
+            return error
+
+        # The page is shared by all users, only is_bookmarked is theirs
+        page, version = get_list_page(request, BookSerializer.has_stats(fields))
+        if page is None:
+            paginator = self.pagination_class()
+            books = BookSerializer.get_queryset(fields, paginator.ordering).filter(**filters)
+            page = list_page(paginator, paginator.paginate_queryset(books, request, view=self), request, fields)
+            set_list_page(request, version, page)
+        bookmarked_ids = get_bookmarked_ids(request.user.id) if 'is_bookmarked' in fields else None
+        return Response(with_bookmarks(page, bookmarked_ids), status=status.HTTP_200_OK)
+
+
 class BookDetailView(APIView):
     @swagger_auto_schema(
         operation_description="Retrieve a book by its ID",
+        manual_parameters=FIELDS_PARAMETERS,
         responses={
             200: BookSerializer,
+            304: openapi.Response(description="Not modified since the ETag sent in If-None-Match"),
             404: openapi.Response(description="Book not found")
         },
     )
+    @condition(book_detail_etag)
     def get(self, request, pk, *args, **kwargs):
+        fields, error = select_fields(request, detailed=True)
+        if error:
+            return error
         try:
-            book = Book.objects.get(pk=pk)
-            context = {'request': request, 'detailed': True}
+            book = BookSerializer.get_queryset(fields).get(pk=pk)
+            context = {'request': request, 'detailed': True, 'fields': fields}
+            if 'is_bookmarked' in fields:
+                context['bookmarked_ids'] = get_bookmarked_ids(request.user.id)
             serializer = BookSerializer(book, context=context)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            with timed('serializer'):
+                data = serializer.data
+            return Response(data, status=status.HTTP_200_OK)
         except Book.DoesNotExist:
             return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
         
 
+class BookSearchView(APIView):
+    default_limit = 20
+    max_limit = 100
+
+    @swagger_auto_schema(
+        operation_description="Full-text search over book titles, authors and descriptions, best match first. Arabic and Persian spellings of the same letters match each other.",
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, description="Search terms", type=openapi.TYPE_STRING, required=True),
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Number of results (max 100)", type=openapi.TYPE_INTEGER),
+            *FIELDS_PARAMETERS,
+        ],
+        responses={
+            200: openapi.Response(description="Matching books"),
+            400: openapi.Response(description="Search terms must be provided"),
+        },
+    )
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "Search terms must be provided"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.default_limit)), self.max_limit))
+        except ValueError:
+            limit = self.default_limit
+
+        fields, error = select_fields(request)
+        if error:
+            return error
+
+        books = search_books(BookSerializer.get_queryset(fields), query, limit)
+        context = {'request': request, 'fields': fields}
+        if 'is_bookmarked' in fields:
+            context['bookmarked_ids'] = get_bookmarked_ids(request.user.id)
+        serializer = BookSerializer(books, many=True, context=context)
+        with timed('serializer'):
+            data = serializer.data
+        return Response({'results': data}, status=status.HTTP_200_OK)
+
+
+class BookRelatedView(APIView):
+    default_limit = 10
+    max_limit = 50
+
+    @swagger_auto_schema(
+        operation_description="Books most often bookmarked or rated 4 or 5 by the readers who did so for this book, closest first. Computed by the build_related_books command.",
+        manual_parameters=[
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Number of results (max 50, or the number stored per book)", type=openapi.TYPE_INTEGER),
+            *FIELDS_PARAMETERS,
+        ],
+        responses={
+            200: openapi.Response(description="Related books, each with its similarity score"),
+            404: openapi.Response(description="Book not found"),
+        },
+    )
+    def get(self, request, pk):
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.default_limit)), self.max_limit))
+        except ValueError:
+            limit = self.default_limit
+
+        fields, error = select_fields(request)
+        if error:
+            return error
+
+        # One query on the (book, rank) index of RelatedBook joined to the books
+        books = list(BookSerializer.get_queryset(fields).filter(related_to__book_id=pk).annotate(
+            score=F('related_to__score'),
+        ).order_by('related_to__rank')[:limit])
+        if not books and not Book.objects.filter(pk=pk).exists():
+            return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'results': scored_results(request, fields, books)}, status=status.HTTP_200_OK)
+
+
+class BookSimilarView(APIView):
+    default_limit = 10
+    max_limit = 50
+
+    @swagger_auto_schema(
+        operation_description="Books whose title, author and description are closest to this book's (TF-IDF), best first. Read from the index written by the build_similar_books command.",
+        manual_parameters=[
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Number of results (max 50, or the number indexed per book)", type=openapi.TYPE_INTEGER),
+            *FIELDS_PARAMETERS,
+        ],
+        responses={
+            200: openapi.Response(description="Similar books, each with its similarity score"),
+            404: openapi.Response(description="Book not found"),
+        },
+    )
+    def get(self, request, pk):
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.default_limit)), self.max_limit))
+        except ValueError:
+            limit = self.default_limit
+
+        fields, error = select_fields(request)
+        if error:
+            return error
+
+        index = get_similar_index()
+        similar = index.similar(pk, limit) if index is not None else []
+        books = BookSerializer.get_queryset(fields).in_bulk([book_id for book_id, _ in similar])
+        if not similar and not Book.objects.filter(pk=pk).exists():
+            return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
+        # Books deleted since the index was built are left out
+        ranked = []
+        for book_id, score in similar:
+            if book_id in books:
+                books[book_id].score = score
+                ranked.append(books[book_id])
+        return Response({'results': scored_results(request, fields, ranked)}, status=status.HTTP_200_OK)
+
+
+class LeaderboardView(APIView):
+    default_limit = 20
+    max_limit = 100
+    parameters = [
+        openapi.Parameter('limit', openapi.IN_QUERY, description="Number of results (max 100)", type=openapi.TYPE_INTEGER),
+        *FIELDS_PARAMETERS,
+    ]
+
+    def leaderboard(self, request, books, column, score=None):
+        """The first books of `books` ordered by the BookRanking `column`, with their `score`."""
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.default_limit)), self.max_limit))
+        except ValueError:
+            limit = self.default_limit
+
+        fields, error = select_fields(request)
+        if error:
+            return error
+        # One query walking the BookRanking index of the column
+        books = list(books(BookSerializer.get_queryset(fields)).annotate(score=score or F(column)).order_by(
+            F(column).desc(), 'id',
+        )[:limit])
+        return Response({'results': scored_results(request, fields, books)}, status=status.HTTP_200_OK)
+
+
+class TopBooksView(LeaderboardView):
+    @swagger_auto_schema(
+        operation_description="Best rated books by Bayesian average: the ratings of a book averaged together with a prior of the mean rating of all books, so a few ratings can't put a book on top.",
+        manual_parameters=LeaderboardView.parameters,
+        responses={200: openapi.Response(description="Rated books, best first, each with its score")},
+    )
+    def get(self, request):
+        return self.leaderboard(request, lambda books: books.filter(ranking__top_score__isnull=False), 'ranking__top_score')
+
+
+class TrendingBooksView(LeaderboardView):
+    @swagger_auto_schema(
+        operation_description=f"Books with the most recent bookmarks and comments. Each counts half as much every {BookRanking.TRENDING_HALF_LIFE // 86400} days; a comment counts as {BookRanking.COMMENT_WEIGHT:g} bookmarks.",
+        manual_parameters=LeaderboardView.parameters,
+        responses={200: openapi.Response(description="Books with recent activity, most active first, each with its score")},
+    )
+    def get(self, request):
+        # Decayed from the epoch of the stored scores to now, which is the same factor for
+        # every book, so the order is the stored one
+        epoch = Subquery(RankingParameters.objects.values('trending_epoch')[:1])
+        decay = Power(2.0, (epoch - timezone.now().timestamp()) / BookRanking.TRENDING_HALF_LIFE)
+        return self.leaderboard(
+            request, lambda books: books.filter(ranking__trending_score__gt=0), 'ranking__trending_score',
+            ExpressionWrapper(F('ranking__trending_score') * decay, output_field=FloatField()),
+        )
+
+
+class BookCommentsView(APIView):
+    pagination_class = CommentCursorPagination
+
+    @swagger_auto_schema(
+        operation_description="Get a page of comments on a book, newest first. Follow the `next`/`previous` links to move between pages.",
+        manual_parameters=[
+            openapi.Parameter('cursor', openapi.IN_QUERY, description="Opaque cursor taken from a `next`/`previous` link", type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description=f"Page size (max {CommentCursorPagination.max_page_size})", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('rating', openapi.IN_QUERY, description="Only comments with this rating (1-5)", type=openapi.TYPE_INTEGER),
+        ],
+        responses={
+            200: openapi.Response(description="A page of comments"),
+            400: openapi.Response(description="Rating must be a number between 1 and 5"),
+            404: openapi.Response(description="Book not found or invalid cursor"),
+        },
+    )
+    def get(self, request, pk):
+        if not Book.objects.filter(pk=pk).exists():
+            return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        comments = Comment.objects.filter(book_id=pk)
+        rating = request.query_params.get('rating')
+        if rating:
+            if not rating.isdigit() or not int(rating) in range(1, 6):
+                return Response({"error": "Rating must be a number between 1 and 5"}, status=status.HTTP_400_BAD_REQUEST)
+            comments = comments.filter(rating=int(rating))
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(
+            comments.values('id', 'user__username', 'text', 'rating', 'submitted_on'), request, view=self
+        )
+        return paginator.get_paginated_response(page)
+
+
+class CatalogExportView(APIView):
+    permission_classes = [IsAdminUser]
+    chunk_size = 1000
+
+    @swagger_auto_schema(
+        operation_description="Stream the whole catalog as NDJSON, one book per line with its bookmark count and rating stats. Staff only.",
+        responses={
+            200: openapi.Response(description="application/x-ndjson stream of books"),
+            403: openapi.Response(description="Staff only"),
+        },
+    )
+    def get(self, request):
+        # Under ASGI Django buffers a sync iterator whole, the blocks have to come async
+        blocks = aiter_ndjson if isinstance(request._request, ASGIRequest) else iter_ndjson
+        response = StreamingHttpResponse(blocks(self.chunk_size), content_type='application/x-ndjson; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="catalog.ndjson"'
+        return response
+
+
 class BookmarkToggleView(APIView):
     @swagger_auto_schema(
         operation_description="Toggle bookmark on a book by ID. Use POST to add and DELETE to remove.",
@@ -60,6 +397,10 @@ class BookmarkToggleView(APIView):
             book = get_object_or_404(Book, id=pk)
             bookmark, created = Bookmark.objects.get_or_create(user=request.user, book=book)
             if created:
+                invalidate_bookmarks(request.user.id)
+                invalidate_catalog()
+                Book.objects.filter(pk=book.pk).bump_version()
+                BookRanking.record([(book.pk, BookRanking.BOOKMARK_WEIGHT, bookmark.added_on)])
                 return Response({"message": "Book bookmarked successfully"}, status=status.HTTP_201_CREATED)
             return Response({"message": "Bookmark already exists"}, status=status.HTTP_400_BAD_REQUEST)
         else:
@@ -69,12 +410,84 @@ class BookmarkToggleView(APIView):
         operation_description="Remove a bookmark from a book by ID.",
     )
     def delete(self, request, pk):
-        bookmark = Bookmark.objects.filter(user=request.user, book__id=pk).first()
-        if bookmark:
-            bookmark.delete()
+        with transaction.atomic():
+            # Only the request that actually deleted the bookmark takes its activity back
+            removed = Bookmark.remove(request.user.id, [pk])
+            if removed:
+                invalidate_bookmarks(request.user.id)
+                invalidate_catalog()
+                Book.objects.filter(pk=pk).bump_version()
+                BookRanking.record([(pk, -BookRanking.BOOKMARK_WEIGHT, removed[pk])])
+        if removed:
             return Response({"message": "Bookmark removed successfully"}, status=status.HTTP_204_NO_CONTENT)
         return Response({"message": "Bookmark not found"}, status=status.HTTP_404_NOT_FOUND)
     
+class BulkBookmarkView(APIView):
+    @swagger_auto_schema(
+        operation_description="Add and remove bookmarks for up to 500 books at once. Each book gets the status and message the single-book bookmark endpoint would return for it.",
+        request_body=BulkBookmarkSerializer,
+        responses={
+            200: openapi.Response(
+                description="Result per book id",
+                examples={"application/json": {"results": {
+                    "1": {"status": 201, "message": "Book bookmarked successfully"},
+                    "2": {"status": 400, "message": "You have Comment on this book"},
+                    "3": {"status": 204, "message": "Bookmark removed successfully"},
+                }}},
+            ),
+            400: openapi.Response(description="Invalid book ids"),
+        }
+    )
+    def post(self, request):
+        serializer = BulkBookmarkSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        add, remove = serializer.validated_data['add'], serializer.validated_data['remove']
+        user = request.user
+
+        results = {}
+        to_create, removed = [], {}
+        with transaction.atomic():
+            if add:
+                existing = set(Book.objects.filter(pk__in=add).values_list('id', flat=True))
+                commented = set(Comment.objects.filter(user=user, book_id__in=add).values_list('book_id', flat=True))
+                bookmarked = set(Bookmark.objects.filter(user=user, book_id__in=add).values_list('book_id', flat=True))
+                for book_id in add:
+                    # Same checks, in the same order, as BookmarkToggleView.post
+                    if book_id in commented:
+                        results[book_id] = (status.HTTP_400_BAD_REQUEST, "You have Comment on this book")
+                    elif book_id not in existing:
+                        results[book_id] = (status.HTTP_404_NOT_FOUND, "Book not found")
+                    elif book_id in bookmarked:
+                        results[book_id] = (status.HTTP_400_BAD_REQUEST, "Bookmark already exists")
+                    else:
+                        results[book_id] = (status.HTTP_201_CREATED, "Book bookmarked successfully")
+                        to_create.append(Bookmark(user=user, book_id=book_id))
+                Bookmark.objects.bulk_create(to_create, ignore_conflicts=True)
+
+            if remove:
+                removed = Bookmark.remove(user.id, remove)
+                for book_id in remove:
+                    if book_id in removed:
+                        results[book_id] = (status.HTTP_204_NO_CONTENT, "Bookmark removed successfully")
+                    else:
+                        results[book_id] = (status.HTTP_404_NOT_FOUND, "Bookmark not found")
+
+            changed = [book_id for book_id, (code, _) in results.items() if code in (status.HTTP_201_CREATED, status.HTTP_204_NO_CONTENT)]
+            if changed:
+                Book.objects.filter(pk__in=changed).bump_version()
+                invalidate_bookmarks(user.id)
+                invalidate_catalog()
+                BookRanking.record(
+                    [(bookmark.book_id, BookRanking.BOOKMARK_WEIGHT, bookmark.added_on) for bookmark in to_create]
+                    + [(book_id, -BookRanking.BOOKMARK_WEIGHT, added_on) for book_id, added_on in removed.items()]
+                )
+
+        return Response({"results": {
+            str(book_id): {"status": code, "message": message} for book_id, (code, message) in results.items()
+        }}, status=status.HTTP_200_OK)
+
+
 class SubmitCommentView(APIView):
     @swagger_auto_schema(
         operation_description="Submit a comment with optional rating and/or text. Both cannot be empty. Each user can comment only once per book.",
@@ -95,8 +508,6 @@ class SubmitCommentView(APIView):
         }
     )
     def post(self, request, pk):
-        book = get_object_or_404(Book, id=pk)
-
         text = request.data.get('text')
         rating = request.data.get('rating')
 
@@ -111,26 +522,30 @@ class SubmitCommentView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            with transaction.atomic():
-                bookmark = Bookmark.objects.filter(user=request.user, book=book).first()
-                if bookmark:
-                    bookmark.delete()
-                # Attempt to create the comment
-                comment = Comment.objects.create(
-                    user=request.user,
-                    book=book,
-                    text=text if text else None,
-                    rating=rating if rating else None
-                )
-            created = True
-        except IntegrityError:
-            comment = Comment.objects.get(user=request.user, book=book)
-            comment.text = text if text else None
-            comment.rating = rating if rating else 0
-            comment.save()
-            created = False
-    
+        text = text if text else None
+        rating = int(rating) if rating else None
+
+        # A fixed number of statements whether the comment is new or edited
+        with transaction.atomic():
+            # Bumping the version also checks the book exists and locks its row, so
+            # concurrent submissions on the same book are applied one after the other
+            if not Book.objects.filter(pk=pk).bump_version():
+                raise Http404
+            old = Comment.objects.filter(user=request.user, book_id=pk).values_list('text', 'rating', 'submitted_on').first()
+            submitted_on = old[2] if old else timezone.now()
+            comment_id = Comment.upsert(request.user.id, pk, text, rating, submitted_on)
+            # The comment replaces the user's bookmark, in the trending activity too
+            removed = Bookmark.remove(request.user.id, [pk])
+            if removed:
+                invalidate_bookmarks(request.user.id)
+                invalidate_catalog()
+            BookStats.record(pk, old=old[:2] if old else None, new=(text, rating))
+            invalidate_stats()
+            # Edits add no activity but may change the top score
+            activity = [(pk, 0 if old else BookRanking.COMMENT_WEIGHT, submitted_on)]
+            activity += [(pk, -BookRanking.BOOKMARK_WEIGHT, added_on) for added_on in removed.values()]
+            BookRanking.record(activity)
+
+        comment = Comment(id=comment_id, user=request.user, book_id=pk, text=text, rating=rating, submitted_on=submitted_on)
         serializer = CommentSerializer(comment)
-        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
-    
+        return Response(serializer.data, status=status.HTTP_200_OK if old else status.HTTP_201_CREATED)
@@ -1,22 +1,19 @@
 #!/bin/bash
-
-echo "****** Apply database migrations ******"
-python manage.py makemigrations 
-python manage.py migrate --noinput
-python manage.py graph_models -a -o ERD.png
-
-
-echo "****** Collecting static files ******"
-python manage.py collectstatic --noinput
-
-
-echo "****** Load fixrures ******"
-python manage.py loaddata fixtures/users.json
-python manage.py loaddata fixtures/books.json
-
-
-echo "****** Run django testcases ******"
-python manage.py test
-
-# Run server 
-uwsgi --ini ./uwsgi.ini 
+set -e
+
+# Migrations, static files and fixtures are only processed when they changed since
+# the last boot. The ERD and the test suite are built into the image (see Dockerfile).
+echo "****** Boot ******"
+python manage.py boot
+
+# Run server: uWSGI with the sync views, or uvicorn with the async read views
+# (SERVER=asgi, see backend/asgi.py). nginx must use the matching backend-*.conf.
+export WEB_WORKERS=${WEB_WORKERS:-1}
+# The workers write their metrics here and /metrics adds them up; samples of the
+# previous run would be counted again
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+if [ "$SERVER" = "asgi" ]; then
+    exec uvicorn backend.asgi:application --host 0.0.0.0 --port 8000 --workers "$WEB_WORKERS" --proxy-headers --forwarded-allow-ips '*' --no-access-log
+fi
+exec uwsgi --ini ./uwsgi.ini 
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import router
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from backend.versioned_cache import CacheStats, get_version, invalidate
+
+# How long a token's user stays in the shared cache, at most until the token expires
+USER_TIMEOUT = 5 * 60
+# How long a worker reuses a user without asking the shared cache; this bounds how
+# late other workers notice a deactivation or password change
+LOCAL_USER_TIMEOUT = 5
+LOCAL_USER_SIZE = 4096
+
+# The fields the views and permissions use, everything else is loaded on access
+USER_FIELDS = ['id', 'username', 'is_active', 'is_staff', 'is_superuser']
+
+
+class LocalCache:
+    """Thread-safe LRU of this process whose entries expire after `timeout` seconds."""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, match):
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_users = LocalCache(LOCAL_USER_SIZE, LOCAL_USER_TIMEOUT)
+user_cache_stats = CacheStats('users')
+
+
+def _user_version_key(user_id):
+    return f'users:auth:{user_id}:version'
+
+
+def _user_key(user_id, jti):
+    return f'users:auth:{user_id}:{jti}'
+
+
+def invalidate_user(user_id):
+    """Call after a change to `user_id` that affects authentication, e.g. deactivation."""
+    invalidate(_user_version_key(user_id))
+    local_users.discard(lambda key: key[0] == str(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that caches the user of a token instead of loading it on
+    every request, first in a short-lived LRU of the worker and then in the shared
+    cache. Entries are keyed by user id and token id (`jti`), so the active and
+    revoked-token checks made when the user was loaded hold for exactly that token,
+    and are dropped when the user is saved.
+
+    The user is built from USER_FIELDS only; other fields are loaded on access.
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        if user_id is None or jti is None:
+            return super().get_user(validated_token)
+
+        local_key = (str(user_id), jti)
+        record = local_users.get(local_key)
+        if record is not None:
+            user_cache_stats.hit()
+        else:
+            version_key, key = _user_version_key(user_id), _user_key(user_id, jti)
+            cached = cache.get_many([version_key, key])
+            version = cached.get(version_key)
+            entry = cached.get(key)
+            if version is not None and entry is not None and entry[0] == version:
+                user_cache_stats.hit()
+                record = entry[1]
+            else:
+                user_cache_stats.miss()
+                if version is None:
+                    version = get_version(version_key)
+                # Raises for unknown and inactive users and revoked tokens, which aren't cached
+                user = super().get_user(validated_token)
+                record = [getattr(user, field) for field in self.user_fields()]
+                expires_in = validated_token.get('exp', 0) - time.time()
+                cache.set(key, (version, record), max(1, min(USER_TIMEOUT, int(expires_in))))
+                local_users.set(local_key, record)
+                return user
+            local_users.set(local_key, record)
+        return self.user_model.from_db(router.db_for_read(self.user_model), self.user_fields(), record)
+
+    def user_fields(self):
+        # from_db() takes the values in the order of the model's fields
+        return [field.attname for field in self.user_model._meta.concrete_fields if field.attname in USER_FIELDS]
@@ -1,3 +1,69 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from .authentication import CachedJWTAuthentication, local_users
+
+
+class CachedJWTAuthenticationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_users.clear()
+        self.user = User.objects.create_user(username='reader', email='reader@example.com', password='testpass')
+        self.client = APIClient()
+        response = self.client.post('/auth/token/', {'username': 'reader', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.url = '/books/list/'
+
+    def authenticate(self, token):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return CachedJWTAuthentication().authenticate(request)[0]
+
+    def test_user_is_loaded_once(self):
+        """Only the first request of a token looks the user up"""
+        token = AccessToken.for_user(self.user)
+        with self.assertNumQueries(1):
+            self.authenticate(token)
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+        self.assertEqual((user.pk, user.username, user.is_active), (self.user.pk, 'reader', True))
+
+    def test_shared_cache_serves_other_workers(self):
+        token = AccessToken.for_user(self.user)
+        self.authenticate(token)
+        local_users.clear()
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+        self.assertEqual(user.pk, self.user.pk)
+        # Fields that aren't cached are loaded on access
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'reader@example.com')
+
+    def test_tokens_are_cached_separately(self):
+        self.authenticate(AccessToken.for_user(self.user))
+        with self.assertNumQueries(1):
+            self.authenticate(AccessToken.for_user(self.user))
+
+    def test_deactivation_rejects_cached_token(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_reloads_user(self):
+        token = AccessToken.for_user(self.user)
+        self.authenticate(token)
+        self.user.set_password('newpass')
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.authenticate(token)
+
+    def test_login_keeps_cache(self):
+        token = AccessToken.for_user(self.user)
+        self.authenticate(token)
+        self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            self.authenticate(token)
@@ -1,23 +1,37 @@
-#pip install requests
+#pip install httpx
 #pip install jdatetime
-import requests
-import json 
-import jdatetime
-import os 
+"""
+Ingest the Taaghche catalog into books.json (a books.book fixture) and covers/.
+
+Pages are followed through the API's nextOffset until the list ends, covers are
+downloaded concurrently through one pooled client, and progress is checkpointed
+after every page so a rerun skips the books and covers it already has.
+
+Covers are stored under the SHA-256 of their content (covers/ab/abcd....jpg, the
+layout of books.storage.ContentAddressedStorage), so identical images are stored
+once and a file never changes once written.
+
+    python extract-data-taaghche.py --base-url http://localhost:8001 --concurrency 16
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
 from datetime import datetime
 
+import httpx
+import jdatetime
 
-os.system('mkdir -p ./covers')
+DEFAULT_BASE_URL = os.environ.get('TAAGHCHE_BASE_URL', 'https://get.taaghche.com')
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+COVER_EXTENSIONS = {'image/png': '.png', 'image/webp': '.webp', 'image/gif': '.gif'}
 
-def fetch_books(list_type=1, list_value=135, offset="0-0-16-16", tracking_data=110160240, order=7):
-    base_url = 'https://get.taaghche.com/v2/everything'
-    filters = f'{{"list":[{{"type":{list_type},"value":{list_value}}},{{"type":50,"value":0}},{{"type":21,"value":0}},{{"type":3,"value":-106}},{{"value":0}}]}}'
 
-    url = f"{base_url}?filters={filters}&offset={offset}&trackingData={tracking_data}&order={order}"
+def build_filters(list_type, list_value):
+    return f'{{"list":[{{"type":{list_type},"value":{list_value}}},{{"type":50,"value":0}},{{"type":21,"value":0}},{{"type":3,"value":-106}},{{"value":0}}]}}'
 
-    response = requests.get(url)
-    data = response.json()
-    return data
 
 def jalali_to_gregorian(jalali_date_str):
     if jalali_date_str:
@@ -27,34 +41,182 @@ def jalali_to_gregorian(jalali_date_str):
     else:
         return datetime.today()
 
-def download_image(image_url, save_path):
-    response = requests.get(image_url, stream=True)
-    with open(save_path, 'wb') as file:
-        for chunk in response.iter_content(1024):
-            file.write(chunk)
 
-def convert_to_fixture(data, counter):
-    download_image(data["coverUri"],f"covers/{counter}.jpg")
-    fixture_data = {
+def convert_to_fixture(data, pk):
+    author = data["authors"][0] if data.get("authors") else {}
+    return {
         "model": "books.book",
-        "pk": counter,
+        "pk": pk,
         "fields": {
             "title": data["title"],
             "description": data.get("shareText", ""),
             "published_date": jalali_to_gregorian(data.get('publishDate')).strftime("%Y-%m-%d"),
-            "cover_image": f"covers/{counter}.jpg",
-            "author": f"{data["authors"][0]['firstName']}{data["authors"][0]['lastName']}",
+            "cover_image": None,
+            "author": f"{author.get('firstName', '')}{author.get('lastName', '')}",
         }
     }
-    return fixture_data
 
 
-data = fetch_books()
+def write_json_atomic(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """Books seen so far (keyed by Taaghche id), covers still to download and the next page offset."""
+
+    def __init__(self, path, first_offset):
+        self.path = path
+        self.next_offset = first_offset
+        self.finished = False
+        self.books = {}
+        self.cover_urls = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.next_offset = state['next_offset']
+            self.finished = state['finished']
+            self.books = state['books']
+            self.cover_urls = state['cover_urls']
+
+    def save(self):
+        write_json_atomic(self.path, {
+            'next_offset': self.next_offset,
+            'finished': self.finished,
+            'books': self.books,
+            'cover_urls': self.cover_urls,
+        })
+
+    def fixture(self):
+        return sorted(self.books.values(), key=lambda book: book['pk'])
+
+
+class Ingester:
+    def __init__(self, client, args, checkpoint):
+        self.client = client
+        self.args = args
+        self.checkpoint = checkpoint
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.cover_tasks = {}
+
+    async def request(self, url, **kwargs):
+        """GET with retries and exponential backoff (plus jitter) on transient failures."""
+        for attempt in range(self.args.retries + 1):
+            try:
+                response = await self.client.get(url, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+            except httpx.TransportError:
+                if attempt == self.args.retries:
+                    raise
+            else:
+                if attempt == self.args.retries:
+                    response.raise_for_status()
+            await asyncio.sleep(self.args.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def fetch_page(self, offset):
+        # Pages are fetched one at a time, outside the semaphore so covers can't starve them
+        response = await self.request(f'{self.args.base_url}/v2/everything', params={
+            'filters': build_filters(self.args.list_type, self.args.list_value),
+            'offset': offset,
+            'trackingData': self.args.tracking_data,
+            'order': self.args.order,
+        })
+        return response.json()
+
+    async def download_cover(self, key, url):
+        async with self.semaphore:
+            response = await self.request(url)
+        digest = hashlib.sha256(response.content).hexdigest()
+        content_type = response.headers.get('content-type', '').split(';')[0].strip()
+        filename = f'{digest}{COVER_EXTENSIONS.get(content_type, ".jpg")}'
+        path = os.path.join(self.args.covers_dir, digest[:2], filename)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.part'
+            with open(tmp_path, 'wb') as file:
+                file.write(response.content)
+            os.replace(tmp_path, path)
+        self.checkpoint.books[key]['fields']['cover_image'] = f'covers/{digest[:2]}/{filename}'
+        del self.checkpoint.cover_urls[key]
+
+    def add_book(self, book):
+        key = str(book['id'])
+        if key not in self.checkpoint.books:
+            pk = len(self.checkpoint.books) + 1
+            self.checkpoint.books[key] = convert_to_fixture(book, pk)
+        if book.get('coverUri') and not self.checkpoint.books[key]['fields']['cover_image']:
+            self.checkpoint.cover_urls[key] = book['coverUri']
+            self.queue_cover(key)
+
+    def queue_cover(self, key):
+        if key not in self.cover_tasks:
+            url = self.checkpoint.cover_urls[key]
+            self.cover_tasks[key] = asyncio.create_task(self.download_cover(key, url))
+
+    async def run(self):
+        pages = 0
+        while not self.checkpoint.finished:
+            if self.args.max_pages and pages >= self.args.max_pages:
+                break
+            offset = self.checkpoint.next_offset
+            data = await self.fetch_page(offset)
+            books = data.get('bookList', {}).get('books', [])
+            for book in books:
+                self.add_book(book)
+            next_offset = data.get('nextOffset') or data.get('bookList', {}).get('nextOffset')
+            self.checkpoint.next_offset = next_offset
+            self.checkpoint.finished = not books or not next_offset or next_offset == offset
+            pages += 1
+            self.checkpoint.save()
+            print(f'page {offset}: {len(books)} books, {len(self.checkpoint.books)} total')
+
+        # Covers of books from earlier runs whose download didn't finish
+        for key in list(self.checkpoint.cover_urls):
+            self.queue_cover(key)
+
+        results = await asyncio.gather(*self.cover_tasks.values(), return_exceptions=True)
+        self.checkpoint.save()
+        failed = [result for result in results if isinstance(result, Exception)]
+        for error in failed:
+            print(f'cover download failed: {error!r}')
+        return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL, help='Taaghche API base URL (env TAAGHCHE_BASE_URL)')
+    parser.add_argument('--output', default='books.json')
+    parser.add_argument('--covers-dir', default='covers')
+    parser.add_argument('--checkpoint', default='.ingest-checkpoint.json')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum requests in flight')
+    parser.add_argument('--retries', type=int, default=4)
+    parser.add_argument('--backoff', type=float, default=0.5, help='Base delay between retries in seconds')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--max-pages', type=int, default=0, help='Stop after this many pages (0: all)')
+    parser.add_argument('--offset', default='0-0-16-16', help='Offset of the first page')
+    parser.add_argument('--list-type', type=int, default=1)
+    parser.add_argument('--list-value', type=int, default=135)
+    parser.add_argument('--tracking-data', type=int, default=110160240)
+    parser.add_argument('--order', type=int, default=7)
+    return parser.parse_args()
+
+
+async def main(args):
+    os.makedirs(args.covers_dir, exist_ok=True)
+    checkpoint = Checkpoint(args.checkpoint, args.offset)
+    # One connection more than the semaphore allows, for the page requests
+    limits = httpx.Limits(max_connections=args.concurrency + 1, max_keepalive_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout, follow_redirects=True) as client:
+        failed = await Ingester(client, args, checkpoint).run()
+    write_json_atomic(args.output, checkpoint.fixture())
+    covers = sum(1 for book in checkpoint.books.values() if book['fields']['cover_image'])
+    print(f'{len(checkpoint.books)} books written to {args.output}, {covers} with covers in {args.covers_dir}')
+    return 1 if failed else 0
 
-fixture = []
-for counter , book in enumerate(data['bookList']['books']):
-    fixture_data = convert_to_fixture(book, counter+1)
-    fixture.append(fixture_data)
 
-with open("books.json", "w") as f:
-    json.dump(fixture, f, indent=4, ensure_ascii=False)
\ No newline at end of file
+if __name__ == '__main__':
+    raise SystemExit(asyncio.run(main(parse_args())))
@@ -0,0 +1,190 @@
+"""
+Tests of extract-data-taaghche.py against a local stub of the Taaghche API.
+
+    python -m unittest discover scripts
+"""
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+spec = importlib.util.spec_from_file_location(
+    'extract_data_taaghche', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract-data-taaghche.py'),
+)
+extract = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(extract)
+
+COVERS = {name: f'image {name}'.encode() for name in ('a', 'b', 'c')}
+
+
+def book(book_id, cover=None):
+    return {
+        'id': book_id,
+        'title': f'Book {book_id}',
+        'shareText': f'About book {book_id}',
+        'publishDate': '1400/01/01',
+        'authors': [{'firstName': 'First', 'lastName': 'Last'}],
+        'coverUri': cover and f'/covers/{cover}.jpg',
+    }
+
+
+class StubAPI(BaseHTTPRequestHandler):
+    """Pages of `server.pages` keyed by offset and COVERS, failing a path `server.failures[path]` times first."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.hits[url.path] += 1
+        if url.path == '/v2/everything':
+            offset = parse_qs(url.query)['offset'][0]
+            key = f'{url.path}?offset={offset}'
+            self.server.hits[key] += 1
+        else:
+            key = url.path
+        if self.server.failures.get(key, 0) > 0:
+            self.server.failures[key] -= 1
+            return self.reply(503, b'', 'text/plain')
+
+        if url.path == '/v2/everything':
+            books, next_offset = self.server.pages[offset]
+            for item in books:
+                if item['coverUri'] and item['coverUri'].startswith('/'):
+                    item['coverUri'] = self.server.base_url + item['coverUri']
+            body = {'bookList': {'books': books}, 'nextOffset': next_offset}
+            return self.reply(200, json.dumps(body).encode(), 'application/json')
+        name = os.path.splitext(os.path.basename(url.path))[0]
+        if url.path.startswith('/covers/') and name in COVERS:
+            return self.reply(200, COVERS[name], 'image/jpeg')
+        self.reply(404, b'', 'text/plain')
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class IngesterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubAPI)
+        self.server.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.server.hits = Counter()
+        self.server.failures = {}
+        # The last page repeats book 3 and cover b, and has no next offset
+        self.server.pages = {
+            '0-0-16-16': ([book(1, 'a'), book(2, 'b')], '1-16-16-16'),
+            '1-16-16-16': ([book(3, 'c'), book(4)], '2-32-16-16'),
+            '2-32-16-16': ([book(3, 'c'), book(5, 'b')], None),
+        }
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def run_ingester(self, *args):
+        argv = [
+            'extract-data-taaghche.py', '--base-url', self.server.base_url, '--backoff', '0',
+            '--output', os.path.join(self.directory, 'books.json'),
+            '--covers-dir', os.path.join(self.directory, 'covers'),
+            '--checkpoint', os.path.join(self.directory, 'checkpoint.json'),
+            *args,
+        ]
+        with mock.patch('sys.argv', argv), contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(extract.main(extract.parse_args()))
+
+    def fixture(self):
+        with open(os.path.join(self.directory, 'books.json')) as file:
+            return {book['fields']['title']: book for book in json.load(file)}
+
+    def cover_path(self, name):
+        digest = hashlib.sha256(COVERS[name]).hexdigest()
+        return f'covers/{digest[:2]}/{digest}.jpg'
+
+    def test_paging(self):
+        """Pages are followed through nextOffset until the last one"""
+        self.assertEqual(self.run_ingester(), 0)
+        books = self.fixture()
+        self.assertEqual(sorted(books), [f'Book {i}' for i in range(1, 6)])
+        self.assertEqual([book['pk'] for book in books.values()], [1, 2, 3, 4, 5])
+        self.assertEqual(books['Book 1']['fields']['published_date'], '2021-03-21')
+        self.assertEqual(books['Book 1']['fields']['author'], 'FirstLast')
+        self.assertEqual(books['Book 1']['fields']['cover_image'], self.cover_path('a'))
+        self.assertIsNone(books['Book 4']['fields']['cover_image'])
+        self.assertEqual(self.server.hits['/v2/everything'], 3)
+
+    def test_dedup(self):
+        """A book listed twice is stored once, and so is a cover shared by two books"""
+        self.run_ingester()
+        books = self.fixture()
+        self.assertEqual(len(books), 5)
+        self.assertEqual(books['Book 2']['fields']['cover_image'], books['Book 5']['fields']['cover_image'])
+        stored = [
+            os.path.relpath(os.path.join(root, name), self.directory)
+            for root, _, names in os.walk(os.path.join(self.directory, 'covers')) for name in names
+        ]
+        self.assertEqual(sorted(stored), sorted(self.cover_path(name) for name in COVERS))
+        # Book 3's cover is downloaded once, though it is listed on two pages
+        self.assertEqual(self.server.hits['/covers/c.jpg'], 1)
+
+    def test_retry_backoff(self):
+        """Transient failures are retried with exponentially growing delays"""
+        self.server.failures = {'/v2/everything?offset=1-16-16-16': 2, '/covers/a.jpg': 1}
+        delays = []
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        with mock.patch.object(extract.asyncio, 'sleep', sleep), mock.patch.object(extract.random, 'random', return_value=0):
+            self.assertEqual(self.run_ingester('--backoff', '0.5'), 0)
+        self.assertEqual(self.server.hits['/v2/everything?offset=1-16-16-16'], 3)
+        self.assertEqual(self.server.hits['/covers/a.jpg'], 2)
+        self.assertEqual(sorted(delays), [0.5, 0.5, 1.0])
+        self.assertEqual(self.fixture()['Book 1']['fields']['cover_image'], self.cover_path('a'))
+
+    def test_retries_exhausted(self):
+        """A cover that keeps failing is reported and left without an image"""
+        self.server.failures = {'/covers/a.jpg': 10}
+        self.assertEqual(self.run_ingester('--retries', '2'), 1)
+        self.assertEqual(self.server.hits['/covers/a.jpg'], 3)
+        self.assertIsNone(self.fixture()['Book 1']['fields']['cover_image'])
+
+    def test_resume(self):
+        """A rerun continues from the checkpoint and only fetches what is missing"""
+        self.server.failures = {'/covers/a.jpg': 10}
+        self.assertEqual(self.run_ingester('--max-pages', '1', '--retries', '0'), 1)
+        self.assertEqual(sorted(self.fixture()), ['Book 1', 'Book 2'])
+
+        self.server.failures = {}
+        self.assertEqual(self.run_ingester(), 0)
+        books = self.fixture()
+        self.assertEqual(sorted(books), [f'Book {i}' for i in range(1, 6)])
+        self.assertEqual(books['Book 1']['fields']['cover_image'], self.cover_path('a'))
+        # The first page isn't fetched again, nor book 2's cover: b is downloaded once
+        # for book 2 by the first run and once for book 5 by the second
+        self.assertEqual(self.server.hits['/v2/everything?offset=0-0-16-16'], 1)
+        self.assertEqual(self.server.hits['/covers/b.jpg'], 2)
+
+        # A finished ingest fetches nothing more
+        hits = sum(self.server.hits.values())
+        self.assertEqual(self.run_ingester(), 0)
+        self.assertEqual(sum(self.server.hits.values()), hits)
+
+
+if __name__ == '__main__':
+    unittest.main()